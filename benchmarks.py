@@ -0,0 +1,188 @@
+"""Бенчмарки бота.
+
+Запуск: python benchmarks.py [название ...]
+Без аргументов выполняются все бенчмарки.
+"""
+import random
+import sys
+import time
+import tracemalloc
+from datetime import datetime
+
+import chess
+from aiogram import F
+from aiogram.types import Chat, Message, User
+
+import checkers_engine
+from main import ButtonRouter, CheckersGame, ChessGame, UserRecord
+
+BENCHMARKS = {}
+
+
+def benchmark(func):
+    BENCHMARKS[func.__name__] = func
+    return func
+
+
+def _legacy_user(history_size: int) -> dict:
+    """Профиль в старом формате: вложенные словари с ISO-датами"""
+    return {
+        "username": "user",
+        "messages_count": 0,
+        "warnings": [],
+        "ban_expiry": None,
+        "irisky": 100,
+        "is_moderator": False,
+        "irisky_history": [
+            {"date": datetime.now().isoformat(), "amount": 15, "balance": 100 + i, "reason": "Ферма"}
+            for i in range(history_size)
+        ],
+        "reminders": [],
+        "last_ferma": None,
+    }
+
+
+def _typed_user(history_size: int) -> UserRecord:
+    user = UserRecord("user", 100)
+    for _ in range(history_size):
+        user.record(15, "Ферма")
+    return user
+
+
+def _bytes_per_user(factory, count: int, history_size: int) -> float:
+    tracemalloc.start()
+    data = [factory(history_size) for _ in range(count)]
+    used = tracemalloc.get_traced_memory()[0]
+    tracemalloc.stop()
+    del data
+    return used / count
+
+
+@benchmark
+def user_memory(count: int = 10000, history_size: int = 50) -> None:
+    """Память на одного пользователя: словари против UserRecord"""
+    legacy = _bytes_per_user(_legacy_user, count, history_size)
+    typed = _bytes_per_user(_typed_user, count, history_size)
+    print(f"users={count} history={history_size}")
+    print(f"  dict:       {legacy:10.0f} bytes/user")
+    print(f"  UserRecord: {typed:10.0f} bytes/user ({legacy / typed:.1f}x less)")
+
+
+def _random_game(plies: int, seed: int = 1) -> list:
+    """Случайная партия в SAN для воспроизведения"""
+    rng = random.Random(seed)
+    board = chess.Board()
+    moves = []
+    while len(moves) < plies and not board.is_game_over():
+        move = rng.choice(list(board.legal_moves))
+        moves.append(board.san(move))
+        board.push(move)
+    return moves
+
+
+def _legacy_ply(board: chess.Board, move_str: str) -> None:
+    """Прежний путь одного /move: разбор, проверка, winner(), статус и отрисовка шаха"""
+    move = board.parse_san(move_str)
+    if move in board.legal_moves:
+        board.push(move)
+    if board.is_checkmate() or board.is_stalemate() or board.is_insufficient_material():
+        pass
+    board.is_checkmate(), board.is_stalemate(), board.is_insufficient_material(), board.is_check()
+    board.is_check()
+
+
+@benchmark
+def chess_move(games: int = 50, plies: int = 80) -> None:
+    """Стоимость одного хода /move: прежние проверки против PositionStatus"""
+    recorded = [_random_game(plies, seed) for seed in range(games)]
+    total_plies = sum(len(moves) for moves in recorded)
+
+    started = time.perf_counter()
+    for moves in recorded:
+        board = chess.Board()
+        for move_str in moves:
+            _legacy_ply(board, move_str)
+    legacy = (time.perf_counter() - started) / total_plies
+
+    started = time.perf_counter()
+    for moves in recorded:
+        game = ChessGame("white", "black")
+        for move_str in moves:
+            game.move(move_str)
+            game.winner()
+            game.get_game_status()
+            game.status().is_check
+    memoised = (time.perf_counter() - started) / total_plies
+
+    print(f"plies={total_plies}")
+    print(f"  legacy:         {legacy * 1e6:8.1f} us/move")
+    print(f"  PositionStatus: {memoised * 1e6:8.1f} us/move ({legacy / memoised:.1f}x faster)")
+
+
+def _checkers_midgame(plies: int, seed: int = 1) -> list:
+    """Позиция шашек после случайных ходов из начальной"""
+    rng = random.Random(seed)
+    board = CheckersGame("white", "black").engine_board()
+    player = 1
+    for _ in range(plies):
+        moves, _ = checkers_engine.generate_moves(board, player)
+        if not moves:
+            break
+        checkers_engine.make_move(board, rng.choice(moves), 0)
+        player = 3 - player
+    return board if player == 1 else _checkers_midgame(plies + 1, seed)
+
+
+@benchmark
+def checkers_search(max_depth: int = 8) -> None:
+    """Перебор AI в шашках: время на ход и узлы в секунду по глубине"""
+    positions = {"start": CheckersGame("white", "black").engine_board(), "midgame": _checkers_midgame(16)}
+    for name, board in positions.items():
+        print(f"position={name}")
+        for depth in range(1, max_depth + 1):
+            checkers_engine._TT.clear()
+            _, score, nodes, elapsed = checkers_engine.search(board, 1, depth)
+            print(f"  depth {depth}: {elapsed * 1000:8.1f} ms/move {nodes:8d} nodes "
+                  f"{nodes / elapsed:8.0f} nodes/s score={score}")
+
+
+def _text_message(text: str) -> Message:
+    return Message(
+        message_id=1, date=datetime.now(), chat=Chat(id=1, type="private"),
+        from_user=User(id=1, is_bot=False, first_name="user"), text=text,
+    )
+
+
+@benchmark
+def button_routing(rounds: int = 20000) -> None:
+    """Маршрутизация сообщения: цепочка F.text.lower() == ... против ButtonRouter"""
+    messages = [_text_message("Привет всем, как дела?"), _text_message("🎮 Игры")]
+    for count in (6, 25, 100):
+        texts = [f"🔘 Кнопка {idx}" for idx in range(count - 1)] + ["🎮 Игры"]
+        filters = [F.text.lower() == text.lower() for text in texts]
+        router = ButtonRouter()
+        for text in texts:
+            router.button(text)(lambda message: None)
+
+        results = []
+        for route in (
+            lambda message: next((f for f in filters if f.resolve(message)), None),
+            router.match,
+        ):
+            started = time.perf_counter()
+            for _ in range(rounds):
+                for message in messages:
+                    route(message)
+            results.append((time.perf_counter() - started) / (rounds * len(messages)))
+        legacy, routed = results
+        print(f"  buttons={count:3d}: filters {legacy * 1e6:7.2f} us/message, "
+              f"ButtonRouter {routed * 1e6:5.2f} us/message ({legacy / routed:.0f}x faster)")
+
+
+if __name__ == "__main__":
+    names = sys.argv[1:] or list(BENCHMARKS)
+    for name in names:
+        print(f"== {name}: {BENCHMARKS[name].__doc__}")
+        started = time.perf_counter()
+        BENCHMARKS[name]()
+        print(f"   ({time.perf_counter() - started:.1f}s)\n")
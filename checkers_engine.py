@@ -0,0 +1,254 @@
+"""Движок русских шашек для AI-соперника.
+
+Модуль без побочных эффектов при импорте: его функции выполняются в процессах
+ProcessPoolExecutor, которые импортируют только этот файл, а не main.py.
+
+Доска - 64 клетки (row * 8 + col) с кодами из CheckersGame._PIECE_CODES:
+0 - пусто, 1/2 - шашка/дамка игрока 1, 3/4 - шашка/дамка игрока 2.
+Игрок 1 начинает снизу (ряды 5-7) и идёт к ряду 0, игрок 2 - наоборот.
+Ход - кортеж (путь по клеткам, побитые клетки, код фигуры после хода).
+"""
+import random
+import time
+
+EMPTY = 0
+MAN_1, KING_1, MAN_2, KING_2 = 1, 2, 3, 4
+_OWNER = (0, 1, 1, 2, 2)
+_IS_KING = (False, False, True, False, True)
+_PROMOTED = (0, KING_1, KING_1, KING_2, KING_2)
+_FORWARD = {1: (-1,), 2: (1,)}  # Направление хода простой шашки по рядам
+_LAST_ROW = {1: 0, 2: 7}
+_DIRECTIONS = ((-1, -1), (-1, 1), (1, -1), (1, 1))
+
+# Диагональные лучи из каждой клетки по каждому направлению: генерация ходов без проверок границ
+_RAYS = []
+for _square in range(64):
+    _rays = []
+    for _dr, _dc in _DIRECTIONS:
+        _ray = []
+        _r, _c = divmod(_square, 8)
+        _r, _c = _r + _dr, _c + _dc
+        while 0 <= _r < 8 and 0 <= _c < 8:
+            _ray.append(_r * 8 + _c)
+            _r, _c = _r + _dr, _c + _dc
+        _rays.append((_dr, tuple(_ray)))
+    _RAYS.append(tuple(_rays))
+
+_rng = random.Random(20240601)
+ZOBRIST = [[0] + [_rng.getrandbits(64) for _ in range(4)] for _ in range(64)]
+ZOBRIST_SIDE = _rng.getrandbits(64)
+
+WIN_SCORE = 100000
+TT_LIMIT = 1 << 20  # Сколько позиций хранить в таблице транспозиций процесса
+_EXACT, _LOWER, _UPPER = 0, 1, 2
+_TT = {}  # Таблица транспозиций процесса: ключ Zobrist -> (глубина, оценка, флаг, лучший ход)
+
+
+def hash_board(board, player: int) -> int:
+    key = ZOBRIST_SIDE if player == 2 else 0
+    for square, code in enumerate(board):
+        if code:
+            key ^= ZOBRIST[square][code]
+    return key
+
+
+def _captures(board, square: int, code: int, player: int, path: list, captured: list, out: list) -> bool:
+    """Продолжения взятия с клетки square; возвращает, было ли хотя бы одно"""
+    found = False
+    king = _IS_KING[code]
+    for dr, ray in _RAYS[square]:
+        if king:
+            idx = 0
+            while idx < len(ray) and board[ray[idx]] == EMPTY:
+                idx += 1
+        else:
+            idx = 0
+        if idx + 1 >= len(ray):
+            continue
+        victim = ray[idx]
+        if _OWNER[board[victim]] in (0, player) or victim in captured:
+            continue
+        landings = []
+        for land in ray[idx + 1:] if king else ray[idx + 1:idx + 2]:
+            if board[land] != EMPTY:
+                break
+            landings.append(land)
+        if not landings:
+            continue
+
+        # Дамка обязана встать на клетку, с которой взятие продолжается, если такая есть
+        branches = []
+        for land in landings:
+            new_code = _PROMOTED[code] if land // 8 == _LAST_ROW[player] else code
+            board[square] = EMPTY
+            board[land] = new_code
+            path.append(land)
+            captured.append(victim)
+            branch = []
+            if not _captures(board, land, new_code, player, path, captured, branch):
+                branch.append((tuple(path), tuple(captured), new_code))
+                branches.append((False, branch))
+            else:
+                branches.append((True, branch))
+            path.pop()
+            captured.pop()
+            board[land] = EMPTY
+            board[square] = code
+        continuing = any(cont for cont, _ in branches)
+        for cont, branch in branches:
+            if cont or not continuing:
+                out.extend(branch)
+        found = True
+    return found
+
+
+def generate_moves(board, player: int):
+    """Легальные ходы игрока и признак того, что это взятия (взятие обязательно)"""
+    captures = []
+    for square in range(64):
+        code = board[square]
+        if _OWNER[code] == player:
+            _captures(board, square, code, player, [square], [], captures)
+    if captures:
+        return captures, True
+
+    moves = []
+    last_row = _LAST_ROW[player]
+    for square in range(64):
+        code = board[square]
+        if _OWNER[code] != player:
+            continue
+        king = _IS_KING[code]
+        for dr, ray in _RAYS[square]:
+            if not king and dr not in _FORWARD[player]:
+                continue
+            for land in ray if king else ray[:1]:
+                if board[land] != EMPTY:
+                    break
+                new_code = _PROMOTED[code] if land // 8 == last_row else code
+                moves.append(((square, land), (), new_code))
+    return moves, False
+
+
+def make_move(board, move, key: int) -> tuple:
+    """Применяет ход к доске на месте; возвращает новый ключ и данные для unmake_move"""
+    path, captured, new_code = move
+    start, end = path[0], path[-1]
+    code = board[start]
+    key ^= ZOBRIST[start][code] ^ ZOBRIST[end][new_code] ^ ZOBRIST_SIDE
+    board[start] = EMPTY
+    board[end] = new_code
+    removed = []
+    for square in captured:
+        removed.append(board[square])
+        key ^= ZOBRIST[square][board[square]]
+        board[square] = EMPTY
+    return key, (code, removed)
+
+
+def unmake_move(board, move, undo) -> None:
+    path, captured, _ = move
+    code, removed = undo
+    board[path[-1]] = EMPTY
+    board[path[0]] = code
+    for square, victim in zip(captured, removed):
+        board[square] = victim
+
+
+def evaluate(board, player: int) -> int:
+    """Оценка позиции с точки зрения player: материал, продвижение шашек, центр"""
+    score = 0
+    for square in range(64):
+        code = board[square]
+        if not code:
+            continue
+        row, col = divmod(square, 8)
+        if _IS_KING[code]:
+            value = 300
+        else:
+            value = 100 + 4 * ((7 - row) if code == MAN_1 else row)
+        if 2 <= col <= 5 and 2 <= row <= 5:
+            value += 5
+        score += value if _OWNER[code] == player else -value
+    return score
+
+
+def _order(moves, tt_move):
+    """Сначала ход из таблицы транспозиций, затем длинные взятия и превращения"""
+    moves.sort(key=lambda m: (m != tt_move, -len(m[1]), -m[2]))
+    return moves
+
+
+def _negamax(board, player: int, depth: int, alpha: int, beta: int, key: int, ply: int, stats: list) -> int:
+    stats[0] += 1
+    alpha_orig = alpha
+    tt_move = None
+    entry = _TT.get(key)
+    if entry is not None:
+        tt_depth, tt_score, tt_flag, tt_move = entry
+        if tt_depth >= depth:
+            if tt_flag == _EXACT:
+                return tt_score
+            if tt_flag == _LOWER:
+                alpha = max(alpha, tt_score)
+            else:
+                beta = min(beta, tt_score)
+            if alpha >= beta:
+                return tt_score
+
+    moves, forced = generate_moves(board, player)
+    if not moves:
+        return -WIN_SCORE + ply
+    # На нулевой глубине взятия доигрываются, чтобы не оценивать позицию посреди размена
+    if depth <= 0 and not forced:
+        return evaluate(board, player)
+
+    opponent = 3 - player
+    best_score = -WIN_SCORE - 1
+    best_move = None
+    for move in _order(moves, tt_move):
+        child_key, undo = make_move(board, move, key)
+        score = -_negamax(board, opponent, depth - 1, -beta, -alpha, child_key, ply + 1, stats)
+        unmake_move(board, move, undo)
+        if score > best_score:
+            best_score, best_move = score, move
+        if score > alpha:
+            alpha = score
+        if alpha >= beta:
+            break
+
+    flag = _UPPER if best_score <= alpha_orig else _LOWER if best_score >= beta else _EXACT
+    if len(_TT) >= TT_LIMIT:
+        _TT.clear()
+    _TT[key] = (max(depth, 0), best_score, flag, best_move)
+    return best_score
+
+
+def search(board, player: int, depth: int) -> tuple:
+    """Итеративное углубление до depth; возвращает (лучший ход, оценка, узлы, секунды)"""
+    board = list(board)
+    key = hash_board(board, player)
+    stats = [0]
+    started = time.perf_counter()
+    best_move, best_score = None, 0
+    moves, _ = generate_moves(board, player)
+    if len(moves) == 1:
+        return moves[0], 0, 1, time.perf_counter() - started
+
+    for current_depth in range(1, depth + 1):
+        alpha, beta = -WIN_SCORE - 1, WIN_SCORE + 1
+        tt_entry = _TT.get(key)
+        ordered = _order(list(moves), tt_entry[3] if tt_entry else best_move)
+        iteration_best, iteration_score = None, -WIN_SCORE - 1
+        for move in ordered:
+            child_key, undo = make_move(board, move, key)
+            score = -_negamax(board, 3 - player, current_depth - 1, -beta, -alpha, child_key, 1, stats)
+            unmake_move(board, move, undo)
+            if score > iteration_score:
+                iteration_best, iteration_score = move, score
+            alpha = max(alpha, score)
+        best_move, best_score = iteration_best, iteration_score
+        _TT[key] = (current_depth, best_score, _EXACT, best_move)
+        if abs(best_score) >= WIN_SCORE - 100:
+            break
+    return best_move, best_score, stats[0], time.perf_counter() - started
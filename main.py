@@ -1,31 +1,54 @@
 import os
+import sys
+import array
+import asyncio
+import atexit
+import contextvars
+import copy
+import gzip
+import hashlib
 import json
+import lzma
+import mmap
+import bisect
+import heapq
 import random
+import time
+import zlib
 import chess
 import requests
 import logging
+import logging.handlers
+import queue
+import struct
 from aiogram.client.bot import DefaultBotProperties
 import chess.svg
+import chess.polyglot
+import checkers_engine
 from svglib.svglib import svg2rlg
 from reportlab.graphics import renderPM
-from aiogram import Bot, Dispatcher, types, F, Router
+from aiogram import BaseMiddleware, Bot, Dispatcher, types, F, Router
 from aiogram.enums import ParseMode
+from aiogram.exceptions import TelegramAPIError, TelegramBadRequest
 from aiogram.filters import Command, CommandStart
 from aiogram.types import (
     BufferedInputFile,
     InlineKeyboardButton,
     InlineKeyboardMarkup,
+    InputMediaPhoto,
     KeyboardButton,
     ReplyKeyboardMarkup,
     ReplyKeyboardRemove,
     Message,
 )
 from aiogram.utils.markdown import bold, code, italic
-from collections import defaultdict
+from collections import OrderedDict, defaultdict, deque
+from collections.abc import MutableMapping
+from concurrent.futures import ProcessPoolExecutor
 from datetime import timedelta, datetime
 from time import sleep
 from io import BytesIO
-from typing import Optional, Dict, Any
+from typing import Optional, Dict, Any, List
 import pytz
 from geopy.geocoders import Nominatim
 import matplotlib.pyplot as plt
@@ -33,11 +56,103 @@ import numpy as np
 from PIL import Image
 import io
 
-# Настройка логирования
-logging.basicConfig(
-    level=logging.INFO,
-    format="%(asctime)s - %(name)s - %(levelname)s - %(message)s",
-)
+# Настройка логирования: вызывающий код только кладёт запись в очередь,
+# вывод выполняет поток QueueListener и не задерживает цикл событий
+LOG_FORMAT = "json"  # "json" - строка JSON на запись, "text" - "время - логгер - уровень - сообщение"
+LOG_TEXT_FORMAT = "%(asctime)s - %(name)s - %(levelname)s - %(message)s"
+LOG_REPEAT_WINDOW = 60  # Одинаковые предупреждения и ошибки пишутся не чаще раза за это окно, секунд
+LOG_CONTEXT = contextvars.ContextVar("log_context", default={})  # Апдейт, пользователь, чат, обработчик
+
+
+class LogContextFilter(logging.Filter):
+    """Переносит контекст апдейта в запись до очереди - в потоке, где он известен"""
+
+    def filter(self, record: logging.LogRecord) -> bool:
+        for key, value in LOG_CONTEXT.get().items():
+            setattr(record, key, value)
+        return True
+
+
+class RepeatedErrorFilter(logging.Filter):
+    """Пропускает одинаковое предупреждение или ошибку раз в окно; следующая запись несёт число пропущенных"""
+
+    def __init__(self, window: float = LOG_REPEAT_WINDOW, max_keys: int = 1000):
+        super().__init__()
+        self.window = window
+        self.max_keys = max_keys
+        self._seen = {}  # (логгер, уровень, сообщение) -> [начало окна, пропущено]
+        self.suppressed = 0
+
+    def filter(self, record: logging.LogRecord) -> bool:
+        if record.levelno < logging.WARNING:
+            return True
+        now = time.monotonic()
+        key = (record.name, record.levelno, record.getMessage())
+        entry = self._seen.get(key)
+        if entry is not None and now - entry[0] < self.window:
+            entry[1] += 1
+            self.suppressed += 1
+            return False
+        if entry is not None and entry[1]:
+            record.repeated = entry[1]
+        if len(self._seen) >= self.max_keys:
+            self._seen = {k: v for k, v in self._seen.items() if now - v[0] < self.window}
+        self._seen[key] = [now, 0]
+        return True
+
+
+class JsonLogFormatter(logging.Formatter):
+    FIELDS = ("update_id", "user_id", "chat_id", "handler", "repeated")
+
+    def format(self, record: logging.LogRecord) -> str:
+        entry = {
+            "time": self.formatTime(record),
+            "level": record.levelname,
+            "logger": record.name,
+            "message": record.getMessage(),
+        }
+        for field in self.FIELDS:
+            value = getattr(record, field, None)
+            if value is not None:
+                entry[field] = value
+        if record.exc_text:
+            entry["exception"] = record.exc_text
+        return json.dumps(entry, ensure_ascii=False, default=str)
+
+
+class QueueLogHandler(logging.handlers.QueueHandler):
+    def prepare(self, record: logging.LogRecord) -> logging.LogRecord:
+        """Подставляет аргументы %-формата (объекты в args могут измениться), трассировку хранит отдельно"""
+        record = copy.copy(record)
+        record.msg = record.getMessage()
+        record.args = None
+        if record.exc_info:
+            record.exc_text = logging.Formatter().formatException(record.exc_info)
+            record.exc_info = None
+        return record
+
+
+REPEATED_ERRORS = RepeatedErrorFilter()
+
+
+def setup_logging(level: int = logging.INFO) -> logging.handlers.QueueListener:
+    log_queue = queue.SimpleQueue()
+    handler = QueueLogHandler(log_queue)
+    handler.addFilter(REPEATED_ERRORS)
+    handler.addFilter(LogContextFilter())
+    output = logging.StreamHandler()
+    output.setFormatter(JsonLogFormatter() if LOG_FORMAT == "json" else logging.Formatter(LOG_TEXT_FORMAT))
+    listener = logging.handlers.QueueListener(log_queue, output)
+    root = logging.getLogger()
+    root.handlers[:] = [handler]
+    root.setLevel(level)
+    listener.start()
+    # Записи, оставшиеся в очереди, дописываются при выходе
+    atexit.register(listener.stop)
+    return listener
+
+
+LOG_LISTENER = setup_logging()
 logger = logging.getLogger(__name__)
 
 # Конфигурация
@@ -46,72 +161,2302 @@ WEATHER_API_KEY = "YOUR_OPENWEATHERMAP_API_KEY"
 MAPS_API_KEY = "YOUR_GOOGLE_MAPS_API_KEY"
 TRANSLATE_API_KEY = "YOUR_YANDEX_TRANSLATE_API_KEY"
 
-bot = Bot(token=API_TOKEN, default=DefaultBotProperties(parse_mode=ParseMode.HTML))
+# Бот создаётся в main(): проверка токена не должна мешать импорту модуля (бенчмарки, консольные команды)
+bot: Optional[Bot] = None
 dp = Dispatcher()
 
 # Данные сохраняются в эти файлы
 DATA_FILE = "users_data.json"
 CHECKS_FILE = "checks_data.json"
-GAME_STATES = {}
-USER_STATES = {}  # Для хранения состояний пользователей
+SNAPSHOT_FILE = "bot_data.snap"
+SNAPSHOT_COMPRESSION = "zlib"  # "none", "zlib" или "lzma"
+# "memory" - все пользователи в памяти, "lazy" - mmap-индекс и загрузка записей по требованию
+STORAGE_MODE = "memory"
+USER_CACHE_SIZE = 10000  # Сколько пользователей держать в памяти в режиме "lazy"
+SAVE_DELAY = 2.0  # Изменения за это окно записываются одной операцией
+SAVE_MAX_DELAY = 10.0  # Максимум секунд изменений, которые можно потерять при сбое
+GAMES_DIR = "games"  # Сюда выгружаются неактивные партии
+GAME_IDLE_TIMEOUT = 30 * 60  # Через сколько секунд без ходов партия выгружается на диск
+GAME_MAX_AGE = 7 * 24 * 3600  # Через сколько секунд без ходов партия удаляется совсем
+GAME_MAX_LIVE = 1000  # Сколько партий держать в памяти одновременно
+# "edit" - у партии одно сообщение (доска с подписью), которое редактируется после каждого хода;
+# "classic" - после каждого хода отправляются новая доска и отдельное сообщение со статусом
+CHESS_VIEW_MODE = "edit"
+BOARD_FILE_ID_CACHE_SIZE = 10000  # Сколько file_id отрисованных позиций запоминать
+OPENING_BOOK_FILE = "book.bin"  # Дебютная книга в формате Polyglot
+OPENING_NAMES_FILE = "openings.tsv"  # Названия дебютов: eco<TAB>name<TAB>pgn (формат lichess chess-openings)
+PUZZLES_FILE = "puzzles.csv"  # База задач в формате lichess: PuzzleId,FEN,Moves,Rating,...,Themes,...
+PUZZLE_RATING_BAND = 100  # Ширина диапазона рейтинга в индексе задач
+# Контроль времени: название -> (минуты на партию, добавление секунд за ход)
+CHESS_TIME_CONTROLS = {"blitz": (5, 3), "rapid": (15, 10)}
+ARCHIVE_DIR = "archive"  # Архив завершённых партий
+ARCHIVE_BLOCK_GAMES = 64  # Сколько партий сжимается в один блок архива
+ELO_START = 1500  # Начальный рейтинг игрока
+ELO_AI = 1500  # Постоянный рейтинг AI-соперника
+ELO_K = 32
+GAMES_PAGE_SIZE = 10  # Партий на странице /games
+CHECKERS_AI_DEPTH = 6  # Глубина перебора AI в шашках по умолчанию
+CHECKERS_AI_MAX_DEPTH = 10
+CHECKERS_AI_WORKERS = 2  # Процессов для перебора ходов AI
 WEATHER_CACHE = {}
+FORECAST_CACHE = {}
+WEATHER_CACHE_TTL = 3600  # Сколько секунд погода и прогноз по городу берутся из кэша
+WEATHER_FORECAST_DAYS = 3
+WEATHER_REFRESH_TOP = 20  # Для скольких популярных запросов кэш обновляется заранее
+WEATHER_REFRESH_AHEAD = 600  # За сколько секунд до истечения обновлять популярные записи
+WEATHER_REFRESH_INTERVAL = 60  # Как часто проверять популярные записи, секунд
+WEATHER_POPULARITY_HALF_LIFE = 6 * 3600  # Период полураспада счётчика популярности, секунд
+WEATHER_CITY_LIST_FILE = "city.list.json.gz"  # Список городов OpenWeatherMap (bulk.openweathermap.org/sample)
+WEATHER_CONCURRENCY = 5  # Сколько запросов к OpenWeatherMap выполнять одновременно
+WEATHER_GROUP_SIZE = 20  # Сколько id городов принимает один запрос /group
+WEATHER_MAX_CITIES = 10  # Сколько городов можно запросить одной командой
+WEATHER_TIMEOUT = 10
+WEATHER_STALE_TTL = 6 * 3600  # До какого возраста устаревшая погода отдаётся сразу, с обновлением в фоне
+# Автомат защиты внешних API: окно последних вызовов, доля ошибок для размыкания,
+# вызов дольше CIRCUIT_SLOW_CALL секунд считается ошибкой, пауза до пробного вызова
+CIRCUIT_WINDOW = 20
+CIRCUIT_MIN_CALLS = 5
+CIRCUIT_ERROR_RATE = 0.5
+CIRCUIT_SLOW_CALL = 5.0
+CIRCUIT_OPEN_FOR = 30
+MAP_CACHE_DIR = "map_cache"  # Картинки Google Static Maps по хэшу нормализованного запроса
+MAP_CACHE_MAX_BYTES = 200 * 1024 * 1024
+MAP_COORD_PRECISION = 4  # Знаков после запятой в координатах ключа кэша (~10 м)
+GEOCODE_CACHE_TTL = 7 * 24 * 3600
+GEOCODE_STALE_TTL = 30 * 24 * 3600  # Сколько ещё отдавать устаревшие координаты, обновляя их в фоне
+MAPS_TIMEOUT = 15
+DIRECTIONS_PROVIDER = "google"  # "google" - Directions API, "stub" - прямая линия без сети (для разработки)
+ROUTE_MODES = ("driving", "walking", "bicycling", "transit")
+ROUTE_CACHE_TTL = 24 * 3600
+ROUTE_STALE_TTL = 7 * 24 * 3600
+ROUTE_PATH_MAX_CHARS = 2000  # Длина закодированной линии маршрута в URL Static Maps
+ROUTE_SIMPLIFY_TOLERANCE = 1e-5  # Начальный допуск упрощения линии, градусы (~1 м)
+TRANSLATE_CACHE_SIZE = 10000  # Сколько переводов помнить
+TRANSLATE_CACHE_TTL = 24 * 3600
+TRANSLATE_STALE_TTL = 7 * 24 * 3600
+TRANSLATE_BATCH_WINDOW = 0.05  # Сколько секунд собирать запросы перевода в один вызов API
+TRANSLATE_BATCH_MAX_TEXTS = 20
+TRANSLATE_BATCH_MAX_CHARS = 10000  # Ограничение Yandex Translate на объём одного запроса
+TRANSLATE_TIMEOUT = 10
+SESSION_MAX_SIZE = 100000  # Сколько состояний пользователей держать одновременно
+SESSION_TTL = 600  # Время жизни состояния по умолчанию, секунд
+QUIZ_ANSWER_TIMEOUT = 120  # Сколько секунд принимается ответ на вопрос викторины
+CHAT_MEMBERS_LIMIT = 200  # Сколько недавно активных участников помнить в каждом чате
+CHAT_MEMBERS_MAX_CHATS = 10000  # Сколько чатов держать в кэше участников
+CHAT_ADMINS_TTL = 3600  # Через сколько секунд список администраторов чата запрашивается заново
+CHAT_STATS_FILE = "chat_stats.snap"  # Статистика чатов: разделы по чатам в формате снапшота
+CHAT_STATS_TOP = 5  # Размер таблицы лидеров в /statistics
+CHAT_STATS_SAVE_INTERVAL = 300  # Как часто записывать статистику чатов, секунд
+# Ограничение частоты дорогих запросов: корзины токенов на пользователя и на чат (ёмкость, токенов в секунду)
+THROTTLE_USER_BUCKET = (10, 0.2)
+THROTTLE_CHAT_BUCKET = (30, 1.0)
+THROTTLE_NOTICE_COOLDOWN = 30  # Не чаще раза в столько секунд предупреждать пользователя об ограничении
+# Стоимость обработчиков в токенах (по имени функции); остальные обработчики не ограничиваются
+THROTTLE_COSTS = {
+    "cmd_profile": 3, "profile_button": 3,
+    "handle_move": 2, "cmd_puzzle": 2, "game_chess": 2, "game_chess_callback": 2,
+    "handle_checkers_move": 2,
+    "cmd_map": 4, "cmd_route": 5,
+    "cmd_translate": 2,
+    "cmd_weather": 1, "weather_callback_handler": 1,
+    "cmd_economy": 3, "cmd_statistics": 2, "cmd_games": 1,
+}
+
+
+# ================== КОМПАКТНЫЙ ФОРМАТ СНАПШОТА ==================
+#
+# Файл: MAGIC | версия (1 байт) | сжатие (1 байт) | поток записей.
+# Поток записей (при необходимости сжатый zlib/lzma) состоит из записей
+# вида varint(длина) | тип записи (1 байт) | ключ | значение и завершается
+# нулевой длиной. Даты в ISO-формате хранятся как целые микросекунды,
+# часто встречающиеся ключи словарей - номерами из SNAPSHOT_KEYS.
+
+SNAPSHOT_MAGIC = b"PKSN"
+SNAPSHOT_VERSION = 2  # 1 - записи словарями, 2 - позиционными строками (to_row)
+SNAPSHOT_CHUNK_SIZE = 64 * 1024
+
+RECORD_USER = 1
+RECORD_CHECK = 2
+RECORD_GAME = 3
+RECORD_CHAT = 4
+
+# Порядок ключей - часть формата: новые ключи добавляются только в конец
+SNAPSHOT_KEYS = (
+    "username", "messages_count", "warnings", "ban_expiry", "irisky", "is_moderator",
+    "irisky_history", "reminders", "last_ferma", "date", "amount", "balance", "reason",
+    "timestamp", "moderator", "text", "time", "created", "completed", "user_id",
+    "activated", "activated_by", "activated_at",
+)
+_SNAPSHOT_KEY_IDS = {key: idx for idx, key in enumerate(SNAPSHOT_KEYS)}
 
+_COMPRESSION_CODES = {"none": 0, "zlib": 1, "lzma": 2}
 
-# Загрузка данных
-def load_data():
-    global users, checks
+_T_NONE, _T_FALSE, _T_TRUE, _T_INT, _T_FLOAT, _T_STR, _T_LIST, _T_DICT, _T_TIME, _T_BYTES = range(10)
+
+_EPOCH = datetime(1970, 1, 1)
+_MICROSECOND = timedelta(microseconds=1)
+
+
+class SnapshotError(Exception):
+    """Ошибка чтения снапшота"""
+
+
+def _write_varint(out: bytearray, value: int) -> None:
+    while value > 0x7F:
+        out.append((value & 0x7F) | 0x80)
+        value >>= 7
+    out.append(value)
+
+
+def _read_varint(buf, pos: int):
+    result = shift = 0
+    while True:
+        byte = buf[pos]
+        pos += 1
+        result |= (byte & 0x7F) << shift
+        if byte < 0x80:
+            return result, pos
+        shift += 7
+
+
+def _write_str(out: bytearray, value: str) -> None:
+    data = value.encode("utf-8")
+    _write_varint(out, len(data))
+    out += data
+
+
+def _read_str(buf, pos: int):
+    length, pos = _read_varint(buf, pos)
+    return str(buf[pos:pos + length], "utf-8"), pos + length
+
+
+def _parse_iso_time(value: str) -> Optional[datetime]:
+    """Возвращает дату, если строка - ISO-дата без потерь при обратном преобразовании"""
+    if len(value) < 19 or value[4] != "-" or value[10] != "T":
+        return None
     try:
-        with open(DATA_FILE, "r") as file:
-            users = json.load(file)
-    except (FileNotFoundError, json.JSONDecodeError):
-        users = {}
+        parsed = datetime.fromisoformat(value)
+    except ValueError:
+        return None
+    if parsed.tzinfo is not None or parsed.isoformat() != value:
+        return None
+    return parsed
+
+
+def _encode_value(value: Any, out: bytearray, local_keys: Dict[str, int]) -> None:
+    """Кодирует значение JSON-совместимой структуры в компактный бинарный вид"""
+    if value is None:
+        out.append(_T_NONE)
+    elif value is True:
+        out.append(_T_TRUE)
+    elif value is False:
+        out.append(_T_FALSE)
+    elif isinstance(value, int):
+        out.append(_T_INT)
+        _write_varint(out, (value << 1) if value >= 0 else ((-value << 1) - 1))
+    elif isinstance(value, float):
+        out.append(_T_FLOAT)
+        out += struct.pack("<d", value)
+    elif isinstance(value, str):
+        moment = _parse_iso_time(value)
+        if moment is not None:
+            micros = (moment - _EPOCH) // _MICROSECOND
+            out.append(_T_TIME)
+            _write_varint(out, (micros << 1) if micros >= 0 else ((-micros << 1) - 1))
+        else:
+            out.append(_T_STR)
+            _write_str(out, value)
+    elif isinstance(value, (bytes, bytearray)):
+        out.append(_T_BYTES)
+        _write_varint(out, len(value))
+        out += value
+    elif isinstance(value, (list, tuple)):
+        out.append(_T_LIST)
+        _write_varint(out, len(value))
+        for item in value:
+            _encode_value(item, out, local_keys)
+    elif isinstance(value, dict):
+        out.append(_T_DICT)
+        _write_varint(out, len(value))
+        base = len(SNAPSHOT_KEYS)
+        for key, item in value.items():
+            key = str(key)
+            key_id = _SNAPSHOT_KEY_IDS.get(key)
+            if key_id is not None:
+                _write_varint(out, key_id)
+            elif key in local_keys:
+                _write_varint(out, base + 1 + local_keys[key])
+            else:
+                # Новый ключ пишется один раз на запись, дальше - по номеру
+                local_keys[key] = len(local_keys)
+                _write_varint(out, base)
+                _write_str(out, key)
+            _encode_value(item, out, local_keys)
+    else:
+        raise TypeError(f"Unsupported snapshot value type: {type(value).__name__}")
+
+
+def _decode_value(buf, pos: int, local_keys: list):
+    """Декодирует значение, записанное _encode_value"""
+    tag = buf[pos]
+    pos += 1
+    if tag == _T_NONE:
+        return None, pos
+    if tag == _T_TRUE:
+        return True, pos
+    if tag == _T_FALSE:
+        return False, pos
+    if tag == _T_INT or tag == _T_TIME:
+        raw, pos = _read_varint(buf, pos)
+        number = (raw >> 1) if not raw & 1 else -((raw + 1) >> 1)
+        if tag == _T_TIME:
+            return (_EPOCH + number * _MICROSECOND).isoformat(), pos
+        return number, pos
+    if tag == _T_FLOAT:
+        return struct.unpack_from("<d", buf, pos)[0], pos + 8
+    if tag == _T_STR:
+        return _read_str(buf, pos)
+    if tag == _T_BYTES:
+        length, pos = _read_varint(buf, pos)
+        return bytes(buf[pos:pos + length]), pos + length
+    if tag == _T_LIST:
+        length, pos = _read_varint(buf, pos)
+        items = []
+        for _ in range(length):
+            item, pos = _decode_value(buf, pos, local_keys)
+            items.append(item)
+        return items, pos
+    if tag == _T_DICT:
+        length, pos = _read_varint(buf, pos)
+        base = len(SNAPSHOT_KEYS)
+        result = {}
+        for _ in range(length):
+            key_id, pos = _read_varint(buf, pos)
+            if key_id < base:
+                key = SNAPSHOT_KEYS[key_id]
+            elif key_id == base:
+                key, pos = _read_str(buf, pos)
+                local_keys.append(key)
+            else:
+                key = local_keys[key_id - base - 1]
+            result[key], pos = _decode_value(buf, pos, local_keys)
+        return result, pos
+    raise SnapshotError(f"Unknown value tag {tag} at {pos - 1}")
+
+
+def encode_record(kind: int, key: str, value: Any) -> bytes:
+    """Кодирует одну запись снапшота вместе с префиксом длины"""
+    body = bytearray([kind])
+    _write_str(body, key)
+    _encode_value(value, body, {})
+    record = bytearray()
+    _write_varint(record, len(body))
+    record += body
+    return bytes(record)
+
+
+def decode_record(body):
+    """Декодирует тело записи (без префикса длины) в (тип, ключ, значение)"""
+    key, pos = _read_str(body, 1)
+    value, _ = _decode_value(body, pos, [])
+    return body[0], key, value
+
+
+class SnapshotWriter:
+    """Потоковая запись снапшота: файл не собирается в памяти целиком"""
+
+    def __init__(self, file, compression: str = "none"):
+        if compression not in _COMPRESSION_CODES:
+            raise ValueError(f"Unknown snapshot compression: {compression}")
+        self._file = file
+        self._compressor = None
+        if compression == "zlib":
+            self._compressor = zlib.compressobj(6)
+        elif compression == "lzma":
+            self._compressor = lzma.LZMACompressor()
+        self.offset = 0  # Смещение в несжатом потоке записей
+        file.write(SNAPSHOT_MAGIC + bytes([SNAPSHOT_VERSION, _COMPRESSION_CODES[compression]]))
+
+    def _write(self, data: bytes) -> None:
+        self.offset += len(data)
+        if self._compressor is not None:
+            data = self._compressor.compress(data)
+        if data:
+            self._file.write(data)
+
+    def write_record(self, kind: int, key: str, value: Any) -> int:
+        """Записывает запись и возвращает её смещение в потоке записей"""
+        return self.write_raw(encode_record(kind, key, value))
+
+    def write_raw(self, record: bytes) -> int:
+        """Записывает уже закодированную запись (с префиксом длины)"""
+        offset = self.offset
+        self._write(record)
+        return offset
+
+    def close(self) -> None:
+        self._write(b"\x00")
+        if self._compressor is not None:
+            self._file.write(self._compressor.flush())
+
+
+class SnapshotReader:
+    """Потоковое чтение снапшота: записи декодируются по одной по мере чтения файла"""
+
+    def __init__(self, file):
+        self._file = file
+        header = file.read(len(SNAPSHOT_MAGIC) + 2)
+        if len(header) != len(SNAPSHOT_MAGIC) + 2 or not header.startswith(SNAPSHOT_MAGIC):
+            raise SnapshotError("Not a snapshot file")
+        self.version = header[-2]
+        if self.version > SNAPSHOT_VERSION:
+            raise SnapshotError(f"Unsupported snapshot version {self.version}")
+        codes = {code: name for name, code in _COMPRESSION_CODES.items()}
+        self.compression = codes.get(header[-1])
+        if self.compression is None:
+            raise SnapshotError(f"Unknown snapshot compression code {header[-1]}")
+        self._decompressor = None
+        if self.compression == "zlib":
+            self._decompressor = zlib.decompressobj()
+        elif self.compression == "lzma":
+            self._decompressor = lzma.LZMADecompressor()
+        self._buffer = bytearray()
+        self._eof = False
+
+    def _fill(self, size: int) -> None:
+        """Дочитывает файл, пока в буфере не окажется хотя бы size байт"""
+        while len(self._buffer) < size and not self._eof:
+            chunk = self._file.read(SNAPSHOT_CHUNK_SIZE)
+            if not chunk:
+                self._eof = True
+                if self._decompressor is not None and hasattr(self._decompressor, "flush"):
+                    self._buffer += self._decompressor.flush()
+                break
+            if self._decompressor is not None:
+                chunk = self._decompressor.decompress(chunk)
+            self._buffer += chunk
+        if len(self._buffer) < size:
+            raise SnapshotError("Unexpected end of snapshot")
+
+    def _next_record(self) -> Optional[bytes]:
+        # Префикс длины - не более 10 байт
+        self._fill(1)
+        if len(self._buffer) < 10 and not self._eof:
+            try:
+                self._fill(10)
+            except SnapshotError:
+                pass
+        length, pos = _read_varint(self._buffer, 0)
+        if length == 0:
+            return None
+        self._fill(pos + length)
+        body = bytes(self._buffer[pos:pos + length])
+        del self._buffer[:pos + length]
+        return body
+
+    def __iter__(self):
+        while True:
+            try:
+                body = self._next_record()
+                if body is None:
+                    return
+                record = decode_record(body)
+            except (IndexError, UnicodeDecodeError, struct.error, zlib.error, lzma.LZMAError) as e:
+                raise SnapshotError(f"Corrupted snapshot: {e}") from e
+            yield record
+
+
+# ================== ТИПИЗИРОВАННЫЕ ЗАПИСИ ==================
+#
+# Пользователи, операции, предупреждения, напоминания и чеки - классы со __slots__.
+# Даты хранятся целыми секундами (Unix time), в снапшот записи пишутся
+# позиционными строками (to_row) без ключей. Новые поля добавляются только
+# в конец строки: from_row подставляет значения по умолчанию для старых строк.
+
+HISTORY_LIMIT = 50  # Сколько операций с пайкоинами хранить на пользователя
+
+
+def to_timestamp(value: Any) -> Optional[int]:
+    """Приводит дату (datetime, ISO-строку или число) к Unix time в секундах"""
+    if value is None or isinstance(value, int):
+        return value
+    if isinstance(value, str):
+        value = datetime.fromisoformat(value)
+    if isinstance(value, datetime):
+        return int(value.timestamp())
+    return int(value)
+
+
+def from_timestamp(value: Optional[int]) -> Optional[datetime]:
+    return None if value is None else datetime.fromtimestamp(value)
+
+
+def _iso(value: Optional[int]) -> Optional[str]:
+    return None if value is None else datetime.fromtimestamp(value).isoformat()
+
+
+class LedgerEntry:
+    """Операция с пайкоинами"""
+    __slots__ = ("date", "amount", "balance", "reason")
+
+    def __init__(self, date: int, amount: int, balance: int, reason: str = ""):
+        self.date = date
+        self.amount = amount
+        self.balance = balance
+        self.reason = sys.intern(reason)
+
+    def to_row(self) -> list:
+        return [self.date, self.amount, self.balance, self.reason]
+
+    @classmethod
+    def from_row(cls, row: list) -> "LedgerEntry":
+        return cls(*row)
+
+    def to_dict(self) -> Dict[str, Any]:
+        return {"date": _iso(self.date), "amount": self.amount, "balance": self.balance, "reason": self.reason}
+
+    @classmethod
+    def from_dict(cls, data: Dict[str, Any]) -> "LedgerEntry":
+        return cls(to_timestamp(data["date"]), data["amount"], data["balance"], data.get("reason", ""))
+
+
+class WarningEntry:
+    """Предупреждение, выданное модератором"""
+    __slots__ = ("timestamp", "reason", "moderator")
+
+    def __init__(self, timestamp: int, reason: str, moderator: str):
+        self.timestamp = timestamp
+        self.reason = reason
+        self.moderator = moderator
+
+    def to_row(self) -> list:
+        return [self.timestamp, self.reason, self.moderator]
+
+    @classmethod
+    def from_row(cls, row: list) -> "WarningEntry":
+        return cls(*row)
+
+    def to_dict(self) -> Dict[str, Any]:
+        return {"timestamp": _iso(self.timestamp), "reason": self.reason, "moderator": self.moderator}
+
+    @classmethod
+    def from_dict(cls, data: Dict[str, Any]) -> "WarningEntry":
+        return cls(to_timestamp(data["timestamp"]), data.get("reason", ""), data.get("moderator", ""))
+
+
+class ReminderEntry:
+    """Напоминание пользователя"""
+    __slots__ = ("text", "time", "created", "completed")
+
+    def __init__(self, text: str, time: int, created: int, completed: bool = False):
+        self.text = text
+        self.time = time
+        self.created = created
+        self.completed = completed
+
+    def to_row(self) -> list:
+        return [self.text, self.time, self.created, self.completed]
+
+    @classmethod
+    def from_row(cls, row: list) -> "ReminderEntry":
+        return cls(*row)
+
+    def to_dict(self) -> Dict[str, Any]:
+        return {"text": self.text, "time": _iso(self.time), "created": _iso(self.created), "completed": self.completed}
+
+    @classmethod
+    def from_dict(cls, data: Dict[str, Any]) -> "ReminderEntry":
+        return cls(data["text"], to_timestamp(data["time"]), to_timestamp(data["created"]), data.get("completed", False))
 
+
+class UserRecord:
+    """Профиль пользователя"""
+    __slots__ = (
+        "username", "messages_count", "warnings", "ban_expiry", "irisky",
+        "is_moderator", "irisky_history", "reminders", "last_ferma", "weather_cities",
+    )
+
+    def __init__(self, username: str = "", irisky: int = 0):
+        self.username = username
+        self.messages_count = 0
+        self.warnings = []
+        self.ban_expiry = None
+        self.irisky = irisky
+        self.is_moderator = False
+        self.irisky_history = []
+        self.reminders = []
+        self.last_ferma = None
+        self.weather_cities = []  # Избранные города для /weather без аргументов
+
+    def record(self, amount: int, reason: str = "") -> LedgerEntry:
+        """Меняет баланс и записывает операцию в историю"""
+        self.irisky += amount
+        entry = LedgerEntry(to_timestamp(datetime.now()), amount, self.irisky, reason)
+        self.irisky_history.append(entry)
+        if len(self.irisky_history) > HISTORY_LIMIT:
+            del self.irisky_history[:-HISTORY_LIMIT]
+        return entry
+
+    def to_row(self) -> list:
+        return [
+            self.username, self.messages_count, [w.to_row() for w in self.warnings], self.ban_expiry,
+            self.irisky, self.is_moderator, [h.to_row() for h in self.irisky_history],
+            [r.to_row() for r in self.reminders], self.last_ferma, self.weather_cities,
+        ]
+
+    @classmethod
+    def from_row(cls, row: list) -> "UserRecord":
+        user = cls(row[0], row[4])
+        user.messages_count = row[1]
+        user.warnings = [WarningEntry.from_row(w) for w in row[2]]
+        user.ban_expiry = row[3]
+        user.is_moderator = row[5]
+        user.irisky_history = [LedgerEntry.from_row(h) for h in row[6]]
+        user.reminders = [ReminderEntry.from_row(r) for r in row[7]]
+        user.last_ferma = row[8]
+        # Поля, добавленные позже, дописываются в конец строки: старые снапшоты их не содержат
+        user.weather_cities = row[9] if len(row) > 9 else []
+        return user
+
+    def to_dict(self) -> Dict[str, Any]:
+        return {
+            "username": self.username,
+            "messages_count": self.messages_count,
+            "warnings": [w.to_dict() for w in self.warnings],
+            "ban_expiry": _iso(self.ban_expiry),
+            "irisky": self.irisky,
+            "is_moderator": self.is_moderator,
+            "irisky_history": [h.to_dict() for h in self.irisky_history],
+            "reminders": [r.to_dict() for r in self.reminders],
+            "last_ferma": _iso(self.last_ferma),
+            "weather_cities": self.weather_cities,
+        }
+
+    @classmethod
+    def from_dict(cls, data: Dict[str, Any]) -> "UserRecord":
+        user = cls(data.get("username", ""), data.get("irisky", 0))
+        user.messages_count = data.get("messages_count", 0)
+        user.warnings = [WarningEntry.from_dict(w) for w in data.get("warnings", [])]
+        user.ban_expiry = to_timestamp(data.get("ban_expiry"))
+        user.is_moderator = data.get("is_moderator", False)
+        user.irisky_history = [LedgerEntry.from_dict(h) for h in data.get("irisky_history", [])]
+        user.reminders = [ReminderEntry.from_dict(r) for r in data.get("reminders", [])]
+        user.last_ferma = to_timestamp(data.get("last_ferma"))
+        user.weather_cities = data.get("weather_cities", [])
+        return user
+
+    @classmethod
+    def from_storage(cls, value: Any) -> "UserRecord":
+        """Строка из снапшота версии 2+ или словарь из JSON / снапшота версии 1"""
+        return cls.from_dict(value) if isinstance(value, dict) else cls.from_row(value)
+
+
+class CheckRecord:
+    """Чек на пайкоины"""
+    __slots__ = ("user_id", "amount", "created", "activated", "activated_by", "activated_at")
+
+    def __init__(self, user_id: str, amount: int, created: int):
+        self.user_id = user_id
+        self.amount = amount
+        self.created = created
+        self.activated = False
+        self.activated_by = None
+        self.activated_at = None
+
+    def to_row(self) -> list:
+        return [self.user_id, self.amount, self.created, self.activated, self.activated_by, self.activated_at]
+
+    @classmethod
+    def from_row(cls, row: list) -> "CheckRecord":
+        check = cls(row[0], row[1], row[2])
+        check.activated, check.activated_by, check.activated_at = row[3], row[4], row[5]
+        return check
+
+    def to_dict(self) -> Dict[str, Any]:
+        data = {"user_id": self.user_id, "amount": self.amount, "created": _iso(self.created), "activated": self.activated}
+        if self.activated_by is not None:
+            data["activated_by"] = self.activated_by
+            data["activated_at"] = _iso(self.activated_at)
+        return data
+
+    @classmethod
+    def from_dict(cls, data: Dict[str, Any]) -> "CheckRecord":
+        check = cls(data["user_id"], data["amount"], to_timestamp(data["created"]))
+        check.activated = data.get("activated", False)
+        check.activated_by = data.get("activated_by")
+        check.activated_at = to_timestamp(data.get("activated_at"))
+        return check
+
+    @classmethod
+    def from_storage(cls, value: Any) -> "CheckRecord":
+        return cls.from_dict(value) if isinstance(value, dict) else cls.from_row(value)
+
+
+# Индекс снапшота: MAGIC | заголовок | отсортированные записи (user_id, смещение, длина)
+SNAPSHOT_INDEX_MAGIC = b"PKIX"
+_INDEX_HEADER = struct.Struct("<QQQQQ")  # размер и mtime снапшота, область чеков, число записей
+_INDEX_ENTRY = struct.Struct("<qQI")
+
+
+class _IndexIds:
+    """Последовательность user_id из mmap-индекса для бинарного поиска через bisect"""
+
+    def __init__(self, store: "LazyUserStore"):
+        self._store = store
+
+    def __len__(self):
+        return self._store._count
+
+    def __getitem__(self, idx: int) -> int:
+        return self._store._entry(idx)[0]
+
+
+class LazyUserStore(MutableMapping):
+    """Пользователи в несжатом снапшоте с mmap-индексом.
+
+    Записи декодируются при первом обращении и держатся в LRU-кэше на cache_size
+    пользователей. При вытеснении запись кодируется заново и, если она изменилась,
+    сохраняется в закодированном виде до следующего flush().
+    """
+
+    def __init__(self, path: str, cache_size: int = USER_CACHE_SIZE):
+        self.path = path
+        self.index_path = path + ".idx"
+        self.cache_size = cache_size
+        self.checks = {}
+        self._hot = OrderedDict()  # user_id -> [значение, закодированная запись, изменена]
+        self._pending = {}  # user_id -> изменённая закодированная запись, ещё не записанная в файл
+        self._deleted = set()
+        self._new = set()
+        # Срез изменений, который сейчас записывается в рабочем потоке
+        self._flushing = {}
+        self._flushing_new = set()
+        self._flushing_deleted = set()
+        self._ids = _IndexIds(self)
+        self._file = self._data = self._index = None
+        self._count = 0
+        self._open()
+
+    # ---------- файлы и индекс ----------
+
+    def _open(self) -> None:
+        if not os.path.exists(self.path):
+            return
+        with open(self.path, "rb") as file:
+            compression = SnapshotReader(file).compression
+        if compression != "none":
+            self._decompress()
+
+        self._file = open(self.path, "rb")
+        self._data = mmap.mmap(self._file.fileno(), 0, access=mmap.ACCESS_READ)
+        if not self._load_index():
+            logger.info("Snapshot index is missing or stale, rebuilding")
+            self._rebuild_index()
+            self._load_index()
+
+    def _close(self) -> None:
+        for resource in (self._index, self._data, self._file):
+            if resource is not None:
+                resource.close()
+        self._file = self._data = self._index = None
+        self._count = 0
+
+    def _decompress(self) -> None:
+        """Переписывает сжатый снапшот в несжатый вид (нужно для доступа по смещению)"""
+        tmp_path = self.path + ".tmp"
+        with open(self.path, "rb") as src, open(tmp_path, "wb") as dst:
+            writer = SnapshotWriter(dst, "none")
+            for kind, key, value in SnapshotReader(src):
+                writer.write_record(kind, key, value)
+            writer.close()
+        os.replace(tmp_path, self.path)
+
+    def _load_index(self) -> bool:
+        try:
+            with open(self.index_path, "rb") as file:
+                index = mmap.mmap(file.fileno(), 0, access=mmap.ACCESS_READ)
+        except (OSError, ValueError):
+            return False
+
+        stat = os.stat(self.path)
+        prefix = len(SNAPSHOT_INDEX_MAGIC)
+        if len(index) < prefix + _INDEX_HEADER.size or index[:prefix] != SNAPSHOT_INDEX_MAGIC:
+            index.close()
+            return False
+        size, mtime_ns, checks_start, checks_end, count = _INDEX_HEADER.unpack_from(index, prefix)
+        if size != stat.st_size or mtime_ns != stat.st_mtime_ns:
+            index.close()
+            return False
+
+        self._index = index
+        self._count = count
+        self.checks = {}
+        pos = checks_start
+        while pos < checks_end:
+            length, body_pos = _read_varint(self._data, pos)
+            _, key, value = decode_record(self._data[body_pos:body_pos + length])
+            self.checks[key] = CheckRecord.from_storage(value)
+            pos = body_pos + length
+        return True
+
+    def _rebuild_index(self) -> None:
+        """Строит индекс проходом по префиксам длины, не декодируя значения пользователей"""
+        entries = []
+        checks_start = checks_end = None
+        pos = len(SNAPSHOT_MAGIC) + 2
+        while True:
+            length, body_pos = _read_varint(self._data, pos)
+            if length == 0:
+                break
+            kind = self._data[body_pos]
+            end = body_pos + length
+            if kind == RECORD_USER:
+                key, _ = _read_str(self._data, body_pos + 1)
+                try:
+                    entries.append((int(key), pos, end - pos))
+                except ValueError:
+                    logger.warning("Skipping user with non-numeric id in snapshot: %s", key)
+            elif kind == RECORD_CHECK:
+                if checks_start is None:
+                    checks_start = pos
+                checks_end = end
+            pos = end
+        entries.sort()
+        self._write_index(self.index_path, os.stat(self.path), entries, checks_start or pos, checks_end or pos)
+
+    @staticmethod
+    def _write_index(path: str, stat, entries, checks_start: int, checks_end: int) -> None:
+        with open(path, "wb") as file:
+            file.write(SNAPSHOT_INDEX_MAGIC)
+            file.write(_INDEX_HEADER.pack(stat.st_size, stat.st_mtime_ns, checks_start, checks_end, len(entries)))
+            for entry in entries:
+                file.write(_INDEX_ENTRY.pack(*entry))
+            file.flush()
+            os.fsync(file.fileno())
+
+    def _entry(self, idx: int):
+        offset = len(SNAPSHOT_INDEX_MAGIC) + _INDEX_HEADER.size + idx * _INDEX_ENTRY.size
+        return _INDEX_ENTRY.unpack_from(self._index, offset)
+
+    def _find(self, user_id: str) -> Optional[tuple]:
+        """Ищет запись пользователя в индексе бинарным поиском"""
+        if not self._count:
+            return None
+        try:
+            numeric_id = int(user_id)
+        except ValueError:
+            return None
+        idx = bisect.bisect_left(self._ids, numeric_id)
+        if idx < self._count:
+            entry = self._entry(idx)
+            if entry[0] == numeric_id:
+                return entry
+        return None
+
+    def _read_raw(self, user_id: str) -> bytes:
+        if user_id in self._deleted or user_id in self._flushing_deleted:
+            raise KeyError(user_id)
+        entry = self._find(user_id)
+        if entry is None:
+            raise KeyError(user_id)
+        _, offset, length = entry
+        return self._data[offset:offset + length]
+
+    @staticmethod
+    def _decode(raw: bytes) -> UserRecord:
+        length, pos = _read_varint(raw, 0)
+        return UserRecord.from_storage(decode_record(raw[pos:pos + length])[2])
+
+    # ---------- кэш горячих пользователей ----------
+
+    def _evict(self) -> None:
+        while len(self._hot) > self.cache_size:
+            user_id, (value, raw, dirty) = self._hot.popitem(last=False)
+            encoded = encode_record(RECORD_USER, user_id, value.to_row())
+            if dirty or encoded != raw:
+                self._pending[user_id] = encoded
+
+    def __getitem__(self, user_id: str) -> UserRecord:
+        entry = self._hot.get(user_id)
+        if entry is not None:
+            self._hot.move_to_end(user_id)
+            return entry[0]
+
+        raw = self._pending.pop(user_id, None)
+        dirty = raw is not None
+        if raw is None:
+            raw = self._flushing.get(user_id) or self._read_raw(user_id)
+        value = self._decode(raw)
+        self._hot[user_id] = [value, raw, dirty]
+        self._evict()
+        return value
+
+    def __setitem__(self, user_id: str, value: UserRecord) -> None:
+        if user_id not in self._hot and user_id not in self._pending:
+            # Удалённый в записываемом срезе пользователь не попадёт в новый индекс
+            if user_id in self._flushing_deleted or self._find(user_id) is None:
+                self._new.add(user_id)
+        self._deleted.discard(user_id)
+        self._pending.pop(user_id, None)
+        self._hot[user_id] = [value, None, True]
+        self._hot.move_to_end(user_id)
+        self._evict()
+
+    def __delitem__(self, user_id: str) -> None:
+        if user_id not in self:
+            raise KeyError(user_id)
+        self._hot.pop(user_id, None)
+        self._pending.pop(user_id, None)
+        if user_id in self._new:
+            self._new.discard(user_id)
+        else:
+            self._deleted.add(user_id)
+
+    def __contains__(self, user_id) -> bool:
+        if user_id in self._hot or user_id in self._pending or user_id in self._flushing_new:
+            return True
+        if user_id in self._deleted or user_id in self._flushing_deleted:
+            return False
+        return self._find(user_id) is not None
+
+    def __len__(self) -> int:
+        indexed = self._count - len(self._deleted - self._flushing_new) - len(self._flushing_deleted)
+        return indexed + len(self._new) + len(self._flushing_new - self._deleted)
+
+    def __iter__(self):
+        for idx in range(self._count):
+            user_id = str(self._entry(idx)[0])
+            if user_id not in self._deleted and user_id not in self._flushing_deleted:
+                yield user_id
+        yield from list(self._new)
+        yield from [user_id for user_id in self._flushing_new if user_id not in self._deleted]
+
+    def scan(self):
+        """Просмотр всех пользователей только для чтения, без заполнения кэша"""
+        for user_id in self:
+            entry = self._hot.get(user_id)
+            if entry is not None:
+                yield user_id, entry[0]
+            elif user_id in self._pending:
+                yield user_id, self._decode(self._pending[user_id])
+            else:
+                yield user_id, self._decode(self._flushing.get(user_id) or self._read_raw(user_id))
+
+    @property
+    def resident(self) -> int:
+        return len(self._hot)
+
+    # ---------- запись изменений ----------
+
+    def prepare_flush(self, checks: Dict[str, CheckRecord]):
+        """Фиксирует согласованный срез изменений и возвращает функцию записи для рабочего потока.
+
+        Неизменённые записи копируются из mmap без декодирования. Пока запись идёт,
+        старый снапшот остаётся открытым, а срез изменений доступен через _flushing.
+        """
+        for user_id, entry in self._hot.items():
+            encoded = encode_record(RECORD_USER, user_id, entry[0].to_row())
+            if entry[2] or encoded != entry[1]:
+                self._pending[user_id] = encoded
+            entry[1], entry[2] = encoded, False
+
+        pending, deleted, new = self._pending, self._deleted, self._new
+        self._pending, self._deleted, self._new = {}, set(), set()
+        self._flushing, self._flushing_new, self._flushing_deleted = pending, new, deleted
+        check_rows = [(check_code, check.to_row()) for check_code, check in checks.items()]
+        count = self._count
+
+        def write() -> None:
+            entries = []
+            with open(self.path + ".tmp", "wb") as file:
+                writer = SnapshotWriter(file, "none")
+                base = len(SNAPSHOT_MAGIC) + 2
+                for idx in range(count):
+                    numeric_id, offset, length = self._entry(idx)
+                    user_id = str(numeric_id)
+                    if user_id in deleted:
+                        continue
+                    raw = pending.get(user_id) or self._data[offset:offset + length]
+                    entries.append((numeric_id, base + writer.write_raw(raw), len(raw)))
+                for user_id in sorted(new, key=int):
+                    raw = pending[user_id]
+                    entries.append((int(user_id), base + writer.write_raw(raw), len(raw)))
+                checks_start = base + writer.offset
+                for check_code, row in check_rows:
+                    writer.write_record(RECORD_CHECK, check_code, row)
+                checks_end = base + writer.offset
+                writer.close()
+                file.flush()
+                os.fsync(file.fileno())
+
+            entries.sort()
+            self._write_index(self.index_path + ".tmp", os.stat(self.path + ".tmp"), entries, checks_start, checks_end)
+            # Открытый mmap не мешает подмене файла везде, кроме Windows
+            if os.name != "nt":
+                _replace_durably(self.path + ".tmp", self.path)
+                _replace_durably(self.index_path + ".tmp", self.index_path)
+
+        return write
+
+    def _remap(self) -> None:
+        """Отображает в память только что записанные снапшот и индекс без их проверки и разбора"""
+        self._file = open(self.path, "rb")
+        self._data = mmap.mmap(self._file.fileno(), 0, access=mmap.ACCESS_READ)
+        with open(self.index_path, "rb") as file:
+            self._index = mmap.mmap(file.fileno(), 0, access=mmap.ACCESS_READ)
+        self._count = _INDEX_HEADER.unpack_from(self._index, len(SNAPSHOT_INDEX_MAGIC))[4]
+
+    def commit_flush(self) -> None:
+        """Переключается на записанные снапшот и индекс (в потоке цикла событий)"""
+        self._close()
+        if os.name == "nt":
+            _replace_durably(self.path + ".tmp", self.path)
+            _replace_durably(self.index_path + ".tmp", self.index_path)
+        self._flushing, self._flushing_new, self._flushing_deleted = {}, set(), set()
+        self._remap()
+        # Пользователи, созданные во время записи, уже могли попасть в новый индекс
+        self._new = {user_id for user_id in self._new if self._find(user_id) is None}
+
+    def abort_flush(self) -> None:
+        """Возвращает срез изменений после неудачной записи"""
+        for user_id, raw in self._flushing.items():
+            self._pending.setdefault(user_id, raw)
+        # Созданные заново во время записи пользователи остаются в старом индексе - это обычное обновление
+        self._new -= self._flushing_deleted
+        for user_id in self._flushing_deleted:
+            if user_id not in self._hot and user_id not in self._pending:
+                self._deleted.add(user_id)
+        self._new |= self._flushing_new - self._deleted
+        self._deleted -= self._flushing_new
+        self._flushing, self._flushing_new, self._flushing_deleted = {}, set(), set()
+
+    def flush(self, checks: Dict[str, CheckRecord]) -> None:
+        """Синхронная запись всех изменений"""
+        write = self.prepare_flush(checks)
+        try:
+            write()
+        except Exception:
+            self.abort_flush()
+            raise
+        self.commit_flush()
+
+
+def scan_users():
+    """Все пользователи для чтения; в режиме "lazy" записи не оседают в кэше"""
+    if isinstance(users, LazyUserStore):
+        return users.scan()
+    return iter(list(users.items()))
+
+
+def _load_json(path: str) -> Dict[str, Any]:
     try:
-        with open(CHECKS_FILE, "r") as file:
-            checks = json.load(file)
+        with open(path, "r") as file:
+            return json.load(file)
     except (FileNotFoundError, json.JSONDecodeError):
-        checks = {}
+        return {}
+
+
+# Загрузка данных
+def load_data():
+    global users, checks
+    if STORAGE_MODE == "lazy":
+        try:
+            users = LazyUserStore(SNAPSHOT_FILE, USER_CACHE_SIZE)
+            checks = users.checks
+            if not os.path.exists(SNAPSHOT_FILE):
+                import_json()
+            return
+        except (OSError, SnapshotError) as e:
+            logger.error("Lazy snapshot open error, falling back to JSON: %s", e)
+
+    users, checks = {}, {}
+    if os.path.exists(SNAPSHOT_FILE):
+        try:
+            with open(SNAPSHOT_FILE, "rb") as file:
+                for kind, key, value in SnapshotReader(file):
+                    if kind == RECORD_USER:
+                        users[key] = UserRecord.from_storage(value)
+                    elif kind == RECORD_CHECK:
+                        checks[key] = CheckRecord.from_storage(value)
+            return
+        except (OSError, SnapshotError) as e:
+            logger.error("Snapshot load error, falling back to JSON: %s", e)
+            users, checks = {}, {}
+
+    # Снапшота ещё нет - импортируем данные из JSON
+    import_json()
+
+
+def _replace_durably(tmp_path: str, path: str) -> None:
+    """Атомарно подменяет файл и сбрасывает на диск запись каталога"""
+    os.replace(tmp_path, path)
+    if os.name != "nt":
+        fd = os.open(os.path.dirname(os.path.abspath(path)), os.O_RDONLY)
+        try:
+            os.fsync(fd)
+        finally:
+            os.close(fd)
+
+
+def prepare_snapshot():
+    """Снимает согласованную копию данных.
+
+    Возвращает (write, commit, abort): write выполняется в рабочем потоке,
+    commit и abort - в потоке цикла событий после успешной или неудачной записи.
+    """
+    if isinstance(users, LazyUserStore):
+        return users.prepare_flush(checks), users.commit_flush, users.abort_flush
+
+    records = [encode_record(RECORD_USER, user_id, user.to_row()) for user_id, user in users.items()]
+    records += [encode_record(RECORD_CHECK, check_code, check.to_row()) for check_code, check in checks.items()]
+
+    def write() -> None:
+        tmp_path = SNAPSHOT_FILE + ".tmp"
+        with open(tmp_path, "wb") as file:
+            writer = SnapshotWriter(file, SNAPSHOT_COMPRESSION)
+            for record in records:
+                writer.write_raw(record)
+            writer.close()
+            file.flush()
+            os.fsync(file.fileno())
+        _replace_durably(tmp_path, SNAPSHOT_FILE)
+
+    return write, None, None
+
+
+def save_data_now() -> None:
+    """Синхронная запись данных на диск"""
+    if isinstance(users, LazyUserStore):
+        users.flush(checks)
+        return
+    write, _, _ = prepare_snapshot()
+    write()
 
 
 def save_data():
-    with open(DATA_FILE, "w") as file:
-        json.dump(users, file, ensure_ascii=False, indent=4)
+    """Отмечает данные изменёнными: запись выполнит PERSISTENCE, сгруппировав изменения"""
+    PERSISTENCE.mark_dirty()
+
+
+# Класс для отложенной групповой записи данных
+class PersistenceManager:
+    def __init__(self, delay: float = SAVE_DELAY, max_delay: float = SAVE_MAX_DELAY):
+        self.delay = delay
+        self.max_delay = max_delay
+        self._dirty_since = None
+        self._last_mark = 0.0
+        self._task = None
+        self._lock = None
+        self._sleeping = False  # Фоновая задача ждёт окна группировки, а не пишет
+        self._closing = False
+        self.retry_delay = 0.0  # Пауза перед повтором после неудачной записи, растёт до max_delay
+        self._retry_at = 0.0
+        self.last_error = None
+        self.marks = 0
+        self.flushes = 0
+        self.failures = 0
+        self.last_latency = 0.0
+        self.max_latency = 0.0
+        self.total_latency = 0.0
+
+    def mark_dirty(self) -> None:
+        self.marks += 1
+        now = time.monotonic()
+        self._last_mark = now
+        if self._dirty_since is None:
+            self._dirty_since = now
+
+        try:
+            loop = asyncio.get_running_loop()
+        except RuntimeError:
+            # Вне цикла событий (консольные команды) пишем сразу
+            self._dirty_since = None
+            save_data_now()
+            return
+
+        # После close() оставшиеся изменения записывает её последний flush()
+        if not self._closing and (self._task is None or self._task.done()):
+            self._task = loop.create_task(self._flush_later())
+
+    async def _flush_later(self) -> None:
+        while self._dirty_since is not None and not self._closing:
+            deadline = min(self._last_mark + self.delay, self._dirty_since + self.max_delay)
+            deadline = max(deadline, self._retry_at)
+            wait = deadline - time.monotonic()
+            if wait > 0:
+                self._sleeping = True
+                try:
+                    await asyncio.sleep(wait)
+                finally:
+                    self._sleeping = False
+                continue
+            await self.flush()
+
+    async def flush(self) -> None:
+        """Записывает накопленные изменения: снимок - в цикле событий, файл - в рабочем потоке"""
+        if self._lock is None:
+            self._lock = asyncio.Lock()
+        async with self._lock:
+            if self._dirty_since is None:
+                return
+            self._dirty_since = None
+            started = time.perf_counter()
+            write, commit, abort = prepare_snapshot()
+            try:
+                await asyncio.to_thread(write)
+            except Exception as e:
+                self.failures += 1
+                self.last_error = str(e)
+                if abort:
+                    abort()
+                # Повтор не раньше чем через retry_delay: полный или read-only диск не должен
+                # превращаться в непрерывный цикл снимков и записей в лог
+                self.retry_delay = min(max(self.retry_delay * 2, self.delay), self.max_delay)
+                now = time.monotonic()
+                self._retry_at = now + self.retry_delay
+                if self._dirty_since is None:
+                    self._dirty_since = now
+                logger.error("Error saving data, retrying in %.1fs: %s", self.retry_delay, e)
+                return
+            if commit:
+                commit()
+            self.retry_delay = 0.0
+            self.last_error = None
+
+            latency = time.perf_counter() - started
+            self.flushes += 1
+            self.last_latency = latency
+            self.max_latency = max(self.max_latency, latency)
+            self.total_latency += latency
+
+    async def close(self) -> None:
+        """Дожидается фоновой записи и сбрасывает оставшиеся изменения.
+
+        Фоновая задача отменяется, только пока она ждёт; начатая запись доводится
+        до commit или abort, иначе второй писатель столкнулся бы с ней на том же .tmp.
+        """
+        self._closing = True
+        task = self._task
+        if task is not None and not task.done():
+            if self._sleeping:
+                task.cancel()
+            try:
+                await task
+            except asyncio.CancelledError:
+                pass
+        await self.flush()
+
+    def stats(self) -> Dict[str, Any]:
+        return {
+            "marks": self.marks,
+            "flushes": self.flushes,
+            "failures": self.failures,
+            "retry_delay": self.retry_delay,
+            "last_error": self.last_error,
+            "last_latency": self.last_latency,
+            "max_latency": self.max_latency,
+            "avg_latency": self.total_latency / self.flushes if self.flushes else 0.0,
+            "dirty_for": time.monotonic() - self._dirty_since if self._dirty_since is not None else 0.0,
+        }
+
+
+PERSISTENCE = PersistenceManager()
+
+
+def import_json(users_path: str = DATA_FILE, checks_path: str = CHECKS_FILE) -> None:
+    """Импорт данных из JSON-файлов старого формата"""
+    global users, checks
+    imported = {uid: UserRecord.from_dict(data) for uid, data in _load_json(users_path).items()}
+    checks = {code: CheckRecord.from_dict(data) for code, data in _load_json(checks_path).items()}
+    if isinstance(users, LazyUserStore):
+        for user_id in list(users):
+            del users[user_id]
+        users.update(imported)
+        save_data_now()
+    else:
+        users = imported
 
-    with open(CHECKS_FILE, "w") as file:
-        json.dump(checks, file, ensure_ascii=False, indent=4)
+
+def export_json(users_path: str = DATA_FILE, checks_path: str = CHECKS_FILE) -> None:
+    """Экспорт данных в JSON (json.dump пишет файл по частям)"""
+    with open(users_path, "w") as file:
+        json.dump({uid: user.to_dict() for uid, user in scan_users()}, file, ensure_ascii=False, indent=4)
+
+    with open(checks_path, "w") as file:
+        json.dump({code: check.to_dict() for code, check in checks.items()}, file, ensure_ascii=False, indent=4)
 
 
 # Загружаем данные при старте
 load_data()
 
 
+# Класс для временных состояний пользователей с автоматическим истечением
+class SessionStore:
+    """Состояния с TTL и ограничением размера (LRU).
+
+    Истёкшие записи удаляются при обращении, а также колесом таймеров: каждая
+    запись попадает в корзину своей секунды истечения, и sweep() разбирает
+    только наступившие корзины - амортизированно O(1) на запись.
+    """
+
+    def __init__(self, max_size: int = SESSION_MAX_SIZE, default_ttl: float = SESSION_TTL, resolution: float = 1.0):
+        self.max_size = max_size
+        self.default_ttl = default_ttl
+        self.resolution = resolution
+        self._data = OrderedDict()  # ключ -> (значение, время истечения)
+        self._wheel = defaultdict(set)  # корзина -> ключи
+        self._cursor = self._bucket(time.monotonic())
+        self.evictions = 0
+        self.expirations = 0
+
+    def _bucket(self, moment: float) -> int:
+        return int(moment // self.resolution)
+
+    def _remove(self, key) -> None:
+        _, expires_at = self._data.pop(key)
+        bucket = self._wheel.get(self._bucket(expires_at))
+        if bucket is not None:
+            bucket.discard(key)
+
+    def sweep(self) -> None:
+        """Удаляет записи из наступивших корзин колеса"""
+        now = time.monotonic()
+        current = self._bucket(now)
+        if current <= self._cursor:
+            return
+        if current - self._cursor > len(self._wheel):
+            due = [bucket for bucket in self._wheel if bucket < current]
+        else:
+            due = range(self._cursor, current)
+        for bucket in due:
+            for key in self._wheel.pop(bucket, ()):
+                entry = self._data.get(key)
+                if entry is not None and entry[1] <= now:
+                    del self._data[key]
+                    self.expirations += 1
+        self._cursor = current
+
+    def set(self, key, value, ttl: Optional[float] = None) -> None:
+        self.sweep()
+        if key in self._data:
+            self._remove(key)
+        expires_at = time.monotonic() + (self.default_ttl if ttl is None else ttl)
+        self._data[key] = (value, expires_at)
+        self._wheel[self._bucket(expires_at)].add(key)
+        while len(self._data) > self.max_size:
+            self._remove(next(iter(self._data)))
+            self.evictions += 1
+
+    def get(self, key, default=None):
+        entry = self._data.get(key)
+        if entry is None:
+            return default
+        if entry[1] <= time.monotonic():
+            self._remove(key)
+            self.expirations += 1
+            return default
+        self._data.move_to_end(key)
+        return entry[0]
+
+    def pop(self, key, default=None):
+        value = self.get(key, default)
+        if key in self._data:
+            self._remove(key)
+        return value
+
+    def __contains__(self, key) -> bool:
+        return self.get(key, self) is not self
+
+    def __len__(self) -> int:
+        return len(self._data)
+
+    def stats(self) -> Dict[str, int]:
+        return {"size": len(self._data), "evictions": self.evictions, "expirations": self.expirations}
+
+
+# Класс для кэша ответов внешних API: после срока свежести запись ещё stale_ttl секунд отдаётся сразу
+class StaleCache:
+    """SessionStore, в котором запись живёт ttl + stale_ttl секунд.
+
+    Устаревшая запись возвращается как есть, а revalidate() - корутина,
+    обновляющая её в обход кэша, - запускается в фоне не больше одного раза
+    на ключ одновременно. Так при разомкнутом автомате защиты API недавние
+    запросы продолжают обслуживаться.
+    """
+
+    def __init__(self, max_size: int, ttl: float, stale_ttl: float):
+        self.ttl = ttl
+        self._store = SessionStore(max_size=max_size, default_ttl=ttl + stale_ttl)
+        self._revalidating = set()
+        self._tasks = set()
+        self.stale_hits = 0
+
+    def get(self, key, revalidate=None):
+        """Свежее или устаревшее значение (или None); для устаревшего запускает revalidate()"""
+        entry = self._store.get(key)
+        if entry is None:
+            return None
+        value, fresh_until = entry
+        if time.monotonic() < fresh_until:
+            return value
+        self.stale_hits += 1
+        if revalidate is not None and key not in self._revalidating:
+            self._revalidating.add(key)
+            task = asyncio.create_task(revalidate())
+            self._tasks.add(task)
+
+            def done(task) -> None:
+                self._tasks.discard(task)
+                self._revalidating.discard(key)
+            task.add_done_callback(done)
+        return value
+
+    def set(self, key, value) -> None:
+        self._store.set(key, (value, time.monotonic() + self.ttl))
+
+    def __len__(self) -> int:
+        return len(self._store)
+
+    def stats(self) -> Dict[str, int]:
+        return {**self._store.stats(), "stale_hits": self.stale_hits}
+
+
+USER_STATES = SessionStore()  # Для хранения состояний пользователей
+
+
+# Класс для кнопок клавиатуры: один обработчик с поиском по словарю вместо цепочки фильтров F.text
+class ButtonRouter:
+    def __init__(self):
+        self._handlers = {}  # нормализованный текст кнопки -> обработчик
+        self._max_length = 0  # Текст вдвое длиннее самой длинной кнопки не нормализуется
+        self.routed = 0
+
+    @staticmethod
+    def normalize(text: str) -> str:
+        """Регистр, пробелы по краям и селектор варианта эмодзи (U+FE0F) не влияют на совпадение"""
+        return text.strip().lower().replace("\ufe0f", "")
+
+    def button(self, text: str):
+        """Декоратор: регистрирует обработчик кнопки с текстом text"""
+        def decorator(handler):
+            self._handlers[self.normalize(text)] = handler
+            self._max_length = max(self._max_length, len(text))
+            return handler
+        return decorator
+
+    def match(self, message: types.Message):
+        """Фильтр aiogram: текст нормализуется один раз, обработчик находится по хэшу"""
+        if not message.text or len(message.text) > 2 * self._max_length:
+            return False
+        handler = self._handlers.get(self.normalize(message.text))
+        return {"button_handler": handler} if handler else False
+
+    async def dispatch(self, message: types.Message, button_handler) -> None:
+        self.routed += 1
+        await button_handler(message)
+
+    def register(self, dispatcher: Dispatcher) -> None:
+        """Регистрирует роутер раньше остальных обработчиков сообщений"""
+        dispatcher.message.register(self.dispatch, self.match)
+
+    def __len__(self) -> int:
+        return len(self._handlers)
+
+
+BUTTONS = ButtonRouter()
+BUTTONS.register(dp)
+
+
+# Класс для контекста логов: id апдейта, пользователя и чата, имя обработчика через contextvars
+class LogContextMiddleware(BaseMiddleware):
+    """Внешний слой на update задаёт id, внутренний на сообщениях и callback - имя обработчика.
+
+    Задачи, созданные внутри обработчика, получают копию контекста.
+    """
+
+    async def __call__(self, handler, event, data):
+        context = dict(LOG_CONTEXT.get())
+        if isinstance(event, types.Update):
+            user, chat = data.get("event_from_user"), data.get("event_chat")
+            context.update(
+                update_id=event.update_id,
+                user_id=user.id if user else None,
+                chat_id=chat.id if chat else None,
+            )
+        else:
+            callback = data.get("button_handler") or data["handler"].callback
+            context["handler"] = getattr(callback, "__name__", None)
+        token = LOG_CONTEXT.set(context)
+        try:
+            return await handler(event, data)
+        finally:
+            LOG_CONTEXT.reset(token)
+
+
+LOG_CONTEXT_MIDDLEWARE = LogContextMiddleware()
+dp.update.outer_middleware(LOG_CONTEXT_MIDDLEWARE)
+dp.message.middleware(LOG_CONTEXT_MIDDLEWARE)
+dp.callback_query.middleware(LOG_CONTEXT_MIDDLEWARE)
+
+
+# Класс для ограничения частоты дорогих запросов: корзины токенов с истечением через SessionStore
+class ThrottlingMiddleware(BaseMiddleware):
+    """Списывает стоимость обработчика из корзин пользователя и чата.
+
+    Корзина хранит (токены, время) и живёт в SessionStore ровно столько,
+    сколько нужно для полного восстановления - после этого она ничем не
+    отличается от отсутствующей, так что память расходуется только на активных
+    пользователей. Отметка о предупреждении хранится отдельно с фиксированным
+    сроком notice_cooldown, независимо от того, какая корзина исчерпана.
+    """
+
+    def __init__(self, costs: Dict[str, float] = THROTTLE_COSTS,
+                 user_bucket: tuple = THROTTLE_USER_BUCKET, chat_bucket: tuple = THROTTLE_CHAT_BUCKET,
+                 notice_cooldown: float = THROTTLE_NOTICE_COOLDOWN):
+        self.costs = costs
+        self.user_bucket = user_bucket
+        self.chat_bucket = chat_bucket
+        self.notice_cooldown = notice_cooldown
+        self._buckets = SessionStore()
+        self.passed = 0
+        self.throttled = defaultdict(int)  # имя обработчика -> отклонённых запросов
+
+    def _level(self, key, bucket: tuple, now: float) -> float:
+        capacity, rate = bucket
+        state = self._buckets.get(key)
+        if state is None:
+            return capacity
+        return min(capacity, state[0] + (now - state[1]) * rate)
+
+    def _spend(self, key, bucket: tuple, tokens: float, now: float) -> None:
+        capacity, rate = bucket
+        self._buckets.set(key, (tokens, now), ttl=(capacity - tokens) / rate + 1)
+
+    async def __call__(self, handler, event, data):
+        callback = data.get("button_handler") or data["handler"].callback
+        name = getattr(callback, "__name__", "")
+        cost = self.costs.get(name, 0)
+        user = data.get("event_from_user")
+        if cost <= 0 or user is None:
+            return await handler(event, data)
+
+        now = time.monotonic()
+        scopes = [(("user", user.id), self.user_bucket)]
+        chat = data.get("event_chat")
+        if chat is not None and chat.type != "private":
+            scopes.append((("chat", chat.id), self.chat_bucket))
+        levels = [self._level(key, bucket, now) for key, bucket in scopes]
+
+        if all(level >= cost for level in levels):
+            for (key, bucket), level in zip(scopes, levels):
+                self._spend(key, bucket, level - cost, now)
+            self.passed += 1
+            return await handler(event, data)
+
+        self.throttled[name] += 1
+        # Уведомляем не чаще раза в notice_cooldown - ответ на спам ничего не стоит
+        notice_key = ("notice", user.id)
+        if self._buckets.get(notice_key) is not None:
+            return None
+        self._buckets.set(notice_key, True, ttl=self.notice_cooldown)
+        wait = max((cost - level) / bucket[1] for (_, bucket), level in zip(scopes, levels) if level < cost)
+        # У сообщения - ответ в чат, у callback - всплывающее уведомление
+        await event.answer(f"⏳ Слишком много запросов. Попробуйте через {int(wait) + 1} с.")
+        return None
+
+    def stats(self) -> Dict[str, Any]:
+        return {
+            "passed": self.passed,
+            "throttled": sum(self.throttled.values()),
+            "by_handler": dict(self.throttled),
+            "buckets": len(self._buckets),
+        }
+
+
+THROTTLING = ThrottlingMiddleware()
+dp.message.middleware(THROTTLING)
+dp.callback_query.middleware(THROTTLING)
+
+
+# Класс для индекса активных банов: проверка за O(1), истёкшие баны снимаются по куче без обхода users
+class BanIndex:
+    def __init__(self):
+        self._active = {}  # user_id -> ban_expiry
+        self._heap = []  # (ban_expiry, user_id); записи, не совпадающие с _active, устарели и пропускаются
+        self.ready = False
+        self.rejected = 0
+        self.lifted = 0
+
+    def set(self, user_id: int, expiry: Optional[int]) -> None:
+        """Синхронизирует индекс с ban_expiry пользователя"""
+        if expiry is None or expiry <= time.time():
+            self._active.pop(user_id, None)
+            return
+        self._active[user_id] = expiry
+        heapq.heappush(self._heap, (expiry, user_id))
+
+    def _expire(self, now: float) -> None:
+        heap = self._heap
+        while heap and heap[0][0] <= now:
+            expiry, user_id = heapq.heappop(heap)
+            if self._active.get(user_id) == expiry:
+                del self._active[user_id]
+                self.lifted += 1
+
+    def expiry(self, user_id: int) -> Optional[int]:
+        """Время окончания активного бана или None"""
+        expiry = self._active.get(user_id)
+        if expiry is None:
+            return None
+        if expiry <= time.time():
+            self._expire(time.time())
+            return None
+        return expiry
+
+    async def rebuild(self) -> None:
+        """Собирает индекс одним проходом по пользователям, уступая цикл событий"""
+        now = time.time()
+        for count, (user_id, user) in enumerate(scan_users(), 1):
+            if user.ban_expiry and user.ban_expiry > now:
+                self.set(int(user_id), user.ban_expiry)
+            if count % 10000 == 0:
+                await asyncio.sleep(0)
+        self.ready = True
+        logger.info("Ban index built: %s active bans", len(self._active))
+
+    def __len__(self) -> int:
+        self._expire(time.time())
+        return len(self._active)
+
+
+BANS = BanIndex()
+
+
+# Класс для отклонения апдейтов от заблокированных пользователей до фильтров и обработчиков
+class BanMiddleware(BaseMiddleware):
+    def __init__(self, index: BanIndex = BANS):
+        self.index = index
+        self._notified = SessionStore(default_ttl=600)  # Кому уже сообщили о бане
+
+    async def __call__(self, handler, event, data):
+        user = data.get("event_from_user")
+        if user is None:
+            return await handler(event, data)
+        expiry = self.index.expiry(user.id)
+        if expiry is None:
+            return await handler(event, data)
+
+        self.index.rejected += 1
+        # Сообщаем о бане не чаще раза в 10 минут: сообщения - только в личке,
+        # на нажатие кнопки отвечаем всегда, иначе у пользователя висит индикатор загрузки
+        message = event.message if isinstance(event, types.Update) else None
+        callback = event.callback_query if isinstance(event, types.Update) else None
+        notify = user.id not in self._notified
+        text = f"🚫 Вы заблокированы до {from_timestamp(expiry).strftime('%Y-%m-%d %H:%M')}."
+        try:
+            if callback is not None:
+                if notify:
+                    self._notified.set(user.id, True)
+                await callback.answer(text if notify else None, show_alert=False)
+            elif message and message.chat.type == "private" and notify:
+                self._notified.set(user.id, True)
+                await message.answer(text)
+        except TelegramAPIError as e:
+            # Например, пользователь заблокировал бота - это не повод для обработчика ошибок
+            logger.info("Ban notice to %s failed: %s", user.id, e)
+        return None
+
+
+dp.update.outer_middleware(BanMiddleware())
+
+
+# Класс для кэша участников чатов: недавно активные участники без запросов к API на каждую команду
+class ChatMemberCache:
+    """Участники чатов, известные по сообщениям и апдейтам chat_member.
+
+    На чат хранится не больше CHAT_MEMBERS_LIMIT участников в порядке последней
+    активности, самые давние вытесняются; чаты сверх CHAT_MEMBERS_MAX_CHATS
+    вытесняются так же. Администраторы подмешиваются через
+    get_chat_administrators не чаще раза в CHAT_ADMINS_TTL секунд или после
+    изменения прав в чате.
+    """
+
+    def __init__(self, limit: int = CHAT_MEMBERS_LIMIT, max_chats: int = CHAT_MEMBERS_MAX_CHATS,
+                 admins_ttl: float = CHAT_ADMINS_TTL):
+        self.limit = limit
+        self.max_chats = max_chats
+        self.admins_ttl = admins_ttl
+        self._chats = OrderedDict()  # chat_id -> OrderedDict(user_id -> имя)
+        self._admins_at = {}  # chat_id -> время последнего запроса администраторов
+        self.hits = 0
+        self.refreshes = 0
+        self.evictions = 0
+
+    def seen(self, chat_id: int, user: types.User) -> None:
+        """Отмечает активность участника"""
+        if user.is_bot:
+            return
+        members = self._chats.get(chat_id)
+        if members is None:
+            members = self._chats[chat_id] = OrderedDict()
+            while len(self._chats) > self.max_chats:
+                evicted, _ = self._chats.popitem(last=False)
+                self._admins_at.pop(evicted, None)
+        else:
+            self._chats.move_to_end(chat_id)
+        members[user.id] = user.first_name
+        members.move_to_end(user.id)
+        while len(members) > self.limit:
+            members.popitem(last=False)
+            self.evictions += 1
+
+    def remove(self, chat_id: int, user_id: int) -> None:
+        members = self._chats.get(chat_id)
+        if members is not None:
+            members.pop(user_id, None)
+
+    def forget(self, chat_id: int) -> None:
+        """Удаляет чат целиком (бот покинул чат)"""
+        self._chats.pop(chat_id, None)
+        self._admins_at.pop(chat_id, None)
+
+    def invalidate_admins(self, chat_id: int) -> None:
+        self._admins_at.pop(chat_id, None)
+
+    async def members(self, chat_id: int) -> Dict[int, str]:
+        """Недавно активные участники и администраторы чата: user_id -> имя"""
+        refreshed_at = self._admins_at.get(chat_id)
+        if refreshed_at is not None and time.monotonic() - refreshed_at < self.admins_ttl:
+            self.hits += 1
+            return dict(self._chats.get(chat_id, ()))
+
+        self.refreshes += 1
+        try:
+            admins = await bot.get_chat_administrators(chat_id)
+        except TelegramBadRequest as e:
+            logger.error("Не удалось получить администраторов чата %s: %s", chat_id, e)
+            admins = []
+        for admin in admins:
+            members = self._chats.get(chat_id)
+            if members is None:
+                self.seen(chat_id, admin.user)
+            # Администраторы не вытесняют активных участников: встают в начало очереди, пока есть место
+            elif not admin.user.is_bot and admin.user.id not in members and len(members) < self.limit:
+                members[admin.user.id] = admin.user.first_name
+                members.move_to_end(admin.user.id, last=False)
+        self._admins_at[chat_id] = time.monotonic()
+        return dict(self._chats.get(chat_id, ()))
+
+    def stats(self) -> Dict[str, int]:
+        return {
+            "chats": len(self._chats),
+            "members": sum(len(members) for members in self._chats.values()),
+            "hits": self.hits,
+            "refreshes": self.refreshes,
+            "evictions": self.evictions,
+        }
+
+
+CHAT_MEMBERS = ChatMemberCache()
+
+
+# Класс для раздела статистики одного чата: участники, счётчик сообщений и таблица лидеров
+class ChatPartition:
+    __slots__ = ("messages", "counts", "top")
+
+    def __init__(self, messages: int = 0, counts: Optional[Dict[int, int]] = None):
+        self.messages = messages
+        self.counts = counts or {}  # user_id -> сообщений в чате; ключи - участники раздела
+        self.top = sorted(self.counts, key=self.counts.__getitem__, reverse=True)[:CHAT_STATS_TOP]
+
+    def record(self, user_id: int) -> None:
+        """Учитывает сообщение; счётчики только растут, поэтому в лидеры можно попасть, лишь обогнав последнего"""
+        counts = self.counts
+        count = counts[user_id] = counts.get(user_id, 0) + 1
+        self.messages += 1
+        top = self.top
+        if user_id in top:
+            top.sort(key=counts.__getitem__, reverse=True)
+        elif len(top) < CHAT_STATS_TOP:
+            top.append(user_id)
+            top.sort(key=counts.__getitem__, reverse=True)
+        elif count > counts[top[-1]]:
+            top[-1] = user_id
+            top.sort(key=counts.__getitem__, reverse=True)
+
+    def remove(self, user_id: int) -> None:
+        if self.counts.pop(user_id, None) is not None and user_id in self.top:
+            self.top = sorted(self.counts, key=self.counts.__getitem__, reverse=True)[:CHAT_STATS_TOP]
+
+    def to_row(self) -> list:
+        return [self.messages, [[user_id, count] for user_id, count in self.counts.items()]]
+
+    @classmethod
+    def from_row(cls, row: list) -> "ChatPartition":
+        return cls(row[0], {user_id: count for user_id, count in row[1]})
+
+
+# Класс для статистики, разделённой по чатам: /statistics в группе работает за размер этого чата
+class ChatStats:
+    """Разделы статистики по чатам и общий раздел GLOBAL для модераторов.
+
+    Разделы обновляются по каждому сообщению за O(1) и раз в
+    CHAT_STATS_SAVE_INTERVAL секунд записываются в отдельный файл записями
+    RECORD_CHAT, не затрагивая снапшот пользователей.
+    """
+
+    GLOBAL = 0
+
+    def __init__(self, path: str = CHAT_STATS_FILE):
+        self.path = path
+        self._partitions = {}  # chat_id -> ChatPartition
+        self.dirty = False
+        self.saves = 0
+
+    def partition(self, chat_id: int) -> ChatPartition:
+        partition = self._partitions.get(chat_id)
+        if partition is None:
+            partition = self._partitions[chat_id] = ChatPartition()
+        return partition
+
+    def record(self, chat_id: int, user_id: int) -> None:
+        self.partition(chat_id).record(user_id)
+        self.partition(self.GLOBAL).record(user_id)
+        self.dirty = True
+
+    def remove(self, chat_id: int, user_id: int) -> None:
+        """Участник покинул чат: убираем его из раздела чата, общий счётчик сохраняется"""
+        partition = self._partitions.get(chat_id)
+        if partition is not None:
+            partition.remove(user_id)
+            self.dirty = True
+
+    def forget(self, chat_id: int) -> None:
+        if self._partitions.pop(chat_id, None) is not None:
+            self.dirty = True
+
+    def load(self) -> None:
+        try:
+            with open(self.path, "rb") as file:
+                for kind, key, value in SnapshotReader(file):
+                    if kind == RECORD_CHAT:
+                        self._partitions[int(key)] = ChatPartition.from_row(value)
+        except FileNotFoundError:
+            return
+        except (OSError, SnapshotError, ValueError) as e:
+            logger.error("Chat stats load error: %s", e)
+            return
+        logger.info("Chat stats loaded: %s partitions", len(self._partitions))
+
+    def prepare_save(self):
+        """Снимает строки разделов в цикле событий и возвращает функцию записи для рабочего потока"""
+        rows = [(str(chat_id), partition.to_row()) for chat_id, partition in self._partitions.items()]
+        self.dirty = False
+
+        def write() -> None:
+            with open(self.path + ".tmp", "wb") as file:
+                writer = SnapshotWriter(file, SNAPSHOT_COMPRESSION)
+                for key, row in rows:
+                    writer.write_record(RECORD_CHAT, key, row)
+                writer.close()
+                file.flush()
+                os.fsync(file.fileno())
+            _replace_durably(self.path + ".tmp", self.path)
+
+        return write
+
+    async def save(self) -> None:
+        if not self.dirty:
+            return
+        try:
+            await asyncio.to_thread(self.prepare_save())
+            self.saves += 1
+        except Exception as e:
+            self.dirty = True
+            logger.error("Ошибка записи статистики чатов: %s", e)
+
+    def stats(self) -> Dict[str, int]:
+        return {
+            "chats": len(self._partitions) - (self.GLOBAL in self._partitions),
+            "memberships": sum(len(p.counts) for chat_id, p in self._partitions.items() if chat_id != self.GLOBAL),
+            "saves": self.saves,
+        }
+
+
+CHAT_STATS = ChatStats()
+
+
+# Класс для учёта авторов сообщений до фильтров и обработчиков
+class ChatMemberMiddleware(BaseMiddleware):
+    def __init__(self, cache: ChatMemberCache = CHAT_MEMBERS, chat_stats: ChatStats = CHAT_STATS):
+        self.cache = cache
+        self.chat_stats = chat_stats
+
+    @staticmethod
+    def count_message(user_id: str) -> None:
+        """Счётчик сообщений профиля и колонка аналитики экономики обновляются вместе"""
+        if user_id not in users:
+            return
+        user = users[user_id]
+        user.messages_count += 1
+        ECONOMY.on_messages(user_id, user.messages_count)
+        save_data()
+
+    async def __call__(self, handler, event, data):
+        if event.from_user is not None and not event.from_user.is_bot:
+            self.count_message(str(event.from_user.id))
+        if event.chat.type != "private":
+            if event.from_user is not None and not event.from_user.is_bot:
+                self.cache.seen(event.chat.id, event.from_user)
+                self.chat_stats.record(event.chat.id, event.from_user.id)
+            for member in event.new_chat_members or ():
+                self.cache.seen(event.chat.id, member)
+            if event.left_chat_member is not None:
+                self.cache.remove(event.chat.id, event.left_chat_member.id)
+                self.chat_stats.remove(event.chat.id, event.left_chat_member.id)
+        return await handler(event, data)
+
+
+dp.message.outer_middleware(ChatMemberMiddleware())
+
+
+class CircuitOpenError(requests.exceptions.ConnectionError):
+    """Внешний API признан недоступным, вызов не выполнялся"""
+
+
+# Класс для автомата защиты внешнего API: при высокой доле ошибок или медленных ответов вызовы сразу отклоняются
+class CircuitBreaker:
+    """Состояния closed -> open -> half_open -> closed.
+
+    В closed вызовы проходят, их исходы копятся в окне последних CIRCUIT_WINDOW
+    вызовов; когда доля ошибок (включая ответы 5xx/429 и вызовы дольше
+    slow_call) достигает error_rate, цепь размыкается. В open вызовы сразу
+    получают CircuitOpenError, через open_for секунд один пробный вызов
+    (half_open) решает, замкнуть цепь или снова разомкнуть.
+    """
+
+    CLOSED, OPEN, HALF_OPEN = "closed", "open", "half_open"
+
+    def __init__(self, name: str, window: int = CIRCUIT_WINDOW, min_calls: int = CIRCUIT_MIN_CALLS,
+                 error_rate: float = CIRCUIT_ERROR_RATE, slow_call: float = CIRCUIT_SLOW_CALL,
+                 open_for: float = CIRCUIT_OPEN_FOR):
+        self.name = name
+        self.min_calls = min_calls
+        self.error_rate = error_rate
+        self.slow_call = slow_call
+        self.open_for = open_for
+        self.state = self.CLOSED
+        self._results = deque(maxlen=window)
+        self._opened_at = 0.0
+        self._probing = False
+        self.calls = 0
+        self.rejected = 0
+        self.opens = 0
+
+    def _allow(self) -> bool:
+        if self.state == self.OPEN:
+            if time.monotonic() - self._opened_at < self.open_for:
+                return False
+            self.state = self.HALF_OPEN
+        if self.state == self.HALF_OPEN:
+            if self._probing:
+                return False
+            self._probing = True
+        return True
+
+    def _open(self) -> None:
+        self.state = self.OPEN
+        self._opened_at = time.monotonic()
+        self._results.clear()
+        self.opens += 1
+        logger.error("Circuit %s opened", self.name)
+
+    def _record(self, ok: bool) -> None:
+        if self.state == self.HALF_OPEN:
+            self._probing = False
+            if ok:
+                self.state = self.CLOSED
+                logger.info("Circuit %s closed", self.name)
+            else:
+                self._open()
+            return
+        if self.state == self.OPEN:
+            return  # Вызов начался до размыкания
+        self._results.append(ok)
+        if len(self._results) >= self.min_calls and self._results.count(False) >= self.error_rate * len(self._results):
+            self._open()
+
+    async def call(self, func, *args, **kwargs):
+        """Выполняет блокирующий вызов в рабочем потоке; при разомкнутой цепи сразу бросает CircuitOpenError"""
+        if not self._allow():
+            self.rejected += 1
+            raise CircuitOpenError(f"{self.name} временно недоступен")
+        self.calls += 1
+        started = time.monotonic()
+        ok = False
+        try:
+            result = await asyncio.to_thread(func, *args, **kwargs)
+            status = getattr(result, "status_code", 200)
+            ok = status < 500 and status != 429 and time.monotonic() - started <= self.slow_call
+            return result
+        finally:
+            self._record(ok)
+
+    def stats(self) -> Dict[str, Any]:
+        failures = self._results.count(False)
+        return {
+            "state": self.state,
+            "error_rate": failures / len(self._results) if self._results else 0.0,
+            "calls": self.calls,
+            "rejected": self.rejected,
+            "opens": self.opens,
+        }
+
+
+CIRCUIT_BREAKERS = {
+    "weather": CircuitBreaker("OpenWeatherMap"),
+    "geocode": CircuitBreaker("Nominatim"),
+    "maps": CircuitBreaker("Google Maps"),
+    "translate": CircuitBreaker("Yandex Translate"),
+}
+
+
+# Класс для поиска id городов OpenWeatherMap по названию
+class CityIndex:
+    """Названия городов из списка OpenWeatherMap -> id города.
+
+    Хранит отсортированный список названий ("город" и "город,страна") и
+    массив id: поиск - бинарный, без словаря на сотни тысяч строк. Названия,
+    которые носят несколько городов, без страны не индексируются - такие
+    запросы уходят в OpenWeatherMap по названию.
+    """
+
+    def __init__(self, path: str = WEATHER_CITY_LIST_FILE):
+        self.path = path
+        self._names = []
+        self._ids = array.array("q")
+
+    @staticmethod
+    def normalize(name: str) -> str:
+        return ",".join(" ".join(part.split()) for part in name.lower().replace("ё", "е").split(","))
+
+    def load(self) -> None:
+        opener = gzip.open if self.path.endswith(".gz") else open
+        try:
+            with opener(self.path, "rt", encoding="utf-8") as file:
+                cities = json.load(file)
+        except FileNotFoundError:
+            logger.info("City list %s not found, weather is queried by name", self.path)
+            return
+        except (OSError, ValueError) as e:
+            logger.error("City list load error: %s", e)
+            return
+
+        entries = []
+        bare = defaultdict(list)
+        for city in cities:
+            name = self.normalize(city["name"])
+            bare[name].append(city["id"])
+            if city.get("country"):
+                entries.append((f"{name},{city['country'].lower()}", city["id"]))
+        entries += [(name, ids[0]) for name, ids in bare.items() if len(ids) == 1]
+        entries.sort()
+        self._names = [name for name, _ in entries]
+        self._ids = array.array("q", (city_id for _, city_id in entries))
+        logger.info("City index built: %s names", len(self._names))
+
+    def get(self, name: str) -> Optional[int]:
+        name = self.normalize(name)
+        idx = bisect.bisect_left(self._names, name)
+        if idx < len(self._names) and self._names[idx] == name:
+            return self._ids[idx]
+        return None
+
+    def __len__(self) -> int:
+        return len(self._names)
+
+
+CITY_INDEX = CityIndex()
+
+
+def parse_cities(text: str) -> List[str]:
+    """Города через запятую; двухбуквенный код страны относится к предыдущему городу (Paris, FR, Tokyo)"""
+    cities = []
+    for part in text.split(","):
+        part = " ".join(part.split())
+        if not part:
+            continue
+        if cities and len(part) == 2 and part.isalpha() and "," not in cities[-1]:
+            cities[-1] = f"{cities[-1]},{part.upper()}"
+        else:
+            cities.append(part)
+    # Повторы без учёта регистра отбрасываются, остаётся первое написание
+    unique = {}
+    for city in cities:
+        unique.setdefault(CityIndex.normalize(city), city)
+    return list(unique.values())
+
+
+# Класс для учёта популярных запросов погоды: счётчики с экспоненциальным затуханием
+class WeatherPopularity:
+    def __init__(self, half_life: float = WEATHER_POPULARITY_HALF_LIFE):
+        self.half_life = half_life
+        self._scores = {}  # (вид запроса, город) -> (счёт, время обновления)
+
+    def _decayed(self, entry: tuple, now: float) -> float:
+        score, updated = entry
+        return score * 0.5 ** ((now - updated) / self.half_life)
+
+    def hit(self, kind: str, city: str) -> None:
+        now = time.monotonic()
+        entry = self._scores.get((kind, city))
+        self._scores[(kind, city)] = ((self._decayed(entry, now) if entry else 0.0) + 1, now)
+
+    def top(self, count: int) -> List[tuple]:
+        """Самые популярные запросы; забытые (счёт < 0.01) удаляются"""
+        now = time.monotonic()
+        scores = {key: self._decayed(entry, now) for key, entry in self._scores.items()}
+        for key, score in scores.items():
+            if score < 0.01:
+                del self._scores[key]
+        return heapq.nlargest(count, (key for key in scores if key in self._scores), key=scores.get)
+
+    def __len__(self) -> int:
+        return len(self._scores)
+
+
+WEATHER_POPULARITY = WeatherPopularity()
+
+
 # Класс для работы с погодой
 class WeatherAPI:
+    BASE_URL = "http://api.openweathermap.org/data/2.5"
+    ICONS = {
+        "01": "☀️",  # ясно
+        "02": "⛅️",  # малооблачно
+        "03": "☁️",  # облачно
+        "04": "☁️",  # пасмурно
+        "09": "🌧️",  # дождь
+        "10": "🌦️",  # дождь с прояснениями
+        "11": "⛈️",  # гроза
+        "13": "❄️",  # снег
+        "50": "🌫️",  # туман
+    }
+    FORECAST_SLOTS_PER_DAY = 8  # Прогноз приходит трёхчасовыми интервалами
+    _semaphore = None  # Создаётся в цикле событий при первом запросе
+
+    refreshes = 0
+    stale_hits = 0
+    _revalidating = set()  # (вид, город), обновляемые в фоне
+    _tasks = set()
+
     @staticmethod
-    async def get_weather(city: str) -> Dict[str, Any]:
-        """Получение данных о погоде через OpenWeatherMap API"""
+    def _cached(city: str, cache: dict = WEATHER_CACHE, ttl: float = WEATHER_CACHE_TTL) -> Optional[Dict[str, Any]]:
+        cached_data = cache.get(CityIndex.normalize(city))
+        if cached_data and (datetime.now() - cached_data["timestamp"]).total_seconds() < ttl:
+            return cached_data["data"]
+        return None
+
+    @staticmethod
+    def _store(city: str, data: Dict[str, Any], cache: dict = WEATHER_CACHE) -> None:
+        cache[CityIndex.normalize(city)] = {"timestamp": datetime.now(), "data": data}
+
+    @classmethod
+    def _cached_or_stale(cls, kind: str, city: str, cache: dict = WEATHER_CACHE) -> Optional[Dict[str, Any]]:
+        """Свежая запись кэша; устаревшая (не старше WEATHER_STALE_TTL) отдаётся сразу и обновляется в фоне"""
+        cached_data = cache.get(CityIndex.normalize(city))
+        if not cached_data:
+            return None
+        age = (datetime.now() - cached_data["timestamp"]).total_seconds()
+        if age < WEATHER_CACHE_TTL:
+            return cached_data["data"]
+        if age > WEATHER_STALE_TTL:
+            return None
+        cls.stale_hits += 1
+        cls._revalidate(kind, city)
+        return cached_data["data"]
+
+    @classmethod
+    def _revalidate(cls, kind: str, city: str) -> None:
+        key = (kind, CityIndex.normalize(city))
+        if key in cls._revalidating:
+            return
+        cls._revalidating.add(key)
+        fetch = cls.get_weather if kind == "weather" else cls.get_forecast
+        task = asyncio.create_task(fetch(city, refresh=True))
+        cls._tasks.add(task)
+
+        def done(task) -> None:
+            cls._tasks.discard(task)
+            cls._revalidating.discard(key)
+        task.add_done_callback(done)
+
+    @classmethod
+    async def _fetch(cls, endpoint: str, **params) -> Dict[str, Any]:
+        """Запрос к OpenWeatherMap в рабочем потоке; одновременно - не больше WEATHER_CONCURRENCY"""
+        if cls._semaphore is None:
+            cls._semaphore = asyncio.Semaphore(WEATHER_CONCURRENCY)
+        params.update(appid=WEATHER_API_KEY, units="metric", lang="ru")
+        async with cls._semaphore:
+            response = await CIRCUIT_BREAKERS["weather"].call(
+                requests.get, f"{cls.BASE_URL}/{endpoint}", params=params, timeout=WEATHER_TIMEOUT
+            )
+        response.raise_for_status()
+        return response.json()
+
+    @classmethod
+    async def get_weather(cls, city: str, refresh: bool = False) -> Dict[str, Any]:
+        """Получение данных о погоде через OpenWeatherMap API; refresh - фоновое обновление мимо кэша"""
         try:
             # Проверяем кэш
-            if city in WEATHER_CACHE:
-                cached_data = WEATHER_CACHE[city]
-                if (datetime.now() - cached_data["timestamp"]).seconds < 3600:  # 1 час кэша
-                    return cached_data["data"]
-
-            url = f"http://api.openweathermap.org/data/2.5/weather?q={city}&appid={WEATHER_API_KEY}&units=metric&lang=ru"
-            response = requests.get(url)
-            response.raise_for_status()
-            data = response.json()
+            if not refresh:
+                WEATHER_POPULARITY.hit("weather", CityIndex.normalize(city))
+                cached_data = cls._cached_or_stale("weather", city)
+                if cached_data is not None:
+                    return cached_data
+
+            data = await cls._fetch("weather", q=city)
+            cls._store(city, data)
+            return data
+        except requests.exceptions.RequestException as e:
+            logger.error("Weather API error: %s", e)
+            return {"error": str(e)}
 
-            # Сохраняем в кэш
-            WEATHER_CACHE[city] = {
-                "timestamp": datetime.now(),
-                "data": data
-            }
+    @classmethod
+    async def get_weather_many(cls, cities: List[str]) -> List[Dict[str, Any]]:
+        """Погода по нескольким городам: известные индексу - пачками через /group, остальные - по названию.
+
+        Все запросы выполняются параллельно; результаты возвращаются в порядке cities.
+        """
+        results = {}
+        by_id = defaultdict(list)  # id города -> названия из запроса
+        by_name = []
+        for city in dict.fromkeys(cities):
+            WEATHER_POPULARITY.hit("weather", CityIndex.normalize(city))
+            cached_data = cls._cached_or_stale("weather", city)
+            if cached_data is not None:
+                results[city] = cached_data
+                continue
+            city_id = CITY_INDEX.get(city)
+            if city_id is None:
+                by_name.append(city)
+            else:
+                by_id[city_id].append(city)
+
+        async def fetch_group(group: list) -> None:
+            try:
+                data = await cls._fetch("group", id=",".join(map(str, group)))
+            except requests.exceptions.RequestException as e:
+                logger.error("Weather API group error: %s", e)
+                data = {"error": str(e)}
+            for item in data.get("list", []):
+                for city in by_id.get(item.get("id"), ()):
+                    results[city] = item
+                    cls._store(city, item)
+            for city_id in group:
+                for city in by_id[city_id]:
+                    results.setdefault(city, {"error": data.get("error", "город не найден")})
+
+        async def fetch_name(city: str) -> None:
+            results[city] = await cls.get_weather(city, refresh=True)
+
+        ids = list(by_id)
+        await asyncio.gather(
+            *(fetch_group(ids[idx:idx + WEATHER_GROUP_SIZE]) for idx in range(0, len(ids), WEATHER_GROUP_SIZE)),
+            *(fetch_name(city) for city in by_name),
+        )
+        return [results[city] for city in cities]
 
+    @classmethod
+    async def get_forecast(cls, city: str, refresh: bool = False) -> Dict[str, Any]:
+        """Прогноз по дням: 3-часовые интервалы OpenWeatherMap, сведённые aggregate_forecast"""
+        try:
+            if not refresh:
+                WEATHER_POPULARITY.hit("forecast", CityIndex.normalize(city))
+                cached_data = cls._cached_or_stale("forecast", city, FORECAST_CACHE)
+                if cached_data is not None:
+                    return cached_data
+
+            data = cls.aggregate_forecast(await cls._fetch("forecast", q=city))
+            cls._store(city, data, FORECAST_CACHE)
             return data
         except requests.exceptions.RequestException as e:
-            logger.error(f"Weather API error: {e}")
+            logger.error("Forecast API error: %s", e)
             return {"error": str(e)}
+        except (KeyError, IndexError, TypeError) as e:
+            logger.error("Error aggregating forecast data: %s", e)
+            return {"error": "не удалось обработать прогноз"}
+
+    @staticmethod
+    def aggregate_forecast(data: Dict[str, Any], days: int = WEATHER_FORECAST_DAYS) -> Dict[str, Any]:
+        """Минимум, максимум и сумма осадков по местным суткам; описание - по интервалу ближе к полудню.
+
+        Неполные сутки (остаток сегодняшнего дня и обрезанный последний день) пропускаются,
+        если в ответе есть полные.
+        """
+        slots = data["list"]
+        count = len(slots)
+        local = np.fromiter((slot["dt"] for slot in slots), dtype=np.int64, count=count)
+        local += data["city"].get("timezone", 0)
+        temp_min = np.fromiter((slot["main"]["temp_min"] for slot in slots), dtype=np.float64, count=count)
+        temp_max = np.fromiter((slot["main"]["temp_max"] for slot in slots), dtype=np.float64, count=count)
+        precipitation = np.fromiter(
+            (slot.get("rain", {}).get("3h", 0) + slot.get("snow", {}).get("3h", 0) for slot in slots),
+            dtype=np.float64, count=count,
+        )
+
+        # Интервалы идут по времени, поэтому сутки - непрерывные отрезки и сводятся reduceat
+        day_numbers, starts = np.unique(local // 86400, return_index=True)
+        ends = np.append(starts[1:], count)
+        lows = np.minimum.reduceat(temp_min, starts)
+        highs = np.maximum.reduceat(temp_max, starts)
+        totals = np.add.reduceat(precipitation, starts)
+        hours = (local % 86400) // 3600
+
+        full = np.flatnonzero(ends - starts >= WeatherAPI.FORECAST_SLOTS_PER_DAY)
+        keep = (full if len(full) else np.arange(len(starts)))[:days]
+        result = []
+        for day, start, end, low, high, total in zip(day_numbers[keep], starts[keep], ends[keep],
+                                                     lows[keep], highs[keep], totals[keep]):
+            midday = slots[start + int(np.argmin(np.abs(hours[start:end] - 13)))]
+            result.append({
+                "date": int(day) * 86400,
+                "min": float(low),
+                "max": float(high),
+                "precipitation": float(total),
+                "description": midday["weather"][0]["description"],
+                "icon": midday["weather"][0]["icon"],
+            })
+        return {"name": data["city"]["name"], "days": result}
+
+    @classmethod
+    def format_forecast(cls, data: Dict[str, Any]) -> str:
+        if "error" in data:
+            return f"Ошибка при получении прогноза: {data['error']}"
+        lines = [f"📅 Прогноз погоды в {data['name']}:"]
+        for day in data["days"]:
+            # date - полночь местных суток, отсчитанная как UTC
+            date = datetime.fromtimestamp(day["date"], pytz.utc).strftime("%d.%m")
+            emoji = cls.ICONS.get(day["icon"][:-1], "🌡️")
+            line = f"{date} {emoji} {day['min']:.0f}…{day['max']:.0f}°C, {day['description']}"
+            if day["precipitation"] >= 0.1:
+                line += f", осадки {day['precipitation']:.1f} мм"
+            lines.append(line)
+        return "\n".join(lines)
+
+    @classmethod
+    async def refresh_popular(cls, count: int = WEATHER_REFRESH_TOP) -> None:
+        """Заранее обновляет популярные записи, которые скоро истекут или уже истекли"""
+        fetchers = {"weather": (cls.get_weather, WEATHER_CACHE), "forecast": (cls.get_forecast, FORECAST_CACHE)}
+        fresh_for = WEATHER_CACHE_TTL - WEATHER_REFRESH_AHEAD
+        due = []
+        for kind, city in WEATHER_POPULARITY.top(count):
+            fetch, cache = fetchers[kind]
+            if cls._cached(city, cache, fresh_for) is None:
+                due.append(fetch(city, refresh=True))
+        if due:
+            await asyncio.gather(*due)
+            cls.refreshes += len(due)
 
     @staticmethod
     def format_weather(data: Dict[str, Any]) -> str:
@@ -133,20 +2478,8 @@ class WeatherAPI:
             sunrise = datetime.fromtimestamp(data["sys"]["sunrise"], timezone).strftime("%H:%M")
             sunset = datetime.fromtimestamp(data["sys"]["sunset"], timezone).strftime("%H:%M")
 
-            weather_icons = {
-                "01": "☀️",  # ясно
-                "02": "⛅️",  # малооблачно
-                "03": "☁️",  # облачно
-                "04": "☁️",  # пасмурно
-                "09": "🌧️",  # дождь
-                "10": "🌦️",  # дождь с прояснениями
-                "11": "⛈️",  # гроза
-                "13": "❄️",  # снег
-                "50": "🌫️",  # туман
-            }
-
             icon_code = icon[:-1]
-            emoji = weather_icons.get(icon_code, "🌡️")
+            emoji = WeatherAPI.ICONS.get(icon_code, "🌡️")
 
             return (
                 f"{emoji} Погода в {city}:\n"
@@ -158,88 +2491,514 @@ class WeatherAPI:
                 f"Закат: {sunset} 🌇"
             )
         except KeyError as e:
-            logger.error(f"Error formatting weather data: {e}")
+            logger.error("Error formatting weather data: %s", e)
             return "Не удалось обработать данные о погоде."
 
 
-# Класс для работы с картами
-class MapsAPI:
+# Класс для дискового кэша картинок карт с адресацией по содержимому запроса
+class MapCache:
+    """PNG карт в MAP_CACHE_DIR под именем sha256 нормализованного запроса.
+
+    Рядом с картинкой хранится file_id Telegram (файл .id), полученный при
+    первой отправке: повторный запрос не скачивает и не загружает картинку
+    заново. Объём ограничен MAP_CACHE_MAX_BYTES, вытесняются давно не
+    использованные записи (порядок восстанавливается по mtime при старте).
+    """
+
+    def __init__(self, directory: str = MAP_CACHE_DIR, max_bytes: int = MAP_CACHE_MAX_BYTES):
+        self.directory = directory
+        self.max_bytes = max_bytes
+        self._sizes = OrderedDict()  # ключ -> размер PNG, от давно использованных к недавним
+        self._file_ids = {}
+        self.total_bytes = 0
+        self.hits = 0
+        self.file_id_hits = 0
+        self.misses = 0
+        self.evictions = 0
+
     @staticmethod
-    async def get_map_image(location: str, zoom: int = 12, size: str = "600x400") -> Optional[bytes]:
-        """Получение статического изображения карты через Google Maps API"""
+    def key(request: Dict[str, Any]) -> str:
+        return hashlib.sha256(json.dumps(request, sort_keys=True).encode("utf-8")).hexdigest()
+
+    def _path(self, key: str, suffix: str = ".png") -> str:
+        return os.path.join(self.directory, key + suffix)
+
+    def open(self) -> None:
+        """Восстанавливает индекс по содержимому каталога"""
+        os.makedirs(self.directory, exist_ok=True)
+        images = []
+        for entry in os.scandir(self.directory):
+            key, suffix = os.path.splitext(entry.name)
+            if suffix == ".png":
+                stat = entry.stat()
+                images.append((stat.st_mtime, key, stat.st_size))
+            elif suffix == ".id":
+                with open(entry.path, "r") as file:
+                    self._file_ids[key] = file.read().strip()
+        for _, key, size in sorted(images):
+            self._sizes[key] = size
+            self.total_bytes += size
+        logger.info("Map cache opened: %s images, %s KiB", len(self._sizes), self.total_bytes // 1024)
+
+    def file_id(self, key: str) -> Optional[str]:
+        file_id = self._file_ids.get(key)
+        if file_id:
+            self.file_id_hits += 1
+            if key in self._sizes:
+                self._sizes.move_to_end(key)
+        return file_id
+
+    @staticmethod
+    def _read_file(path: str) -> Optional[bytes]:
         try:
-            # Сначала получаем координаты по названию места
-            geolocator = Nominatim(user_agent="telegram_bot")
-            location_data = geolocator.geocode(location)
-            if not location_data:
-                return None
+            with open(path, "rb") as file:
+                data = file.read()
+            os.utime(path)
+            return data
+        except OSError:
+            return None
 
-            lat, lon = location_data.latitude, location_data.longitude
+    @staticmethod
+    def _write_file(path: str, data: bytes) -> None:
+        with open(path + ".tmp", "wb") as file:
+            file.write(data)
+        os.replace(path + ".tmp", path)
 
-            url = f"https://maps.googleapis.com/maps/api/staticmap?center={lat},{lon}&zoom={zoom}&size={size}&maptype=roadmap&markers=color:red%7C{lat},{lon}&key={MAPS_API_KEY}"
-            response = requests.get(url)
-            response.raise_for_status()
-            return response.content
+    @staticmethod
+    def _remove_files(paths: list) -> None:
+        for path in paths:
+            try:
+                os.remove(path)
+            except FileNotFoundError:
+                pass
+
+    # Индекс меняется только в цикле событий, в рабочих потоках - лишь файловые операции
+
+    async def read(self, key: str) -> Optional[bytes]:
+        if key not in self._sizes:
+            self.misses += 1
+            return None
+        data = await asyncio.to_thread(self._read_file, self._path(key))
+        if data is None:
+            await self._drop([key])
+            self.misses += 1
+            return None
+        if key in self._sizes:
+            self._sizes.move_to_end(key)
+        self.hits += 1
+        return data
+
+    async def write(self, key: str, data: bytes) -> None:
+        """Сохраняет картинку и вытесняет давно не использованные записи сверх бюджета"""
+        await asyncio.to_thread(self._write_file, self._path(key), data)
+        self.total_bytes += len(data) - self._sizes.pop(key, 0)
+        self._sizes[key] = len(data)
+        evicted = []
+        while self.total_bytes > self.max_bytes and len(self._sizes) > 1:
+            old_key, size = self._sizes.popitem(last=False)
+            self.total_bytes -= size
+            evicted.append(old_key)
+            self.evictions += 1
+        if evicted:
+            await self._drop(evicted)
+
+    async def set_file_id(self, key: str, file_id: Optional[str]) -> None:
+        if file_id is None:
+            self._file_ids.pop(key, None)
+            await asyncio.to_thread(self._remove_files, [self._path(key, ".id")])
+            return
+        self._file_ids[key] = file_id
+        await asyncio.to_thread(self._write_file, self._path(key, ".id"), file_id.encode("utf-8"))
+
+    async def _drop(self, keys: list) -> None:
+        paths = []
+        for key in keys:
+            self.total_bytes -= self._sizes.pop(key, 0)
+            self._file_ids.pop(key, None)
+            paths += [self._path(key), self._path(key, ".id")]
+        await asyncio.to_thread(self._remove_files, paths)
+
+    def stats(self) -> Dict[str, int]:
+        return {
+            "images": len(self._sizes),
+            "bytes": self.total_bytes,
+            "file_ids": len(self._file_ids),
+            "hits": self.hits,
+            "file_id_hits": self.file_id_hits,
+            "misses": self.misses,
+            "evictions": self.evictions,
+        }
+
+
+MAP_CACHE = MapCache()
+GEOCODE_CACHE = StaleCache(max_size=10000, ttl=GEOCODE_CACHE_TTL, stale_ttl=GEOCODE_STALE_TTL)
+ROUTE_CACHE = StaleCache(max_size=10000, ttl=ROUTE_CACHE_TTL, stale_ttl=ROUTE_STALE_TTL)  # (откуда, куда, способ) -> маршрут
+
+
+def decode_polyline(encoded: str) -> np.ndarray:
+    """Encoded Polyline Google -> массив (n, 2) широт и долгот без цикла по символам"""
+    if not encoded:
+        return np.empty((0, 2))
+    chunks = np.frombuffer(encoded.encode("ascii"), dtype=np.uint8).astype(np.int64) - 63
+    ends = (chunks & 0x20) == 0  # Последний 5-битный кусок числа
+    starts = np.flatnonzero(np.concatenate(([True], ends[:-1])))
+    number = np.concatenate(([0], np.cumsum(ends)[:-1]))
+    position = np.arange(len(chunks)) - starts[number]
+    values = np.add.reduceat((chunks & 0x1F) << (5 * position), starts)
+    values = np.where(values & 1, ~(values >> 1), values >> 1)
+    return np.cumsum(values.reshape(-1, 2), axis=0) / 1e5
+
+
+def encode_polyline(points: np.ndarray) -> str:
+    coords = np.round(points * 1e5).astype(np.int64)
+    deltas = np.diff(coords, axis=0, prepend=0).ravel()
+    values = np.where(deltas < 0, ~(deltas << 1), deltas << 1)
+    out = []
+    for value in values.tolist():
+        while value >= 0x20:
+            out.append(chr((0x20 | (value & 0x1F)) + 63))
+            value >>= 5
+        out.append(chr(value + 63))
+    return "".join(out)
+
+
+def simplify_polyline(points: np.ndarray, tolerance: float) -> np.ndarray:
+    """Douglas-Peucker: отрезки разбираются стеком, расстояния до хорды считаются для всего отрезка сразу"""
+    if len(points) < 3:
+        return points
+    # Долгота сжимается по широте, чтобы градусы по обеим осям были сопоставимы
+    scaled = points * np.array([1.0, np.cos(np.radians(points[:, 0].mean()))])
+    keep = np.zeros(len(points), dtype=bool)
+    keep[0] = keep[-1] = True
+    stack = [(0, len(points) - 1)]
+    while stack:
+        first, last = stack.pop()
+        if last - first < 2:
+            continue
+        start = scaled[first]
+        chord = scaled[last] - start
+        offsets = scaled[first + 1:last] - start
+        length = np.hypot(chord[0], chord[1])
+        if length == 0:
+            distances = np.hypot(offsets[:, 0], offsets[:, 1])
+        else:
+            distances = np.abs(chord[0] * offsets[:, 1] - chord[1] * offsets[:, 0]) / length
+        idx = int(np.argmax(distances))
+        if distances[idx] > tolerance:
+            split = first + 1 + idx
+            keep[split] = True
+            stack.append((first, split))
+            stack.append((split, last))
+    return points[keep]
+
+
+def fit_polyline(points: np.ndarray, max_chars: int = ROUTE_PATH_MAX_CHARS) -> str:
+    """Закодированная линия не длиннее max_chars: допуск упрощения удваивается, пока не влезет"""
+    tolerance = ROUTE_SIMPLIFY_TOLERANCE
+    while True:
+        simplified = simplify_polyline(points, tolerance)
+        encoded = encode_polyline(simplified)
+        if len(encoded) <= max_chars or len(simplified) <= 2:
+            return encoded
+        tolerance *= 2
+
+
+# Класс для работы с картами
+class MapsAPI:
+    STATIC_URL = "https://maps.googleapis.com/maps/api/staticmap"
+    DIRECTIONS_URL = "https://maps.googleapis.com/maps/api/directions/json"
+
+    @classmethod
+    async def geocode(cls, location: str, refresh: bool = False) -> Optional[tuple]:
+        """Координаты места через Nominatim (в рабочем потоке, с кэшем)"""
+        key = CityIndex.normalize(location)
+        cached = None if refresh else GEOCODE_CACHE.get(key, lambda: cls.geocode(location, refresh=True))
+        if cached is not None:
+            return cached
+        try:
+            geolocator = Nominatim(user_agent="telegram_bot")
+            location_data = await CIRCUIT_BREAKERS["geocode"].call(geolocator.geocode, location, timeout=MAPS_TIMEOUT)
         except Exception as e:
-            logger.error(f"Maps API error: {e}")
+            logger.error("Geocoding error: %s", e)
+            return None
+        if not location_data:
             return None
+        coords = (location_data.latitude, location_data.longitude)
+        GEOCODE_CACHE.set(key, coords)
+        return coords
 
     @staticmethod
-    async def get_route_map(origin: str, destination: str, mode: str = "driving") -> Optional[bytes]:
-        """Получение карты с маршрутом"""
+    def _point(lat: float, lon: float) -> str:
+        return f"{round(lat, MAP_COORD_PRECISION)},{round(lon, MAP_COORD_PRECISION)}"
+
+    @classmethod
+    async def map_request(cls, location: str, zoom: int = 12, size: str = "600x400") -> Optional[Dict[str, Any]]:
+        """Нормализованные параметры Static Maps для карты места; они же - ключ MapCache"""
+        coords = await cls.geocode(location)
+        if coords is None:
+            return None
+        point = cls._point(*coords)
+        return {"center": point, "zoom": zoom, "size": size, "maptype": "roadmap",
+                "markers": [f"color:red|{point}"]}
+
+    @classmethod
+    async def _fetch_directions(cls, start: tuple, end: tuple, mode: str) -> Optional[Dict[str, Any]]:
+        if DIRECTIONS_PROVIDER == "stub":
+            # Прямая линия из 100 точек в том же формате, что и у Directions API
+            line = np.linspace(start, end, 100)
+            return {"polyline": encode_polyline(line), "distance": "", "duration": ""}
         try:
-            geolocator = Nominatim(user_agent="telegram_bot")
-            origin_data = geolocator.geocode(origin)
-            destination_data = geolocator.geocode(destination)
+            response = await CIRCUIT_BREAKERS["maps"].call(
+                requests.get, cls.DIRECTIONS_URL, timeout=MAPS_TIMEOUT, params={
+                    "origin": "{},{}".format(*start), "destination": "{},{}".format(*end),
+                    "mode": mode, "language": "ru", "key": MAPS_API_KEY,
+                },
+            )
+            response.raise_for_status()
+            data = response.json()
+            route = data["routes"][0]
+            leg = route["legs"][0]
+            return {
+                "polyline": route["overview_polyline"]["points"],
+                "distance": leg["distance"]["text"],
+                "duration": leg["duration"]["text"],
+            }
+        except (requests.exceptions.RequestException, KeyError, IndexError, ValueError) as e:
+            logger.error("Directions API error: %s", e)
+            return None
 
-            if not origin_data or not destination_data:
-                return None
+    @classmethod
+    async def get_directions(cls, origin: str, destination: str, mode: str = "driving",
+                             refresh: bool = False) -> Optional[Dict[str, Any]]:
+        """Маршрут с раскодированной геометрией; кэшируется по (откуда, куда, способ)"""
+        key = (CityIndex.normalize(origin), CityIndex.normalize(destination), mode)
+        cached = None if refresh else ROUTE_CACHE.get(
+            key, lambda: cls.get_directions(origin, destination, mode, refresh=True)
+        )
+        if cached is not None:
+            return cached
+        origin_data, destination_data = await asyncio.gather(cls.geocode(origin), cls.geocode(destination))
+        if origin_data is None or destination_data is None:
+            return None
+        route = await cls._fetch_directions(origin_data, destination_data, mode)
+        points = None
+        if route is not None:
+            try:
+                points = decode_polyline(route.pop("polyline"))
+            except ValueError as e:  # В том числе UnicodeEncodeError у не-ASCII строки
+                logger.error("Bad route polyline %s -> %s: %s", origin, destination, e)
+        if points is None or len(points) < 2:
+            # Без геометрии маршрута рисуем прямую между точками, как раньше, но не кэшируем её
+            return {"start": origin_data, "end": destination_data, "points": np.array([origin_data, destination_data]),
+                    "distance": "", "duration": ""}
+        route = {"start": origin_data, "end": destination_data, "points": points, **route}
+        ROUTE_CACHE.set(key, route)
+        return route
+
+    @classmethod
+    async def route_request(cls, origin: str, destination: str, mode: str = "driving") -> Optional[Dict[str, Any]]:
+        route = await cls.get_directions(origin, destination, mode)
+        return cls.route_map_request(route) if route else None
 
-            origin_lat, origin_lon = origin_data.latitude, origin_data.longitude
-            dest_lat, dest_lon = destination_data.latitude, destination_data.longitude
+    @classmethod
+    def route_map_request(cls, route: Dict[str, Any]) -> Dict[str, Any]:
+        """Параметры Static Maps для маршрута: линия упрощается, пока URL не уложится в ROUTE_PATH_MAX_CHARS"""
+        start, end = cls._point(*route["start"]), cls._point(*route["end"])
+        return {"size": "600x400", "maptype": "roadmap",
+                "markers": [f"color:green|{start}", f"color:red|{end}"],
+                "path": f"color:0x0000ff80|weight:5|enc:{fit_polyline(route['points'])}"}
 
-            url = f"https://maps.googleapis.com/maps/api/staticmap?size=600x400&maptype=roadmap&markers=color:green%7C{origin_lat},{origin_lon}&markers=color:red%7C{dest_lat},{dest_lon}&path=color:0x0000ff80|weight:5|{origin_lat},{origin_lon}|{dest_lat},{dest_lon}&key={MAPS_API_KEY}"
-            response = requests.get(url)
+    @classmethod
+    async def fetch_image(cls, request: Dict[str, Any]) -> Optional[bytes]:
+        """Картинка карты: с диска, иначе из Google Static Maps с сохранением в кэш"""
+        key = MapCache.key(request)
+        data = await MAP_CACHE.read(key)
+        if data is not None:
+            return data
+        try:
+            response = await CIRCUIT_BREAKERS["maps"].call(
+                requests.get, cls.STATIC_URL, params={**request, "key": MAPS_API_KEY}, timeout=MAPS_TIMEOUT
+            )
             response.raise_for_status()
-            return response.content
-        except Exception as e:
-            logger.error(f"Route Map API error: {e}")
+        except requests.exceptions.RequestException as e:
+            logger.error("Maps API error: %s", e)
             return None
+        await MAP_CACHE.write(key, response.content)
+        return response.content
+
+    @classmethod
+    async def get_map_image(cls, location: str, zoom: int = 12, size: str = "600x400") -> Optional[bytes]:
+        """Получение статического изображения карты через Google Maps API"""
+        request = await cls.map_request(location, zoom, size)
+        return await cls.fetch_image(request) if request else None
+
+    @classmethod
+    async def get_route_map(cls, origin: str, destination: str, mode: str = "driving") -> Optional[bytes]:
+        """Получение карты с маршрутом"""
+        request = await cls.route_request(origin, destination, mode)
+        return await cls.fetch_image(request) if request else None
+
+
+async def send_static_map(message: types.Message, request: Optional[Dict[str, Any]], caption: str) -> bool:
+    """Отправляет карту по file_id из MapCache, иначе загружает картинку и запоминает её file_id"""
+    if request is None:
+        return False
+    key = MapCache.key(request)
+    file_id = MAP_CACHE.file_id(key)
+    if file_id:
+        try:
+            await message.answer_photo(file_id, caption=caption)
+            return True
+        except TelegramBadRequest as e:
+            logger.error("Cached map file_id rejected: %s", e)
+            await MAP_CACHE.set_file_id(key, None)
+
+    image = await MapsAPI.fetch_image(request)
+    if image is None:
+        return False
+    result = await message.answer_photo(BufferedInputFile(image, filename="map.png"), caption=caption)
+    if isinstance(result, Message) and result.photo:
+        await MAP_CACHE.set_file_id(key, result.photo[-1].file_id)
+    return True
 
 
 # Класс для работы с переводом
 class TranslateAPI:
     @staticmethod
-    async def translate_text(text: str, target_lang: str = "ru") -> Optional[str]:
-        """Перевод текста через Yandex Translate API"""
+    async def translate_batch(texts: List[str], target_lang: str = "ru") -> Optional[List[str]]:
+        """Перевод нескольких текстов одним запросом к Yandex Translate API (параметр text повторяется)"""
         try:
             url = "https://translate.yandex.net/api/v1.5/tr.json/translate"
             params = {
                 "key": TRANSLATE_API_KEY,
-                "text": text,
+                "text": texts,
                 "lang": target_lang,
             }
-            response = requests.get(url, params=params)
+            response = await CIRCUIT_BREAKERS["translate"].call(requests.post, url, data=params, timeout=TRANSLATE_TIMEOUT)
             response.raise_for_status()
             data = response.json()
-            return " ".join(data["text"])
+            if len(data["text"]) != len(texts):
+                raise ValueError(f"expected {len(texts)} translations, got {len(data['text'])}")
+            return data["text"]
         except Exception as e:
-            logger.error(f"Translate API error: {e}")
+            logger.error("Translate API error: %s", e)
             return None
 
+    @staticmethod
+    async def translate_text(text: str, target_lang: str = "ru") -> Optional[str]:
+        """Перевод текста через сервис с кэшем и пакетной отправкой"""
+        return await TRANSLATOR.translate(text, target_lang)
+
+
+# Класс для перевода с кэшем, склейкой одинаковых запросов и пакетной отправкой
+class TranslateService:
+    """Переводы запоминаются по (хэш текста, язык) в StaleCache.
+
+    Одинаковые запросы, пришедшие во время перевода, ждут один и тот же
+    Future. Новые тексты копятся TRANSLATE_BATCH_WINDOW секунд (или до
+    заполнения пачки) и уходят одним вызовом TranslateAPI.translate_batch.
+    """
+
+    def __init__(self, window: float = TRANSLATE_BATCH_WINDOW, max_texts: int = TRANSLATE_BATCH_MAX_TEXTS,
+                 max_chars: int = TRANSLATE_BATCH_MAX_CHARS):
+        self.window = window
+        self.max_texts = max_texts
+        self.max_chars = max_chars
+        self._cache = StaleCache(max_size=TRANSLATE_CACHE_SIZE, ttl=TRANSLATE_CACHE_TTL, stale_ttl=TRANSLATE_STALE_TTL)
+        self._inflight = {}  # ключ -> Future с переводом
+        self._pending = {}  # язык -> [(ключ, текст)]
+        self._pending_chars = defaultdict(int)
+        self._timers = {}  # язык -> asyncio.TimerHandle
+        self._tasks = set()
+        self.requests = 0
+        self.cache_hits = 0
+        self.coalesced = 0
+        self.batches = 0
+        self.upstream_texts = 0
+
+    @staticmethod
+    def _key(text: str, target_lang: str) -> tuple:
+        return hashlib.blake2b(text.encode("utf-8"), digest_size=16).digest(), target_lang
+
+    async def translate(self, text: str, target_lang: str = "ru") -> Optional[str]:
+        self.requests += 1
+        key = self._key(text, target_lang)
+        cached = self._cache.get(key, lambda: self._request(key, text, target_lang))
+        if cached is not None:
+            self.cache_hits += 1
+            return cached
+        return await self._request(key, text, target_lang)
+
+    async def _request(self, key: tuple, text: str, target_lang: str) -> Optional[str]:
+        """Перевод в обход кэша: присоединяется к идущему запросу или ставит текст в пачку"""
+        future = self._inflight.get(key)
+        if future is not None:
+            self.coalesced += 1
+            return await asyncio.shield(future)
+
+        future = self._inflight[key] = asyncio.get_running_loop().create_future()
+        # Текст не влезает в текущую пачку - отправляем её и начинаем новую
+        if self._pending_chars[target_lang] + len(text) > self.max_chars:
+            self._flush(target_lang)
+        self._pending.setdefault(target_lang, []).append((key, text))
+        self._pending_chars[target_lang] += len(text)
+        if len(self._pending[target_lang]) >= self.max_texts:
+            self._flush(target_lang)
+        elif target_lang not in self._timers:
+            self._timers[target_lang] = asyncio.get_running_loop().call_later(self.window, self._flush, target_lang)
+        return await asyncio.shield(future)
+
+    def _flush(self, target_lang: str) -> None:
+        handle = self._timers.pop(target_lang, None)
+        if handle:
+            handle.cancel()
+        batch = self._pending.pop(target_lang, None)
+        self._pending_chars.pop(target_lang, None)
+        if not batch:
+            return
+        task = asyncio.create_task(self._send(target_lang, batch))
+        self._tasks.add(task)
+        task.add_done_callback(self._tasks.discard)
+
+    async def _send(self, target_lang: str, batch: list) -> None:
+        self.batches += 1
+        self.upstream_texts += len(batch)
+        translations = await TranslateAPI.translate_batch([text for _, text in batch], target_lang)
+        for idx, (key, _) in enumerate(batch):
+            result = translations[idx] if translations else None
+            if result is not None:
+                self._cache.set(key, result)
+            future = self._inflight.pop(key, None)
+            if future is not None and not future.done():
+                future.set_result(result)
+
+    def stats(self) -> Dict[str, int]:
+        return {
+            "requests": self.requests,
+            "cache_hits": self.cache_hits,
+            "coalesced": self.coalesced,
+            "batches": self.batches,
+            "upstream_texts": self.upstream_texts,
+            "cached": len(self._cache),
+            "stale_hits": self._cache.stale_hits,
+        }
+
+
+TRANSLATOR = TranslateService()
+
 
 # Класс для работы с графиками
 class ChartGenerator:
     @staticmethod
-    async def generate_irisky_chart(user_data: Dict[str, Any]) -> Optional[bytes]:
+    async def generate_irisky_chart(user_data: UserRecord) -> Optional[bytes]:
         """Генерация графика изменения баланса пайкоинов"""
         try:
-            history = user_data.get("irisky_history", [])
+            history = user_data.irisky_history
             if not history:
                 return None
 
-            dates = [datetime.fromisoformat(item["date"]) for item in history]
-            values = [item["amount"] for item in history]
+            dates = [from_timestamp(item.date) for item in history]
+            values = [item.amount for item in history]
 
             plt.figure(figsize=(10, 5))
             plt.plot(dates, values, marker="o", linestyle="-", color="blue")
@@ -255,19 +3014,239 @@ class ChartGenerator:
             plt.close()
             return buf.read()
         except Exception as e:
-            logger.error(f"Chart generation error: {e}")
+            logger.error("Chart generation error: %s", e)
+            return None
+
+
+    @staticmethod
+    async def generate_economy_chart(report: Dict[str, Any]) -> Optional[bytes]:
+        """Кривая Лоренца распределения пайкоинов и ежедневный приток"""
+        try:
+            fig, (ax_lorenz, ax_inflow) = plt.subplots(1, 2, figsize=(12, 5))
+
+            lorenz = report["lorenz"]
+            share = np.linspace(0, 1, len(lorenz))
+            ax_lorenz.plot(share, lorenz, color="blue", label="Распределение")
+            ax_lorenz.plot([0, 1], [0, 1], linestyle="--", color="gray", label="Равенство")
+            ax_lorenz.set_title(f"Кривая Лоренца (Джини {report['gini']:.2f})")
+            ax_lorenz.set_xlabel("Доля пользователей")
+            ax_lorenz.set_ylabel("Доля пайкоинов")
+            ax_lorenz.legend()
+            ax_lorenz.grid(True)
+
+            days = report["days"]
+            ax_inflow.bar(days, report["inflow_ferma"], color="green", label="Ферма")
+            ax_inflow.bar(days, report["inflow_quiz"], bottom=report["inflow_ferma"], color="orange", label="Викторины")
+            ax_inflow.set_title("Ежедневный приток пайкоинов")
+            ax_inflow.set_xlabel("Дата")
+            ax_inflow.legend()
+            ax_inflow.grid(True)
+            fig.autofmt_xdate()
+            fig.tight_layout()
+
+            buf = io.BytesIO()
+            fig.savefig(buf, format="png")
+            buf.seek(0)
+            plt.close(fig)
+            return buf.read()
+        except Exception as e:
+            logger.error("Economy chart generation error: %s", e)
+            return None
+
+
+# Класс с состоянием шахматной позиции, рассчитанным один раз
+class PositionStatus:
+    """Исход позиции и разобранные ходы: проверки выполняются один раз на позицию"""
+    __slots__ = ("board", "moves", "is_check", "is_checkmate", "is_stalemate", "is_insufficient_material")
+
+    def __init__(self, board: chess.Board):
+        self.board = board
+        self.moves = {}  # Введённая запись хода (UCI или SAN) -> легальный ход или None
+        self.is_check = board.is_check()
+        # Генерация легальных ходов останавливается на первом найденном
+        has_moves = any(True for _ in board.generate_legal_moves())
+        self.is_checkmate = self.is_check and not has_moves
+        self.is_stalemate = not self.is_check and not has_moves
+        self.is_insufficient_material = board.is_insufficient_material()
+
+    def find(self, move_str: str) -> Optional[chess.Move]:
+        """Ищет легальный ход по записи в UCI или SAN"""
+        if move_str in self.moves:
+            return self.moves[move_str]
+        try:
+            move = chess.Move.from_uci(move_str.lower())
+            if not self.board.is_legal(move):
+                move = None
+        except ValueError:
+            try:
+                move = self.board.parse_san(move_str)
+            except ValueError:
+                move = None
+        self.moves[move_str] = move
+        return move
+
+
+# Индекс названий дебютов: MAGIC | заголовок | ключи Zobrist (uint64, по возрастанию) | смещения строк в TSV
+OPENING_INDEX_MAGIC = b"PKON"
+_OPENING_INDEX_HEADER = struct.Struct("<4sIQQ")  # magic, число позиций, размер и mtime файла названий
+
+
+# Класс для дебютной книги: файлы не загружаются в память, а читаются через mmap
+class OpeningBook:
+    def __init__(self, book_path: str = OPENING_BOOK_FILE, names_path: str = OPENING_NAMES_FILE):
+        self.book_path = book_path
+        self.names_path = names_path
+        self.index_path = names_path + ".idx"
+        self._opened = False
+        self.ready = False  # Книга и индекс открыты; до этого подсказки просто не показываются
+        self._reader = None  # chess.polyglot.MemoryMappedReader
+        self._names = None  # mmap файла названий
+        self._keys = None  # np.memmap ключей позиций
+        self._offsets = None  # np.memmap смещений строк
+
+    def open(self) -> None:
+        """Открывает книгу и индекс названий; индекс пересобирается, если файл названий изменился.
+
+        Вызывается в рабочем потоке при запуске, обработчики ходов не ждут сборки индекса.
+        """
+        if self._opened:
+            return
+        self._opened = True
+        try:
+            self._open()
+        finally:
+            self.ready = True
+
+    def _open(self) -> None:
+        if os.path.exists(self.book_path):
+            try:
+                self._reader = chess.polyglot.open_reader(self.book_path)
+            except (OSError, ValueError) as e:
+                logger.error("Error opening opening book %s: %s", self.book_path, e)
+        if not os.path.exists(self.names_path):
+            return
+        try:
+            stat = os.stat(self.names_path)
+            if not self._index_fresh(stat):
+                self.build_index()
+            with open(self.names_path, "rb") as file:
+                self._names = mmap.mmap(file.fileno(), 0, access=mmap.ACCESS_READ)
+            with open(self.index_path, "rb") as file:
+                _, count, _, _ = _OPENING_INDEX_HEADER.unpack(file.read(_OPENING_INDEX_HEADER.size))
+            if count:
+                self._keys = np.memmap(self.index_path, dtype="<u8", mode="r",
+                                       offset=_OPENING_INDEX_HEADER.size, shape=(count,))
+                self._offsets = np.memmap(self.index_path, dtype="<u8", mode="r",
+                                          offset=_OPENING_INDEX_HEADER.size + count * 8, shape=(count,))
+        except (OSError, ValueError, struct.error) as e:
+            logger.error("Error opening opening names %s: %s", self.names_path, e)
+            self._names = self._keys = self._offsets = None
+
+    def _index_fresh(self, stat: os.stat_result) -> bool:
+        try:
+            with open(self.index_path, "rb") as file:
+                magic, _, size, mtime = _OPENING_INDEX_HEADER.unpack(file.read(_OPENING_INDEX_HEADER.size))
+        except (OSError, struct.error):
+            return False
+        return magic == OPENING_INDEX_MAGIC and size == stat.st_size and mtime == stat.st_mtime_ns
+
+    def build_index(self) -> int:
+        """Строит индекс: ключ Zobrist конечной позиции каждого дебюта -> смещение его строки"""
+        stat = os.stat(self.names_path)
+        positions = {}
+        with open(self.names_path, "rb") as file:
+            offset = 0
+            for raw in file:
+                fields = raw.decode("utf-8").rstrip("\r\n").split("\t")
+                if len(fields) >= 3 and fields[0] != "eco":
+                    board = chess.Board()
+                    try:
+                        for token in fields[2].split():
+                            if not token[0].isdigit():
+                                board.push_san(token)
+                    except ValueError:
+                        logger.error("Bad opening line at %s in %s", offset, self.names_path)
+                    else:
+                        positions[chess.polyglot.zobrist_hash(board)] = offset
+                offset += len(raw)
+
+        keys = np.array(sorted(positions), dtype="<u8")
+        offsets = np.array([positions[key] for key in keys.tolist()], dtype="<u8")
+        tmp_path = self.index_path + ".tmp"
+        with open(tmp_path, "wb") as file:
+            file.write(_OPENING_INDEX_HEADER.pack(OPENING_INDEX_MAGIC, len(keys), stat.st_size, stat.st_mtime_ns))
+            file.write(keys.tobytes())
+            file.write(offsets.tobytes())
+        os.replace(tmp_path, self.index_path)
+        return len(keys)
+
+    def move(self, board: chess.Board) -> Optional[chess.Move]:
+        """Ход из книги с учётом весов или None, если позиции в книге нет"""
+        if not self.ready or self._reader is None:
+            return None
+        try:
+            return self._reader.weighted_choice(board).move
+        except IndexError:
+            return None
+
+    def opening_name(self, board: chess.Board) -> Optional[str]:
+        """Название дебюта, если текущая позиция есть в индексе"""
+        if not self.ready or self._keys is None:
+            return None
+        key = chess.polyglot.zobrist_hash(board)
+        idx = int(np.searchsorted(self._keys, np.uint64(key)))
+        if idx >= len(self._keys) or int(self._keys[idx]) != key:
             return None
+        start = int(self._offsets[idx])
+        end = self._names.find(b"\n", start)
+        fields = self._names[start:end if end != -1 else len(self._names)].decode("utf-8").rstrip("\r").split("\t")
+        return f"{fields[0]} {fields[1]}"
+
+    def stats(self) -> Dict[str, Any]:
+        return {
+            "book": self._reader is not None,
+            "openings": len(self._keys) if self._keys is not None else 0,
+        }
+
+
+OPENING_BOOK = OpeningBook()
 
 
 # Класс для шахматной игры
 class ChessGame:
-    def __init__(self, white_player: str, black_player: str):
+    def __init__(self, white_player: str, black_player: str, time_control: Optional[str] = None):
         self.board = chess.Board()
         self.white_player = white_player
         self.black_player = black_player
+        self.white_id = None  # Telegram id игроков; None - AI
+        self.black_id = None
         self.current_turn = "white"
         self.moves_history = []
         self.start_time = datetime.now()
+        self.message_id = None  # Сообщение с доской в режиме CHESS_VIEW_MODE = "edit"
+        self.opening = None  # Название последнего пройденного дебюта из OPENING_BOOK
+        self._status = None
+        # Часы: оставшиеся секунды каждой стороны и момент, с которого идёт время стороны на ходу
+        self.time_control = time_control
+        self.clocks = {}
+        self.increment = 0
+        self.turn_started = None
+        self.flagged = None  # Сторона, у которой упал флажок
+        if time_control:
+            minutes, self.increment = CHESS_TIME_CONTROLS[time_control]
+            self.clocks = {chess.WHITE: minutes * 60.0, chess.BLACK: minutes * 60.0}
+            self.turn_started = time.time()
+
+    def status(self) -> PositionStatus:
+        """Состояние текущей позиции; сбрасывается после каждого хода"""
+        if self._status is None:
+            self._status = PositionStatus(self.board)
+        return self._status
+
+    @property
+    def orientation(self) -> chess.Color:
+        """Сторона, снизу которой показывается доска"""
+        return chess.WHITE if self.current_turn == "white" else chess.BLACK
 
     def show_board(self) -> str:
         """Возвращает SVG-представление доски"""
@@ -276,60 +3255,398 @@ class ChessGame:
             orientation=chess.WHITE if self.current_turn == "white" else chess.BLACK,
             size=400,
             lastmove=self.board.peek() if self.board.move_stack else None,
-            check=self.board.king(
-                chess.WHITE if self.board.turn == chess.WHITE else chess.BLACK) if self.board.is_check() else None,
+            check=self.board.king(self.board.turn) if self.status().is_check else None,
         )
 
     def move(self, move_str: str) -> bool:
         """Пытается выполнить ход, возвращает успешность выполнения"""
-        try:
-            move = self.board.parse_san(move_str)
-            if move in self.board.legal_moves:
-                self.board.push(move)
-                self.moves_history.append(move_str)
-                self.current_turn = "black" if self.current_turn == "white" else "white"
-                return True
-            return False
-        except (chess.IllegalMoveError, chess.InvalidMoveError):
+        move = self.status().find(move_str.strip())
+        if move is None:
             return False
+        self.board.push(move)
+        self._status = None
+        if self.time_control:
+            now = time.time()
+            mover = not self.board.turn
+            self.clocks[mover] += self.increment - (now - self.turn_started)
+            self.turn_started = now
+        self.opening = OPENING_BOOK.opening_name(self.board) or self.opening
+        self.moves_history.append(move_str)
+        self.current_turn = "black" if self.current_turn == "white" else "white"
+        return True
+
+    def play_book_move(self) -> Optional[str]:
+        """Если ходит AI и позиция есть в дебютной книге, делает ход из книги и возвращает его в SAN"""
+        current_player = self.white_player if self.current_turn == "white" else self.black_player
+        if current_player != "AI":
+            return None
+        move = OPENING_BOOK.move(self.board)
+        if move is None:
+            return None
+        san = self.board.san(move)
+        self.move(san)
+        return san
+
+    def remaining(self, color: chess.Color) -> float:
+        """Оставшееся время стороны с учётом идущего хода"""
+        left = self.clocks[color]
+        if color == self.board.turn and self.flagged is None:
+            left -= time.time() - self.turn_started
+        return max(left, 0.0)
+
+    def flag_at(self) -> Optional[float]:
+        """Момент (time.time()), когда упадёт флажок стороны на ходу"""
+        if not self.time_control or self.flagged is not None:
+            return None
+        return self.turn_started + self.clocks[self.board.turn]
+
+    def clock_text(self) -> str:
+        def fmt(seconds: float) -> str:
+            minutes, seconds = divmod(int(seconds), 60)
+            return f"{minutes:02}:{seconds:02}"
+        return f"⏱ Белые {fmt(self.remaining(chess.WHITE))} | Чёрные {fmt(self.remaining(chess.BLACK))}"
 
     def winner(self) -> Optional[str]:
         """Определяет победителя игры"""
-        if self.board.is_checkmate():
+        if self.flagged is not None:
+            # Флажок не приносит победу, если у соперника не хватает материала для мата
+            if self.board.has_insufficient_material(not self.flagged):
+                return "Draw"
+            return self.black_player if self.flagged == chess.WHITE else self.white_player
+        status = self.status()
+        if status.is_checkmate:
             return self.white_player if self.current_turn == "black" else self.black_player
-        if self.board.is_stalemate() or self.board.is_insufficient_material():
+        if status.is_stalemate or status.is_insufficient_material:
             return "Draw"
         return None
 
     def get_game_status(self) -> str:
         """Возвращает текстовое состояние игры"""
-        if self.board.is_checkmate():
+        if self.flagged is not None:
+            return "Время вышло у " + ("белых" if self.flagged == chess.WHITE else "чёрных") + "!"
+        status = self.status()
+        if status.is_checkmate:
             return "Мат! Победитель: " + ("Белые" if self.current_turn == "black" else "Чёрные")
-        if self.board.is_stalemate():
+        if status.is_stalemate:
             return "Пат - ничья!"
-        if self.board.is_insufficient_material():
+        if status.is_insufficient_material:
             return "Недостаточно материала для мата - ничья!"
-        if self.board.is_check():
+        if status.is_check:
             return "Шах!"
         return "Игра продолжается"
 
     def get_game_duration(self) -> str:
         """Возвращает продолжительность игры"""
         duration = datetime.now() - self.start_time
-        hours, remainder = divmod(duration.seconds, 3600)
+        hours, remainder = divmod(int(duration.total_seconds()), 3600)
         minutes, seconds = divmod(remainder, 60)
         return f"{hours:02}:{minutes:02}:{seconds:02}"
 
+    def result(self) -> str:
+        """Результат в нотации PGN: "1-0", "0-1", "1/2-1/2" или "*" """
+        if self.flagged is not None:
+            if self.board.has_insufficient_material(not self.flagged):
+                return "1/2-1/2"
+            return "0-1" if self.flagged == chess.WHITE else "1-0"
+        status = self.status()
+        if status.is_checkmate:
+            return "0-1" if self.board.turn == chess.WHITE else "1-0"
+        if status.is_stalemate or status.is_insufficient_material:
+            return "1/2-1/2"
+        return "*"
+
+    def pack_moves(self) -> bytes:
+        """Ходы партии по 2 байта: откуда | куда << 6 | фигура превращения << 12"""
+        codes = [m.from_square | m.to_square << 6 | (m.promotion or 0) << 12 for m in self.board.move_stack]
+        return struct.pack(f"<{len(codes)}H", *codes)
+
+    @staticmethod
+    def unpack_moves(packed: bytes) -> list:
+        return [
+            chess.Move(code & 0x3F, (code >> 6) & 0x3F, (code >> 12) or None)
+            for code in struct.unpack(f"<{len(packed) // 2}H", packed)
+        ]
+
+    def archive_record(self) -> list:
+        """Запись завершённой партии для GameArchive"""
+        return [
+            "chess", to_timestamp(datetime.now()), self.white_id, self.black_id, self.white_player,
+            self.black_player, self.result(), self.pack_moves(),
+            int((datetime.now() - self.start_time).total_seconds()), [self.time_control, self.opening],
+        ]
+
+    def to_state(self) -> list:
+        """Компактное состояние для выгрузки на диск: начальная позиция и ходы в SAN"""
+        root = self.board.root()
+        replay = root.copy(stack=False)
+        san_moves = []
+        for move in self.board.move_stack:
+            san_moves.append(replay.san(move))
+            replay.push(move)
+        return [
+            "chess", self.white_player, self.black_player, to_timestamp(self.start_time),
+            root.fen(), san_moves, self.moves_history, self.message_id,
+            [
+                self.time_control, self.clocks[chess.WHITE], self.clocks[chess.BLACK],
+                self.turn_started, self.flag_at(),
+            ] if self.time_control else None,
+            [self.white_id, self.black_id],
+        ]
+
+    @classmethod
+    def from_state(cls, state: list) -> "ChessGame":
+        game = cls(state[1], state[2])
+        game.start_time = from_timestamp(state[3])
+        game.board = chess.Board(state[4])
+        for san in state[5]:
+            game.board.push_san(san)
+            game.opening = OPENING_BOOK.opening_name(game.board) or game.opening
+        game._status = None
+        game.moves_history = list(state[6])
+        game.current_turn = "white" if game.board.turn == chess.WHITE else "black"
+        game.message_id = state[7] if len(state) > 7 else None
+        if len(state) > 8 and state[8]:
+            game.time_control, white_left, black_left, game.turn_started, _ = state[8]
+            game.increment = CHESS_TIME_CONTROLS[game.time_control][1]
+            game.clocks = {chess.WHITE: white_left, chess.BLACK: black_left}
+        if len(state) > 9:
+            game.white_id, game.black_id = state[9]
+        return game
+
+    @staticmethod
+    def flag_at_from_state(state: list) -> Optional[float]:
+        """Момент падения флажка из выгруженного состояния, без восстановления партии"""
+        if state[0] == "chess" and len(state) > 8 and state[8]:
+            return state[8][4]
+        return None
+
+
+# Индекс задач: MAGIC | заголовок | каталог (JSON) | смещения строк CSV (uint64), сгруппированные по теме и рейтингу
+PUZZLE_INDEX_MAGIC = b"PKPZ"
+_PUZZLE_INDEX_HEADER = struct.Struct("<4sIQQQ")  # magic, ширина диапазона, размер и mtime CSV, длина каталога
+
+
+# Класс для базы шахматных задач: случайная задача по рейтингу и теме за O(1) через mmap
+class PuzzleDatabase:
+    def __init__(self, path: str = PUZZLES_FILE, band: int = PUZZLE_RATING_BAND):
+        self.path = path
+        self.index_path = path + ".idx"
+        self.band = band
+        self._opened = False
+        self._source = None  # mmap CSV с задачами
+        self._offsets = None  # np.memmap смещений строк
+        self._directory = {}  # тема -> {диапазон рейтинга: (начало, количество)}
+        self._bands = {}  # тема -> отсортированные непустые диапазоны
+
+    def open(self) -> bool:
+        """Открывает базу, если индекс построен для текущей версии CSV"""
+        if self._opened:
+            return self._offsets is not None
+        self._opened = True
+        try:
+            stat = os.stat(self.path)
+            with open(self.index_path, "rb") as file:
+                magic, band, size, mtime, dir_length = _PUZZLE_INDEX_HEADER.unpack(
+                    file.read(_PUZZLE_INDEX_HEADER.size))
+                if magic != PUZZLE_INDEX_MAGIC or size != stat.st_size or mtime != stat.st_mtime_ns:
+                    logger.warning(
+                        "Puzzle index %s is stale, run: python main.py build_puzzle_index", self.index_path
+                    )
+                    return False
+                directory = json.loads(file.read(dir_length).decode("utf-8"))
+            data_offset = (_PUZZLE_INDEX_HEADER.size + dir_length + 7) // 8 * 8
+            count = (os.path.getsize(self.index_path) - data_offset) // 8
+            if not count:
+                return False
+            self.band = band
+            self._directory = {
+                theme: {int(band_id): tuple(span) for band_id, span in bands.items()}
+                for theme, bands in directory.items()
+            }
+            self._bands = {theme: sorted(bands) for theme, bands in self._directory.items()}
+            self._offsets = np.memmap(self.index_path, dtype="<u8", mode="r", offset=data_offset, shape=(count,))
+            with open(self.path, "rb") as file:
+                self._source = mmap.mmap(file.fileno(), 0, access=mmap.ACCESS_READ)
+        except FileNotFoundError:
+            return False
+        except (OSError, ValueError, struct.error) as e:
+            logger.error("Error opening puzzle database %s: %s", self.path, e)
+            self._offsets = self._source = None
+            return False
+        return True
+
+    def build_index(self) -> int:
+        """Один проход по CSV: смещения строк группируются по теме и диапазону рейтинга"""
+        stat = os.stat(self.path)
+        groups = defaultdict(lambda: array.array("Q"))
+        count = 0
+        with open(self.path, "rb") as file:
+            offset = 0
+            for raw in file:
+                fields = raw.split(b",")
+                if len(fields) > 7 and fields[0] != b"PuzzleId":
+                    try:
+                        band_id = int(fields[3]) // self.band
+                    except ValueError:
+                        band_id = None
+                    if band_id is not None:
+                        groups[("all", band_id)].append(offset)
+                        for theme in fields[7].decode("utf-8").split():
+                            groups[(theme, band_id)].append(offset)
+                        count += 1
+                offset += len(raw)
+
+        directory = defaultdict(dict)
+        start = 0
+        for theme, band_id in sorted(groups):
+            size = len(groups[(theme, band_id)])
+            directory[theme][band_id] = (start, size)
+            start += size
+        dir_bytes = json.dumps(directory, ensure_ascii=False).encode("utf-8")
+        padding = -(_PUZZLE_INDEX_HEADER.size + len(dir_bytes)) % 8
+
+        tmp_path = self.index_path + ".tmp"
+        with open(tmp_path, "wb") as file:
+            file.write(_PUZZLE_INDEX_HEADER.pack(
+                PUZZLE_INDEX_MAGIC, self.band, stat.st_size, stat.st_mtime_ns, len(dir_bytes)))
+            file.write(dir_bytes + b"\0" * padding)
+            for key in sorted(groups):
+                offsets = groups.pop(key)
+                if sys.byteorder == "big":
+                    offsets.byteswap()
+                file.write(offsets.tobytes())
+        os.replace(tmp_path, self.index_path)
+        self._opened = False
+        return count
+
+    def themes(self) -> list:
+        self.open()
+        return sorted(theme for theme in self._directory if theme != "all")
+
+    def random(self, rating: Optional[int] = None, theme: Optional[str] = None) -> Optional[Dict[str, Any]]:
+        """Случайная задача из ближайшего к rating непустого диапазона"""
+        if not self.open():
+            return None
+        bands = self._bands.get(theme or "all")
+        if not bands:
+            return None
+        if rating is None:
+            band_id = random.choice(bands)
+        else:
+            target = rating // self.band
+            pos = bisect.bisect_left(bands, target)
+            candidates = bands[max(pos - 1, 0):pos + 1]
+            band_id = min(candidates, key=lambda b: abs(b - target))
+        start, size = self._directory[theme or "all"][band_id]
+        return self._read(int(self._offsets[start + random.randrange(size)]))
+
+    def _read(self, offset: int) -> Dict[str, Any]:
+        end = self._source.find(b"\n", offset)
+        fields = self._source[offset:end if end != -1 else len(self._source)].decode("utf-8").rstrip("\r").split(",")
+        return {
+            "id": fields[0],
+            "fen": fields[1],
+            "moves": fields[2].split(),
+            "rating": int(fields[3]),
+            "themes": fields[7].split(),
+        }
+
+    def stats(self) -> Dict[str, int]:
+        return {
+            "puzzles": sum(size for _, size in self._directory.get("all", {}).values()),
+            "themes": max(len(self._directory) - 1, 0),
+        }
+
+
+PUZZLES = PuzzleDatabase()
+
+
+# Класс для шахматной задачи: первый ход решения делает соперник, дальше игрок ищет ходы
+class PuzzleGame(ChessGame):
+    def __init__(self, player: str, puzzle: Dict[str, Any]):
+        super().__init__(player, "Задача")
+        self.puzzle_id = puzzle["id"]
+        self.rating = puzzle["rating"]
+        self.themes = puzzle["themes"]
+        self.solution = puzzle["moves"]
+        self.board = chess.Board(puzzle["fen"])
+        self.board.push_uci(self.solution[0])
+        self.player_color = self.board.turn
+        self.progress = 1  # Индекс следующего хода решения
+        self.mistakes = 0
+        self.current_turn = "white" if self.board.turn == chess.WHITE else "black"
+
+    @property
+    def orientation(self) -> chess.Color:
+        return self.player_color
+
+    def _advance(self, move: chess.Move) -> None:
+        self.board.push(move)
+        self._status = None
+        self.progress += 1
+        self.current_turn = "white" if self.board.turn == chess.WHITE else "black"
+
+    def solve(self, move_str: str) -> str:
+        """Проверяет ход игрока: "illegal", "wrong", "correct" (соперник ответил) или "solved" """
+        move = self.status().find(move_str.strip())
+        if move is None:
+            return "illegal"
+        expected = chess.Move.from_uci(self.solution[self.progress])
+        if move != expected:
+            # Любой мат засчитывается, даже если он не совпадает с ходом из базы
+            self.board.push(move)
+            is_mate = self.board.is_checkmate()
+            self.board.pop()
+            if not is_mate:
+                self.mistakes += 1
+                return "wrong"
+            self.progress = len(self.solution) - 1
+        self.moves_history.append(move_str)
+        self._advance(move)
+        if self.progress >= len(self.solution):
+            return "solved"
+        self._advance(chess.Move.from_uci(self.solution[self.progress]))
+        return "correct"
+
+    def last_reply(self) -> str:
+        """Последний ответ соперника в SAN"""
+        move = self.board.pop()
+        san = self.board.san(move)
+        self.board.push(move)
+        return san
+
+    def to_state(self) -> list:
+        return [
+            "puzzle", self.white_player, to_timestamp(self.start_time), self.puzzle_id, self.rating,
+            self.themes, self.board.root().fen(), self.solution, self.progress, self.mistakes,
+            self.moves_history, self.message_id,
+        ]
+
+    @classmethod
+    def from_state(cls, state: list) -> "PuzzleGame":
+        puzzle = {"id": state[3], "rating": state[4], "themes": state[5], "fen": state[6], "moves": state[7]}
+        game = cls(state[1], puzzle)
+        game.start_time = from_timestamp(state[2])
+        for uci in state[7][1:state[8]]:
+            game._advance(chess.Move.from_uci(uci))
+        game.mistakes = state[9]
+        game.moves_history = list(state[10])
+        game.message_id = state[11]
+        return game
+
 
 # Класс для игры в шашки
 class CheckersGame:
-    def __init__(self, player1: str, player2: str):
+    def __init__(self, player1: str, player2: str, ai_depth: int = CHECKERS_AI_DEPTH):
         self.board = self.create_board()
         self.player1 = player1
         self.player2 = player2
+        self.player1_id = None  # Telegram id игроков; None - AI
+        self.player2_id = None
         self.current_player = player1
         self.moves_history = []
         self.start_time = datetime.now()
+        self.ai_depth = ai_depth
 
     @staticmethod
     def create_board() -> Dict[str, Any]:
@@ -348,47 +3665,614 @@ class CheckersGame:
                     board[f"{row}{col}"] = None
         return board
 
-    def move(self, from_pos: str, to_pos: str) -> bool:
-        """Пытается выполнить ход, возвращает успешность выполнения"""
-        # Упрощенная логика хода (без учета правил шашек)
-        if from_pos in self.board and to_pos in self.board:
-            piece = self.board[from_pos]
-            if piece and ((piece["player"] == 1 and self.current_player == self.player1) or
-                          (piece["player"] == 2 and self.current_player == self.player2)):
-                self.board[to_pos] = piece
-                self.board[from_pos] = None
-                self.moves_history.append(f"{from_pos}-{to_pos}")
-                self.current_player = self.player2 if self.current_player == self.player1 else self.player1
-                return True
-        return False
+    def current_number(self) -> int:
+        """Номер игрока на ходу: 1 или 2"""
+        return 1 if self.current_player == self.player1 else 2
+
+    def engine_board(self) -> list:
+        """Доска в формате checkers_engine: 64 кода клеток"""
+        board = [0] * 64
+        for pos, piece in self.board.items():
+            if piece:
+                board[int(pos[0]) * 8 + int(pos[1])] = self._PIECE_CODES[(piece["player"], piece["type"])]
+        return board
+
+    def legal_moves(self) -> list:
+        """Ходы по правилам русских шашек: взятие обязательно, дамки ходят на любое расстояние"""
+        moves, _ = checkers_engine.generate_moves(self.engine_board(), self.current_number())
+        return moves
+
+    def move(self, from_pos: str, to_pos: str) -> bool:
+        """Пытается выполнить ход, возвращает успешность выполнения"""
+        if from_pos not in self.board or to_pos not in self.board:
+            return False
+        start = int(from_pos[0]) * 8 + int(from_pos[1])
+        end = int(to_pos[0]) * 8 + int(to_pos[1])
+        # Для серии взятий достаточно начальной и конечной клетки; из совпадающих выбирается самая длинная
+        candidates = [move for move in self.legal_moves() if move[0][0] == start and move[0][-1] == end]
+        if not candidates:
+            return False
+        self.apply_move(max(candidates, key=lambda move: len(move[1])))
+        return True
+
+    def apply_move(self, move: tuple) -> None:
+        """Применяет ход движка: (путь, побитые клетки, код фигуры после хода)"""
+        path, captured, new_code = move
+        start, end = (f"{square // 8}{square % 8}" for square in (path[0], path[-1]))
+        self.board[start] = None
+        player, piece_type = self._CODE_PIECES[new_code]
+        self.board[end] = {"type": piece_type, "player": player}
+        for square in captured:
+            self.board[f"{square // 8}{square % 8}"] = None
+        self.moves_history.append(f"{start}-{end}")
+        self.current_player = self.player2 if self.current_player == self.player1 else self.player1
+
+    def show_board(self) -> str:
+        """Генерирует ASCII-представление доски"""
+        board_str = "  0 1 2 3 4 5 6 7\n"
+        for row in range(8):
+            board_str += f"{row} "
+            for col in range(8):
+                pos = f"{row}{col}"
+                piece = self.board[pos]
+                if piece is None:
+                    board_str += ". "
+                elif piece["player"] == 1:
+                    board_str += "○ " if piece["type"] == "pawn" else "Ⓞ "
+                else:
+                    board_str += "● " if piece["type"] == "pawn" else "◉ "
+            board_str += "\n"
+        return board_str
+
+    # Коды клеток в упакованной доске: 0 - пусто, 1/2 - шашка/дамка игрока 1, 3/4 - игрока 2
+    _PIECE_CODES = {(1, "pawn"): 1, (1, "king"): 2, (2, "pawn"): 3, (2, "king"): 4}
+    _CODE_PIECES = {code: piece for piece, code in _PIECE_CODES.items()}
+    _DARK_SQUARES = [f"{row}{col}" for row in range(8) for col in range(8) if (row + col) % 2 == 1]
+
+    def pack_board(self) -> bytes:
+        """Упаковывает 32 тёмные клетки по 4 бита: 16 байт на доску"""
+        codes = [
+            self._PIECE_CODES[(piece["player"], piece["type"])] if piece else 0
+            for piece in (self.board[pos] for pos in self._DARK_SQUARES)
+        ]
+        return bytes((codes[i] << 4) | codes[i + 1] for i in range(0, len(codes), 2))
+
+    @classmethod
+    def unpack_board(cls, packed: bytes) -> Dict[str, Any]:
+        board = {f"{row}{col}": None for row in range(8) for col in range(8)}
+        for idx, byte in enumerate(packed):
+            for offset, code in ((0, byte >> 4), (1, byte & 0x0F)):
+                if code:
+                    player, piece_type = cls._CODE_PIECES[code]
+                    board[cls._DARK_SQUARES[idx * 2 + offset]] = {"type": piece_type, "player": player}
+        return board
+
+    def to_state(self) -> list:
+        """Компактное состояние для выгрузки на диск"""
+        return [
+            "checkers", self.player1, self.player2, to_timestamp(self.start_time),
+            self.pack_board(), self.current_player == self.player1, self.moves_history,
+            [self.player1_id, self.player2_id], self.ai_depth,
+        ]
+
+    @classmethod
+    def from_state(cls, state: list) -> "CheckersGame":
+        game = cls(state[1], state[2])
+        game.start_time = from_timestamp(state[3])
+        game.board = cls.unpack_board(state[4])
+        game.current_player = game.player1 if state[5] else game.player2
+        game.moves_history = list(state[6])
+        if len(state) > 7:
+            game.player1_id, game.player2_id = state[7]
+        if len(state) > 8:
+            game.ai_depth = state[8]
+        return game
+
+    def archive_record(self) -> list:
+        """Запись завершённой партии для GameArchive; ходы по 2 байта (откуда, куда)"""
+        winner = self.winner()
+        result = "1-0" if winner == self.player1 else "0-1" if winner == self.player2 else "*"
+        moves = bytes(int(pos) for move in self.moves_history for pos in move.split("-"))
+        return [
+            "checkers", to_timestamp(datetime.now()), self.player1_id, self.player2_id, self.player1,
+            self.player2, result, moves, int((datetime.now() - self.start_time).total_seconds()), [],
+        ]
+
+    def winner(self) -> Optional[str]:
+        """Определяет победителя игры"""
+        p1_pieces = sum(1 for piece in self.board.values() if piece and piece["player"] == 1)
+        p2_pieces = sum(1 for piece in self.board.values() if piece and piece["player"] == 2)
+
+        if p1_pieces == 0:
+            return self.player2
+        if p2_pieces == 0:
+            return self.player1
+        # Игрок, которому некуда ходить, проигрывает
+        if not self.legal_moves():
+            return self.player2 if self.current_player == self.player1 else self.player1
+        return None
+
+
+# Класс для управления играми: неактивные партии выгружаются на диск
+class GameManager:
+    GAME_TYPES = {"chess": ChessGame, "puzzle": PuzzleGame, "checkers": CheckersGame}
+
+    def __init__(self, directory: str = GAMES_DIR, max_live: int = GAME_MAX_LIVE,
+                 idle_timeout: float = GAME_IDLE_TIMEOUT, max_age: float = GAME_MAX_AGE):
+        self.directory = directory
+        self.max_live = max_live
+        self.idle_timeout = idle_timeout
+        self.max_age = max_age
+        self._live = OrderedDict()  # gid -> игра, в порядке последней активности
+        self._last_active = {}
+        self._hibernated = {}  # gid -> время последней активности
+        self.hibernations = 0
+        self.revivals = 0
+        self.purged = 0
+        os.makedirs(directory, exist_ok=True)
+        for name in os.listdir(directory):
+            if name.endswith(".game"):
+                path = os.path.join(directory, name)
+                self._hibernated[name[:-5]] = os.path.getmtime(path)
+
+    def _path(self, gid: str) -> str:
+        return os.path.join(self.directory, f"{gid}.game")
+
+    def _touch(self, gid: str) -> None:
+        self._last_active[gid] = time.time()
+        self._live.move_to_end(gid)
+
+    def hibernate(self, gid: str) -> None:
+        """Записывает партию на диск и убирает её из памяти"""
+        game = self._live.pop(gid)
+        last_active = self._last_active.pop(gid)
+        path = self._path(gid)
+        try:
+            with open(path + ".tmp", "wb") as file:
+                file.write(encode_record(RECORD_GAME, gid, game.to_state()))
+            os.replace(path + ".tmp", path)
+            os.utime(path, (last_active, last_active))
+        except OSError as e:
+            logger.error("Error hibernating game %s: %s", gid, e)
+            self._live[gid] = game
+            self._last_active[gid] = last_active
+            return
+        self._hibernated[gid] = last_active
+        self.hibernations += 1
+
+    def _read_state(self, gid: str) -> list:
+        with open(self._path(gid), "rb") as file:
+            raw = file.read()
+        length, pos = _read_varint(raw, 0)
+        _, _, state = decode_record(raw[pos:pos + length])
+        return state
+
+    def hibernated_states(self):
+        """Состояния выгруженных партий без их восстановления: (gid, состояние)"""
+        for gid in list(self._hibernated):
+            try:
+                yield gid, self._read_state(gid)
+            except (OSError, IndexError, ValueError) as e:
+                logger.error("Error reading hibernated game %s: %s", gid, e)
+
+    def _revive(self, gid: str) -> bool:
+        if gid not in self._hibernated:
+            return False
+        try:
+            state = self._read_state(gid)
+            game = self.GAME_TYPES[state[0]].from_state(state)
+        except (OSError, KeyError, IndexError, ValueError) as e:
+            logger.error("Error reviving game %s: %s", gid, e)
+            self._drop_file(gid)
+            return False
+        self._drop_file(gid)
+        self._live[gid] = game
+        self._touch(gid)
+        self.revivals += 1
+        self._enforce_limit()
+        return True
+
+    def _drop_file(self, gid: str) -> None:
+        self._hibernated.pop(gid, None)
+        try:
+            os.remove(self._path(gid))
+        except FileNotFoundError:
+            pass
+
+    def _enforce_limit(self) -> None:
+        while len(self._live) > self.max_live:
+            self.hibernate(next(iter(self._live)))
+
+    def __contains__(self, gid: str) -> bool:
+        return gid in self._live or gid in self._hibernated
+
+    def __getitem__(self, gid: str):
+        if gid not in self._live and not self._revive(gid):
+            raise KeyError(gid)
+        self._touch(gid)
+        return self._live[gid]
+
+    def get(self, gid: str, default=None):
+        try:
+            return self[gid]
+        except KeyError:
+            return default
+
+    def __setitem__(self, gid: str, game) -> None:
+        self._drop_file(gid)
+        self._live[gid] = game
+        self._touch(gid)
+        self._enforce_limit()
+
+    def __delitem__(self, gid: str) -> None:
+        if gid not in self:
+            raise KeyError(gid)
+        self._live.pop(gid, None)
+        self._last_active.pop(gid, None)
+        self._drop_file(gid)
+
+    def __len__(self) -> int:
+        return len(self._live) + len(self._hibernated)
+
+    def maintain(self) -> None:
+        """Выгружает простаивающие партии и удаляет давно заброшенные"""
+        now = time.time()
+        for gid in [gid for gid in self._live if now - self._last_active[gid] > self.idle_timeout]:
+            self.hibernate(gid)
+        for gid in [gid for gid, active in self._hibernated.items() if now - active > self.max_age]:
+            self._drop_file(gid)
+            self.purged += 1
+
+    def close(self) -> None:
+        """Выгружает все партии перед остановкой, чтобы они пережили перезапуск"""
+        for gid in list(self._live):
+            self.hibernate(gid)
+
+    def stats(self) -> Dict[str, int]:
+        return {
+            "live": len(self._live),
+            "hibernated": len(self._hibernated),
+            "hibernations": self.hibernations,
+            "revivals": self.revivals,
+            "purged": self.purged,
+        }
+
+
+GAME_STATES = GameManager()
+
+
+# Класс для шахматных часов: один таймер событийного цикла на партию вместо периодического опроса
+class ChessClocks:
+    def __init__(self):
+        self._timers = {}  # gid -> asyncio.TimerHandle
+        self._tasks = set()
+        self.flag_falls = 0
+
+    def schedule(self, gid: str, game: ChessGame) -> None:
+        """Переставляет таймер флажка партии после хода"""
+        self.cancel(gid)
+        flag_at = game.flag_at()
+        if flag_at is not None:
+            self._schedule_at(gid, flag_at)
+
+    def _schedule_at(self, gid: str, flag_at: float) -> None:
+        loop = asyncio.get_running_loop()
+        self._timers[gid] = loop.call_later(max(flag_at - time.time(), 0), self._fire, gid)
+
+    def cancel(self, gid: str) -> None:
+        handle = self._timers.pop(gid, None)
+        if handle:
+            handle.cancel()
+
+    def _fire(self, gid: str) -> None:
+        self._timers.pop(gid, None)
+        task = asyncio.create_task(on_flag_fall(gid))
+        self._tasks.add(task)
+        task.add_done_callback(self._tasks.discard)
+
+    def restore(self) -> None:
+        """Ставит таймеры партиям, пережившим перезапуск; партии восстанавливаются только при срабатывании"""
+        for gid, state in GAME_STATES.hibernated_states():
+            flag_at = ChessGame.flag_at_from_state(state)
+            if flag_at is not None:
+                self._schedule_at(gid, flag_at)
+
+    def close(self) -> None:
+        for gid in list(self._timers):
+            self.cancel(gid)
+
+    def __len__(self) -> int:
+        return len(self._timers)
+
+
+CHESS_CLOCKS = ChessClocks()
+
+
+# Файлы архива партий:
+#   games.dat   - блоки: длина (uint32) | zlib(записи encode_record, по ARCHIVE_BLOCK_GAMES партий)
+#   games.idx   - по записи _ARCHIVE_GAME_ENTRY на каждую партию в блоках, номер партии = номер записи
+#   players.idx - по записи _ARCHIVE_PLAYER_ENTRY на каждого игрока партии, с рейтингом после неё
+#   games.tail  - партии, ещё не собранные в блок (несжатые записи)
+_ARCHIVE_BLOCK_HEADER = struct.Struct("<I")
+_ARCHIVE_GAME_ENTRY = struct.Struct("<QHq")  # смещение блока, позиция в блоке, время окончания
+_ARCHIVE_PLAYER_ENTRY = struct.Struct("<qQiBB")  # id игрока, номер партии, рейтинг, вид игры, очки (0/1/2)
+ARCHIVE_KINDS = ("chess", "checkers")
+_ARCHIVE_RESULT_SCORES = {"1-0": (2, 0), "0-1": (0, 2), "1/2-1/2": (1, 1)}
+
+
+# Класс для архива завершённых партий: блоки сжаты, запросы идут через индексы по игроку и номеру партии
+class GameArchive:
+    def __init__(self, directory: str = ARCHIVE_DIR, block_games: int = ARCHIVE_BLOCK_GAMES):
+        self.directory = directory
+        self.block_games = block_games
+        self.data_path = os.path.join(directory, "games.dat")
+        self.index_path = os.path.join(directory, "games.idx")
+        self.players_path = os.path.join(directory, "players.idx")
+        self.tail_path = os.path.join(directory, "games.tail")
+        self._block_offsets = array.array("Q")  # номер партии -> смещение блока
+        self._block_positions = array.array("H")
+        self._finished = array.array("q")  # номер партии -> время окончания
+        self._pending = []  # записи партий из games.tail
+        self._players = defaultdict(lambda: array.array("Q"))  # id игрока -> номера партий по возрастанию
+        self._ratings = {}  # (id игрока, вид игры) -> рейтинг
+        self._scores = {}  # (id игрока, вид игры) -> [победы, ничьи, поражения]
+        self._blocks = OrderedDict()  # LRU распакованных блоков
+        self.block_reads = 0
+        self._loaded = False
+        self._lock = None  # Создаётся в цикле событий; дозаписи в файлы архива идут по одной
+
+    def load(self) -> None:
+        """Читает индексы архива; при запуске вызывается в рабочем потоке"""
+        if self._loaded:
+            return
+        self._loaded = True
+        os.makedirs(self.directory, exist_ok=True)
+        if os.path.exists(self.index_path):
+            with open(self.index_path, "rb") as file:
+                raw = file.read()
+            usable = len(raw) - len(raw) % _ARCHIVE_GAME_ENTRY.size
+            for offset, position, finished in _ARCHIVE_GAME_ENTRY.iter_unpack(raw[:usable]):
+                self._block_offsets.append(offset)
+                self._block_positions.append(position)
+                self._finished.append(finished)
+        if os.path.exists(self.tail_path):
+            with open(self.tail_path, "rb") as file:
+                raw = file.read()
+            for game_no, record in self._iter_records(raw):
+                # Записи, уже собранные в блок до сбоя, пропускаются
+                if game_no == len(self._finished) + len(self._pending):
+                    self._pending.append(record)
+        if os.path.exists(self.players_path):
+            with open(self.players_path, "rb") as file:
+                raw = file.read()
+            usable = len(raw) - len(raw) % _ARCHIVE_PLAYER_ENTRY.size
+            for player_id, game_no, rating, kind, score in _ARCHIVE_PLAYER_ENTRY.iter_unpack(raw[:usable]):
+                self._apply(player_id, game_no, rating, ARCHIVE_KINDS[kind], score)
+
+    @staticmethod
+    def _iter_records(raw: bytes):
+        pos = 0
+        while pos < len(raw):
+            try:
+                length, start = _read_varint(raw, pos)
+                _, key, record = decode_record(raw[start:start + length])
+            except (IndexError, ValueError):
+                return  # Оборванная последняя запись
+            pos = start + length
+            yield int(key), record
+
+    def _apply(self, player_id: int, game_no: int, rating: int, kind: str, score: int) -> None:
+        self._players[player_id].append(game_no)
+        self._ratings[(player_id, kind)] = rating
+        scores = self._scores.setdefault((player_id, kind), [0, 0, 0])
+        scores[2 - score] += 1
+
+    def __len__(self) -> int:
+        self.load()
+        return len(self._finished) + len(self._pending)
+
+    def rating(self, player_id: Optional[int], kind: str) -> int:
+        self.load()
+        if player_id is None:
+            return ELO_AI
+        return self._ratings.get((player_id, kind), ELO_START)
+
+    def scores(self, player_id: int, kind: str) -> list:
+        self.load()
+        return list(self._scores.get((player_id, kind), [0, 0, 0]))
+
+    def top(self, kind: str, limit: int = 10) -> list:
+        self.load()
+        return heapq.nlargest(
+            limit, ((rating, pid) for (pid, game_kind), rating in self._ratings.items() if game_kind == kind)
+        )
+
+    async def add(self, record: list) -> Dict[Optional[int], int]:
+        """Добавляет завершённую партию и пересчитывает Эло игроков, возвращает изменения рейтинга.
+
+        Рейтинги считаются в цикле событий, дозапись файлов идёт в рабочем потоке;
+        состояние в памяти меняется только после успешной записи.
+        """
+        if self._lock is None:
+            self._lock = asyncio.Lock()
+        async with self._lock:
+            self.load()
+            game_no = len(self)
+            changes, entries, applied = self._rate(record, game_no)
+            await asyncio.to_thread(self._append, game_no, record, entries)
+            self._pending.append(record)
+            for args in applied:
+                self._apply(*args)
+            if len(self._pending) >= self.block_games:
+                await self._seal()
+        return changes
+
+    def _rate(self, record: list, game_no: int) -> tuple:
+        """Новые рейтинги по Эло: (изменения, записи players.idx, аргументы _apply)"""
+        kind, white_id, black_id, result = record[0], record[2], record[3], record[6]
+        changes, entries, applied = {}, bytearray(), []
+        if result in _ARCHIVE_RESULT_SCORES:
+            white_rating, black_rating = self.rating(white_id, kind), self.rating(black_id, kind)
+            for player_id, rating, opponent, score in (
+                (white_id, white_rating, black_rating, _ARCHIVE_RESULT_SCORES[result][0]),
+                (black_id, black_rating, white_rating, _ARCHIVE_RESULT_SCORES[result][1]),
+            ):
+                if player_id is None:
+                    continue
+                expected = 1 / (1 + 10 ** ((opponent - rating) / 400))
+                new_rating = round(rating + ELO_K * (score / 2 - expected))
+                changes[player_id] = new_rating - rating
+                entries += _ARCHIVE_PLAYER_ENTRY.pack(player_id, game_no, new_rating, ARCHIVE_KINDS.index(kind), score)
+                applied.append((player_id, game_no, new_rating, kind, score))
+        return changes, bytes(entries), applied
+
+    def _append(self, game_no: int, record: list, entries: bytes) -> None:
+        with open(self.tail_path, "ab") as file:
+            file.write(encode_record(RECORD_GAME, str(game_no), record))
+        if entries:
+            with open(self.players_path, "ab") as file:
+                file.write(entries)
+
+    async def _seal(self) -> None:
+        """Сжимает накопленные партии в блок и очищает games.tail (вызывается под _lock)"""
+        pending = list(self._pending)
+        offset = await asyncio.to_thread(self._write_block, len(self._finished), pending)
+        for idx, record in enumerate(pending):
+            self._block_offsets.append(offset)
+            self._block_positions.append(idx)
+            self._finished.append(record[1])
+        del self._pending[:len(pending)]
+
+    def _write_block(self, first: int, pending: list) -> int:
+        payload = bytearray()
+        for idx, record in enumerate(pending):
+            payload += encode_record(RECORD_GAME, str(first + idx), record)
+        block = zlib.compress(bytes(payload), 6)
+        with open(self.data_path, "ab") as file:
+            offset = file.seek(0, os.SEEK_END)
+            file.write(_ARCHIVE_BLOCK_HEADER.pack(len(block)) + block)
+            file.flush()
+            os.fsync(file.fileno())
+        entries = b"".join(
+            _ARCHIVE_GAME_ENTRY.pack(offset, idx, record[1]) for idx, record in enumerate(pending)
+        )
+        with open(self.index_path, "ab") as file:
+            file.write(entries)
+            file.flush()
+            os.fsync(file.fileno())
+        open(self.tail_path, "wb").close()
+        return offset
+
+    def _read_block(self, offset: int) -> list:
+        block = self._blocks.get(offset)
+        if block is not None:
+            self._blocks.move_to_end(offset)
+            return block
+        with open(self.data_path, "rb") as file:
+            file.seek(offset)
+            (length,) = _ARCHIVE_BLOCK_HEADER.unpack(file.read(_ARCHIVE_BLOCK_HEADER.size))
+            raw = zlib.decompress(file.read(length))
+        block = [record for _, record in self._iter_records(raw)]
+        self.block_reads += 1
+        self._blocks[offset] = block
+        if len(self._blocks) > 8:
+            self._blocks.popitem(last=False)
+        return block
+
+    def get(self, game_no: int) -> Optional[list]:
+        """Запись партии по номеру: читается и распаковывается только её блок"""
+        self.load()
+        sealed = len(self._finished)
+        if game_no >= sealed:
+            idx = game_no - sealed
+            return self._pending[idx] if idx < len(self._pending) else None
+        try:
+            return self._read_block(self._block_offsets[game_no])[self._block_positions[game_no]]
+        except (OSError, IndexError, ValueError, zlib.error) as e:
+            logger.error("Error reading archived game %s: %s", game_no, e)
+            return None
+
+    def finished_at(self, game_no: int) -> int:
+        sealed = len(self._finished)
+        return self._finished[game_no] if game_no < sealed else self._pending[game_no - sealed][1]
+
+    def player_games(self, player_id: int, page: int = 0, page_size: int = GAMES_PAGE_SIZE,
+                     before: Optional[int] = None) -> tuple:
+        """Страница партий игрока от новых к старым (опционально - закончившихся до before); (номера, всего)"""
+        self.load()
+        games = self._players.get(player_id, ())
+        end = len(games)
+        if before is not None:
+            # Номера партий растут вместе со временем окончания, поэтому подходит бинарный поиск
+            end = bisect.bisect_left(_ArchiveTimes(self, games), before)
+        start = max(end - (page + 1) * page_size, 0)
+        return [games[idx] for idx in range(end - page * page_size - 1, start - 1, -1)], end
+
+    def stats(self) -> Dict[str, int]:
+        self.load()
+        return {
+            "games": len(self),
+            "pending": len(self._pending),
+            "players": len(self._players),
+            "block_reads": self.block_reads,
+        }
+
+
+class _ArchiveTimes:
+    """Время окончания партий игрока как последовательность для bisect"""
+
+    def __init__(self, archive: GameArchive, games):
+        self._archive = archive
+        self._games = games
+
+    def __len__(self):
+        return len(self._games)
+
+    def __getitem__(self, idx: int) -> int:
+        return self._archive.finished_at(self._games[idx])
+
+
+GAME_ARCHIVE = GameArchive()
+
+
+# Класс для AI в шашках: перебор идёт в отдельных процессах и не блокирует обработку сообщений
+class CheckersAI:
+    def __init__(self, workers: int = CHECKERS_AI_WORKERS):
+        self.workers = workers
+        self._pool = None
+        self.thinking = set()  # gid партий, для которых идёт перебор
+        self.searches = 0
+        self.nodes = 0
+        self.search_time = 0.0
 
-    def show_board(self) -> str:
-        """Генерирует ASCII-представление доски"""
-        board_str = "  0 1 2 3 4 5 6 7\n"
-        for row in range(8):
-            board_str += f"{row} "
-            for col in range(8):
-                pos = f"{row}{col}"
-                piece = self.board[pos]
-                if piece is None:
-                    board_str += ". "
-                elif piece["player"] == 1:
-                    board_str += "○ " if piece["type"] == "pawn" else "Ⓞ "
-                else:
-                    board_str += "● " if piece["type"] == "pawn" else "◉ "
-            board_str += "\n"
-        return board_str
+    async def choose_move(self, game: CheckersGame) -> Optional[tuple]:
+        """Лучший ход игрока на ходу по перебору до game.ai_depth"""
+        if self._pool is None:
+            self._pool = ProcessPoolExecutor(max_workers=self.workers)
+        loop = asyncio.get_running_loop()
+        move, _, nodes, elapsed = await loop.run_in_executor(
+            self._pool, checkers_engine.search, game.engine_board(), game.current_number(), game.ai_depth
+        )
+        self.searches += 1
+        self.nodes += nodes
+        self.search_time += elapsed
+        return move
+
+    def close(self) -> None:
+        if self._pool is not None:
+            self._pool.shutdown(wait=False, cancel_futures=True)
+            self._pool = None
+
+    def stats(self) -> Dict[str, float]:
+        return {
+            "searches": self.searches,
+            "thinking": len(self.thinking),
+            "nodes_per_second": self.nodes / self.search_time if self.search_time else 0.0,
+            "avg_time": self.search_time / self.searches if self.searches else 0.0,
+        }
 
-    def winner(self) -> Optional[str]:
-        """Определяет победителя игры (упрощенная версия)"""
-        p1_pieces = sum(1 for piece in self.board.values() if piece and piece["player"] == 1)
-        p2_pieces = sum(1 for piece in self.board.values() if piece and piece["player"] == 2)
 
-        if p1_pieces == 0:
-            return self.player2
-        if p2_pieces == 0:
-            return self.player1
-        return None
+CHECKERS_AI = CheckersAI()
 
 
 # Класс для работы с квизами
@@ -435,90 +4319,262 @@ class QuizManager:
 
 # Класс для работы с напоминаниями
 class ReminderManager:
+    # Очередь (время, user_id) невыполненных напоминаний: проверка не обходит всех пользователей
+    _queue = []
+    _queue_ready = False
+
+    @classmethod
+    def _build_queue(cls) -> None:
+        cls._queue = [
+            (reminder.time, user_id)
+            for user_id, user_data in scan_users()
+            for reminder in user_data.reminders
+            if not reminder.completed
+        ]
+        heapq.heapify(cls._queue)
+        cls._queue_ready = True
+
     @staticmethod
     async def set_reminder(user_id: int, text: str, remind_time: datetime) -> bool:
         """Устанавливает напоминание для пользователя"""
         try:
-            if "reminders" not in users[str(user_id)]:
-                users[str(user_id)]["reminders"] = []
-
-            users[str(user_id)]["reminders"].append({
-                "text": text,
-                "time": remind_time.isoformat(),
-                "created": datetime.now().isoformat(),
-                "completed": False
-            })
+            reminder = ReminderEntry(text, to_timestamp(remind_time), to_timestamp(datetime.now()))
+            users[str(user_id)].reminders.append(reminder)
+            if ReminderManager._queue_ready:
+                heapq.heappush(ReminderManager._queue, (reminder.time, str(user_id)))
             save_data()
             return True
         except Exception as e:
-            logger.error(f"Error setting reminder: {e}")
+            logger.error("Error setting reminder: %s", e)
             return False
 
     @staticmethod
     async def check_reminders() -> None:
         """Проверяет и отправляет напоминания, которые наступили"""
         try:
-            current_time = datetime.now()
-            for user_id, user_data in users.items():
-                if "reminders" not in user_data:
+            if not ReminderManager._queue_ready:
+                ReminderManager._build_queue()
+
+            current_time = to_timestamp(datetime.now())
+            queue = ReminderManager._queue
+            due_users = set()
+            while queue and queue[0][0] <= current_time:
+                due_users.add(heapq.heappop(queue)[1])
+
+            changed = False
+            for user_id in due_users:
+                user_data = users.get(user_id)
+                if not user_data:
                     continue
 
-                for reminder in user_data["reminders"]:
-                    if reminder["completed"]:
+                for reminder in user_data.reminders:
+                    if reminder.completed:
                         continue
 
-                    remind_time = datetime.fromisoformat(reminder["time"])
-                    if remind_time <= current_time:
+                    if reminder.time <= current_time:
                         try:
                             await bot.send_message(
                                 user_id,
-                                f"⏰ Напоминание: {reminder['text']}\n"
-                                f"Установлено: {datetime.fromisoformat(reminder['created']).strftime('%Y-%m-%d %H:%M')}"
+                                f"⏰ Напоминание: {reminder.text}\n"
+                                f"Установлено: {from_timestamp(reminder.created).strftime('%Y-%m-%d %H:%M')}"
                             )
-                            reminder["completed"] = True
+                            reminder.completed = True
+                            changed = True
                         except Exception as e:
-                            logger.error(f"Error sending reminder to {user_id}: {e}")
+                            logger.error("Error sending reminder to %s: %s", user_id, e)
+                            # Повторим попытку при следующей проверке
+                            heapq.heappush(queue, (current_time + 60, user_id))
 
-            save_data()
+            if changed:
+                save_data()
         except Exception as e:
-            logger.error(f"Error checking reminders: {e}")
+            logger.error("Error checking reminders: %s", e)
+
+
+# Класс для аналитики экономики: колонки NumPy, обновляемые при каждой операции
+class EconomyAnalytics:
+    # Категории операций по причине из истории
+    OTHER, BONUS, FERMA, QUIZ, TRANSFER, CHECK, GAME = range(7)
+    LEDGER_WINDOW_DAYS = 30
+
+    def __init__(self):
+        self._reset()
+
+    def _reset(self) -> None:
+        self.ready = False
+        self._rows = {}  # user_id -> строка в колонках
+        self._users = 0
+        self.balances = np.zeros(1024, dtype=np.int64)
+        self.messages = np.zeros(1024, dtype=np.int64)
+        self._ledger = 0
+        self.ledger_time = np.zeros(4096, dtype=np.int64)
+        self.ledger_amount = np.zeros(4096, dtype=np.int64)
+        self.ledger_kind = np.zeros(4096, dtype=np.int8)
+
+    @classmethod
+    def classify(cls, reason: str) -> int:
+        if reason == "Ферма":
+            return cls.FERMA
+        if "викторин" in reason:
+            return cls.QUIZ
+        if reason.startswith("Перевод"):
+            return cls.TRANSFER
+        if "чека" in reason:
+            return cls.CHECK
+        if reason.startswith("Победа"):
+            return cls.GAME
+        if reason == "Начальный бонус":
+            return cls.BONUS
+        return cls.OTHER
+
+    @staticmethod
+    def _grow(array: np.ndarray, size: int) -> np.ndarray:
+        grown = np.zeros(max(size, len(array) * 2), dtype=array.dtype)
+        grown[:len(array)] = array
+        return grown
+
+    def _row(self, user_id: str) -> int:
+        row = self._rows.get(user_id)
+        if row is None:
+            row = self._rows[user_id] = self._users
+            self._users += 1
+            if self._users > len(self.balances):
+                self.balances = self._grow(self.balances, self._users)
+                self.messages = self._grow(self.messages, self._users)
+        return row
+
+    def _append_ledger(self, timestamp: int, amount: int, kind: int) -> None:
+        if self._ledger == len(self.ledger_time):
+            self._trim_ledger()
+        if self._ledger == len(self.ledger_time):
+            self.ledger_time = self._grow(self.ledger_time, self._ledger + 1)
+            self.ledger_amount = self._grow(self.ledger_amount, self._ledger + 1)
+            self.ledger_kind = self._grow(self.ledger_kind, self._ledger + 1)
+        idx = self._ledger
+        self.ledger_time[idx] = timestamp
+        self.ledger_amount[idx] = amount
+        self.ledger_kind[idx] = kind
+        self._ledger += 1
+
+    def _trim_ledger(self) -> None:
+        """Отбрасывает операции старше окна аналитики"""
+        size = self._ledger
+        keep = self.ledger_time[:size] >= to_timestamp(datetime.now()) - self.LEDGER_WINDOW_DAYS * 86400
+        kept = int(keep.sum())
+        if kept == size:
+            return
+        self.ledger_time[:kept] = self.ledger_time[:size][keep]
+        self.ledger_amount[:kept] = self.ledger_amount[:size][keep]
+        self.ledger_kind[:kept] = self.ledger_kind[:size][keep]
+        self._ledger = kept
+
+    async def rebuild(self) -> None:
+        """Собирает колонки одним проходом по пользователям, уступая цикл событий"""
+        self._reset()
+        since = to_timestamp(datetime.now()) - self.LEDGER_WINDOW_DAYS * 86400
+        for count, (user_id, user) in enumerate(scan_users(), 1):
+            row = self._row(user_id)
+            self.balances[row] = user.irisky
+            self.messages[row] = user.messages_count
+            for entry in user.irisky_history:
+                if entry.date >= since:
+                    self._append_ledger(entry.date, entry.amount, self.classify(entry.reason))
+            if count % 10000 == 0:
+                await asyncio.sleep(0)
+        self.ready = True
+        logger.info("Economy analytics built for %s users", self._users)
+
+    def on_record(self, user_id: str, user: UserRecord, entry: LedgerEntry) -> None:
+        # Пока идёт сборка, пользователей, до которых проход ещё не дошёл, он прочитает сам
+        if not self.ready and user_id not in self._rows:
+            return
+        row = self._row(user_id)
+        self.balances[row] = user.irisky
+        self._append_ledger(entry.date, entry.amount, self.classify(entry.reason))
+
+    def on_messages(self, user_id: str, count: int) -> None:
+        if not self.ready and user_id not in self._rows:
+            return
+        self.messages[self._row(user_id)] = count
+
+    def report(self, days: int = 14) -> Dict[str, Any]:
+        """Денежная масса, распределение, приток и оборот - векторно по колонкам"""
+        balances = self.balances[:self._users]
+        positive = np.sort(np.clip(balances, 0, None))
+        supply = int(balances.sum())
+        total = int(positive.sum())
+
+        if total > 0:
+            n = len(positive)
+            ranks = np.arange(1, n + 1, dtype=np.float64)
+            gini = float((2.0 * np.dot(ranks, positive) / (n * total)) - (n + 1) / n)
+            cumulative = np.concatenate(([0.0], np.cumsum(positive) / total))
+        else:
+            gini = 0.0
+            cumulative = np.zeros(2)
+        # Для графика достаточно 200 точек кривой Лоренца
+        points = np.linspace(0, len(cumulative) - 1, min(len(cumulative), 200)).astype(np.int64)
+
+        percentiles = (10, 25, 50, 75, 90, 99)
+        values = np.percentile(balances, percentiles) if len(balances) else np.zeros(len(percentiles))
+
+        today = datetime.now().replace(hour=0, minute=0, second=0, microsecond=0)
+        start = to_timestamp(today - timedelta(days=days - 1))
+        size = self._ledger
+        times = self.ledger_time[:size]
+        amounts = self.ledger_amount[:size]
+        kinds = self.ledger_kind[:size]
+        in_window = (times >= start) & (amounts > 0)
+        day_index = (times - start) // 86400
+
+        def daily(kind: int) -> np.ndarray:
+            mask = in_window & (kinds == kind)
+            return np.bincount(day_index[mask], weights=amounts[mask], minlength=days)[:days].astype(np.int64)
+
+        transfers = in_window & (kinds == self.TRANSFER)
+        transfer_volume = int(amounts[transfers].sum())
+
+        return {
+            "users": int(self._users),
+            "supply": supply,
+            "messages": int(self.messages[:self._users].sum()),
+            "gini": gini,
+            "percentiles": dict(zip(percentiles, values.tolist())),
+            "lorenz": cumulative[points],
+            "days": [today - timedelta(days=days - 1 - i) for i in range(days)],
+            "inflow_ferma": daily(self.FERMA),
+            "inflow_quiz": daily(self.QUIZ),
+            "transfer_volume": transfer_volume,
+            "transfer_count": int(transfers.sum()),
+            "velocity": transfer_volume / supply if supply > 0 else 0.0,
+        }
+
+
+ECONOMY = EconomyAnalytics()
 
 
 # Класс для работы с пайкоинами (экономика бота)
 class IriskyEconomy:
+    @staticmethod
+    def record(user_id: str, amount: int, reason: str = "") -> LedgerEntry:
+        """Единственная точка изменения баланса: история и аналитика обновляются вместе"""
+        user = users[user_id]
+        entry = user.record(amount, reason)
+        ECONOMY.on_record(user_id, user, entry)
+        return entry
+
     @staticmethod
     async def add_irisky(user_id: int, amount: int, reason: str = "") -> None:
         """Добавляет пайкоины пользователю"""
         try:
             user_id = str(user_id)
             if user_id not in users:
-                users[user_id] = {
-                    "username": "",
-                    "messages_count": 0,
-                    "warnings": [],
-                    "ban_expiry": None,
-                    "irisky": 0,
-                    "is_moderator": False,
-                    "irisky_history": [],
-                }
-
-            users[user_id]["irisky"] = users[user_id].get("irisky", 0) + amount
-
-            # Записываем в историю
-            users[user_id]["irisky_history"].append({
-                "date": datetime.now().isoformat(),
-                "amount": amount,
-                "balance": users[user_id]["irisky"],
-                "reason": reason
-            })
-
-            # Ограничиваем размер истории
-            if len(users[user_id]["irisky_history"]) > 50:
-                users[user_id]["irisky_history"] = users[user_id]["irisky_history"][-50:]
+                users[user_id] = UserRecord()
 
+            IriskyEconomy.record(user_id, amount, reason)
             save_data()
         except Exception as e:
-            logger.error(f"Error adding irisky to {user_id}: {e}")
+            logger.error("Error adding irisky to %s: %s", user_id, e)
 
     @staticmethod
     async def transfer_irisky(from_user_id: int, to_user_id: int, amount: int) -> bool:
@@ -530,31 +4586,16 @@ class IriskyEconomy:
             if from_user_id not in users or to_user_id not in users:
                 return False
 
-            if users[from_user_id]["irisky"] < amount:
+            if users[from_user_id].irisky < amount:
                 return False
 
-            users[from_user_id]["irisky"] -= amount
-            users[to_user_id]["irisky"] += amount
-
-            # Записываем в историю
-            users[from_user_id]["irisky_history"].append({
-                "date": datetime.now().isoformat(),
-                "amount": -amount,
-                "balance": users[from_user_id]["irisky"],
-                "reason": f"Перевод пользователю {to_user_id}"
-            })
-
-            users[to_user_id]["irisky_history"].append({
-                "date": datetime.now().isoformat(),
-                "amount": amount,
-                "balance": users[to_user_id]["irisky"],
-                "reason": f"Перевод от пользователя {from_user_id}"
-            })
+            IriskyEconomy.record(from_user_id, -amount, f"Перевод пользователю {to_user_id}")
+            IriskyEconomy.record(to_user_id, amount, f"Перевод от пользователя {from_user_id}")
 
             save_data()
             return True
         except Exception as e:
-            logger.error(f"Error transferring irisky: {e}")
+            logger.error("Error transferring irisky: %s", e)
             return False
 
     @staticmethod
@@ -562,7 +4603,7 @@ class IriskyEconomy:
         """Создает чек на указанное количество пайкоинов"""
         try:
             user_id = str(user_id)
-            if user_id not in users or users[user_id]["irisky"] < amount:
+            if user_id not in users or users[user_id].irisky < amount:
                 return None
 
             check_code = ''.join(random.choices("ABCDEFGHJKLMNPQRSTUVWXYZ23456789", k=8))
@@ -570,28 +4611,15 @@ class IriskyEconomy:
             if check_code in checks:
                 return None  # На случай коллизии
 
-            checks[check_code] = {
-                "user_id": user_id,
-                "amount": amount,
-                "created": datetime.now().isoformat(),
-                "activated": False
-            }
+            checks[check_code] = CheckRecord(user_id, amount, to_timestamp(datetime.now()))
 
             # Снимаем пайкоины у создателя
-            users[user_id]["irisky"] -= amount
-
-            # Записываем в историю
-            users[user_id]["irisky_history"].append({
-                "date": datetime.now().isoformat(),
-                "amount": -amount,
-                "balance": users[user_id]["irisky"],
-                "reason": f"Создание чека {check_code}"
-            })
+            IriskyEconomy.record(user_id, -amount, f"Создание чека {check_code}")
 
             save_data()
             return check_code
         except Exception as e:
-            logger.error(f"Error creating check: {e}")
+            logger.error("Error creating check: %s", e)
             return None
 
     @staticmethod
@@ -601,48 +4629,32 @@ class IriskyEconomy:
             user_id = str(user_id)
             check_code = check_code.upper()
 
-            if check_code not in checks or checks[check_code]["activated"]:
+            if check_code not in checks or checks[check_code].activated:
                 return None
 
-            amount = checks[check_code]["amount"]
-            creator_id = checks[check_code]["user_id"]
+            check = checks[check_code]
+            amount = check.amount
 
             # Если пользователь пытается активировать свой чек
-            if creator_id == user_id:
+            if check.user_id == user_id:
                 # Возвращаем пайкоины обратно
-                users[user_id]["irisky"] += amount
-
-                # Записываем в историю
-                users[user_id]["irisky_history"].append({
-                    "date": datetime.now().isoformat(),
-                    "amount": amount,
-                    "balance": users[user_id]["irisky"],
-                    "reason": f"Отмена чека {check_code}"
-                })
+                IriskyEconomy.record(user_id, amount, f"Отмена чека {check_code}")
 
                 del checks[check_code]
                 save_data()
                 return None
 
             # Переводим пайкоины новому пользователю
-            users[user_id]["irisky"] += amount
-
-            # Записываем в историю
-            users[user_id]["irisky_history"].append({
-                "date": datetime.now().isoformat(),
-                "amount": amount,
-                "balance": users[user_id]["irisky"],
-                "reason": f"Активация чека {check_code}"
-            })
+            IriskyEconomy.record(user_id, amount, f"Активация чека {check_code}")
 
-            checks[check_code]["activated"] = True
-            checks[check_code]["activated_by"] = user_id
-            checks[check_code]["activated_at"] = datetime.now().isoformat()
+            check.activated = True
+            check.activated_by = user_id
+            check.activated_at = to_timestamp(datetime.now())
 
             save_data()
             return amount
         except Exception as e:
-            logger.error(f"Error activating check: {e}")
+            logger.error("Error activating check: %s", e)
             return None
 
 
@@ -652,22 +4664,8 @@ class IriskyEconomy:
 async def cmd_start(message: types.Message):
     uid = str(message.from_user.id)
     if uid not in users:
-        users[uid] = {
-            "username": message.from_user.username or message.from_user.full_name,
-            "messages_count": 0,
-            "warnings": [],
-            "ban_expiry": None,
-            "irisky": 100,  # Начальный бонус
-            "is_moderator": False,
-            "irisky_history": [{
-                "date": datetime.now().isoformat(),
-                "amount": 100,
-                "balance": 100,
-                "reason": "Начальный бонус"
-            }],
-            "reminders": [],
-            "last_ferma": None,
-        }
+        users[uid] = UserRecord(message.from_user.username or message.from_user.full_name)
+        IriskyEconomy.record(uid, 100, "Начальный бонус")
         save_data()
 
     # Создаем клавиатуру с основными командами
@@ -696,15 +4694,19 @@ async def cmd_help(message: types.Message):
     commands_list = """📚 Доступные команды:
 
 🎮 Игры:
-/game_chess - Начать шахматную партию
-/game_checkers - Начать игру в шашки
+/game_chess [blitz|rapid] - Начать шахматную партию, при желании с часами
+/game_checkers [глубина] - Начать игру в шашки против AI
 /move [ход] - Сделать ход в текущей игре
+/puzzle [рейтинг] [тема] - Решить шахматную задачу
+/games [страница] - История ваших партий
+/rating - Рейтинг Эло в шахматах и шашках
 /end_game - Завершить текущую игру
 
 🌍 Информация:
-/weather [город] - Узнать погоду
+/weather [город] - Узнать погоду (можно несколько через запятую)
+/weather_fav [города] - Избранные города для /weather
 /map [место] - Показать карту места
-/route [откуда] [куда] - Построить маршрут
+/route [откуда] [куда] [способ] - Построить маршрут
 /translate [текст] - Перевести текст на русский
 
 💰 Экономика:
@@ -725,10 +4727,12 @@ async def cmd_help(message: types.Message):
 /ban [ID] [причина] - Забанить пользователя
 /unban [ID] - Разбанить пользователя
 /clearwarns [ID] - Снять предупреждения
+/storage - Статистика сохранения данных
 
 ℹ Прочее:
 /profile - Ваш профиль
-/statistics - Статистика чата
+/statistics - Статистика чата (/statistics global - общая, для модераторов)
+/economy - Аналитика экономики пайкоинов
 /real_life - Полезные советы
 """
 
@@ -749,7 +4753,7 @@ async def cmd_help(message: types.Message):
     await message.answer(commands_list, reply_markup=inline_keyboard)
 
 
-@dp.message(F.text.lower() == "❓ помощь")
+@BUTTONS.button("❓ Помощь")
 async def help_button(message: types.Message):
     await cmd_help(message)
 
@@ -764,19 +4768,19 @@ async def cmd_profile(message: types.Message):
         profile_text = (
             f"👤 {bold('Профиль пользователя')}\n\n"
             f"🆔 ID: {code(uid)}\n"
-            f"📛 Имя: {user['username']}\n"
-            f"📨 Сообщений: {user['messages_count']}\n"
-            f"💰 Пайкоины: {bold(str(user['irisky']))}\n"
-            f"⚠ Предупреждений: {len(user['warnings'])}\n"
+            f"📛 Имя: {user.username}\n"
+            f"📨 Сообщений: {user.messages_count}\n"
+            f"💰 Пайкоины: {bold(str(user.irisky))}\n"
+            f"⚠ Предупреждений: {len(user.warnings)}\n"
         )
 
         # Добавляем информацию о модераторе, если есть
-        if user.get("is_moderator", False):
+        if user.is_moderator:
             profile_text += "\n⭐ Вы модератор этого чата\n"
 
         # Добавляем информацию о бане, если есть
-        if user.get("ban_expiry"):
-            ban_time = datetime.fromisoformat(user["ban_expiry"])
+        if user.ban_expiry:
+            ban_time = from_timestamp(user.ban_expiry)
             if ban_time > datetime.now():
                 profile_text += f"\n🚫 Заблокирован до: {ban_time.strftime('%Y-%m-%d %H:%M')}\n"
 
@@ -791,7 +4795,7 @@ async def cmd_profile(message: types.Message):
         await message.answer("Пользователь не зарегистрирован. Напишите /start для регистрации.")
 
 
-@dp.message(F.text.lower() == "📊 профиль")
+@BUTTONS.button("📊 Профиль")
 async def profile_button(message: types.Message):
     await cmd_profile(message)
 
@@ -800,13 +4804,13 @@ async def profile_button(message: types.Message):
 async def cmd_get_irisky(message: types.Message):
     uid = str(message.from_user.id)
     if uid in users:
-        irisky = users[uid]["irisky"]
+        irisky = users[uid].irisky
         await message.answer(f"💰 Ваш текущий баланс: {bold(str(irisky))} пайкоинов", parse_mode=ParseMode.HTML)
     else:
         await message.answer("Пользователь не зарегистрирован. Напишите /start для регистрации.")
 
 
-@dp.message(F.text.lower() == "💰 пайкоины")
+@BUTTONS.button("💰 Пайкоины")
 async def irisky_button(message: types.Message):
     await cmd_get_irisky(message)
 
@@ -818,7 +4822,7 @@ async def cmd_irisky_history(message: types.Message):
         await message.answer("Пользователь не зарегистрирован. Напишите /start для регистрации.")
         return
 
-    history = users[uid].get("irisky_history", [])
+    history = users[uid].irisky_history
     if not history:
         await message.answer("История операций с пайкоинами пуста.")
         return
@@ -826,10 +4830,10 @@ async def cmd_irisky_history(message: types.Message):
     # Формируем текст истории (последние 10 операций)
     history_text = "📊 История операций с пайкоинами (последние 10):\n\n"
     for item in history[-10:]:
-        date = datetime.fromisoformat(item["date"]).strftime("%d.%m %H:%M")
-        amount = item["amount"]
-        balance = item["balance"]
-        reason = item.get("reason", "")
+        date = from_timestamp(item.date).strftime("%d.%m %H:%M")
+        amount = item.amount
+        balance = item.balance
+        reason = item.reason
 
         history_text += (
             f"{date} - {'+' if amount > 0 else ''}{amount} (Баланс: {balance})\n"
@@ -863,12 +4867,12 @@ async def cmd_transfer(message: types.Message):
             await message.answer("Нельзя переводить пайкоины самому себе.")
             return
 
-        if users[uid]["irisky"] < amount:
+        if users[uid].irisky < amount:
             await message.answer("Недостаточно пайкоинов для перевода.")
             return
 
         if await IriskyEconomy.transfer_irisky(int(uid), int(recipient_id), amount):
-            recipient_name = users.get(recipient_id, {}).get("username", recipient_id)
+            recipient_name = users[recipient_id].username or recipient_id
             await message.answer(
                 f"✅ Успешно переведено {bold(str(amount))} пайкоинов пользователю {recipient_name}.",
                 parse_mode=ParseMode.HTML
@@ -892,7 +4896,7 @@ async def cmd_create_check(message: types.Message):
             await message.answer("Сумма чека должна быть положительной.")
             return
 
-        if users[uid]["irisky"] < amount:
+        if users[uid].irisky < amount:
             await message.answer("Недостаточно пайкоинов для создания чека.")
             return
 
@@ -942,9 +4946,9 @@ async def cmd_ferma(message: types.Message):
         return
 
     # Проверяем, когда пользователь последний раз использовал ферму
-    last_ferma = users[uid].get("last_ferma")
+    last_ferma = users[uid].last_ferma
     if last_ferma:
-        last_time = datetime.fromisoformat(last_ferma)
+        last_time = from_timestamp(last_ferma)
         if (datetime.now() - last_time) < timedelta(hours=24):
             next_time = last_time + timedelta(hours=24)
             await message.answer(
@@ -992,7 +4996,7 @@ async def cmd_ferma(message: types.Message):
 
     # Добавляем пайкоины пользователю
     await IriskyEconomy.add_irisky(int(uid), total_reward, "Ферма")
-    users[uid]["last_ferma"] = datetime.now().isoformat()
+    users[uid].last_ferma = to_timestamp(datetime.now())
     save_data()
 
     # Формируем ответ
@@ -1006,7 +5010,7 @@ async def cmd_ferma(message: types.Message):
         response += f"• Праздничный бонус ({holiday_name}): +{holiday_bonus}\n"
 
     response += (
-        f"\n💵 Ваш текущий баланс: {bold(str(users[uid]['irisky']))}\n"
+        f"\n💵 Ваш текущий баланс: {bold(str(users[uid].irisky))}\n"
         f"⏳ Следующий сбор будет доступен через 24 часа."
     )
 
@@ -1016,13 +5020,26 @@ async def cmd_ferma(message: types.Message):
 @dp.message(Command("weather"))
 async def cmd_weather(message: types.Message):
     try:
-        city = message.text.split(maxsplit=1)[1]
+        cities = parse_cities(message.text.split(maxsplit=1)[1])
     except IndexError:
-        await message.answer("Укажите город: /weather [город]")
+        # Без аргументов - избранные города пользователя
+        user = users.get(str(message.from_user.id))
+        cities = list(user.weather_cities) if user else []
+    if not cities:
+        await message.answer(
+            "Укажите город: /weather [город]\n"
+            "Несколько городов: /weather Москва, Париж, Токио\n"
+            "Избранные города: /weather_fav [города]"
+        )
+        return
+
+    if len(cities) > 1:
+        await send_weather_many(message, cities)
         return
+    city = cities[0]
 
     # Устанавливаем состояние ожидания для пользователя
-    USER_STATES[message.from_user.id] = {"waiting_for": "weather", "city": city}
+    USER_STATES.set(message.from_user.id, {"waiting_for": "weather", "city": city})
 
     # Создаем клавиатуру с вариантами
     keyboard = InlineKeyboardMarkup(
@@ -1043,7 +5060,51 @@ async def cmd_weather(message: types.Message):
     )
 
 
-@dp.message(F.text.lower() == "🌤️ погода")
+async def send_weather_many(message: types.Message, cities: List[str]) -> None:
+    """Погода по нескольким городам одним сообщением"""
+    if len(cities) > WEATHER_MAX_CITIES:
+        await message.answer(f"Можно запросить не больше {WEATHER_MAX_CITIES} городов за раз.")
+        return
+    results = await WeatherAPI.get_weather_many(cities)
+    parts = []
+    for city, data in zip(cities, results):
+        text = WeatherAPI.format_weather(data)
+        parts.append(f"❌ {city}: {text}" if "error" in data else text)
+    await message.answer("\n\n".join(parts))
+
+
+@dp.message(Command("weather_fav"))
+async def cmd_weather_fav(message: types.Message):
+    uid = str(message.from_user.id)
+    if uid not in users:
+        await message.answer("Пользователь не зарегистрирован. Напишите /start для регистрации.")
+        return
+
+    user = users[uid]
+    args = message.text.split(maxsplit=1)
+    if len(args) < 2:
+        if user.weather_cities:
+            await message.answer(
+                f"⭐ Избранные города: {', '.join(user.weather_cities)}\n"
+                f"Погода по ним: /weather, очистить список: /weather_fav -"
+            )
+        else:
+            await message.answer("Использование: /weather_fav Москва, Париж, Токио")
+        return
+
+    cities = [] if args[1].strip() == "-" else parse_cities(args[1])
+    if len(cities) > WEATHER_MAX_CITIES:
+        await message.answer(f"Можно сохранить не больше {WEATHER_MAX_CITIES} городов.")
+        return
+    user.weather_cities = cities
+    save_data()
+    if cities:
+        await message.answer(f"⭐ Избранные города сохранены: {', '.join(cities)}")
+    else:
+        await message.answer("⭐ Список избранных городов очищен.")
+
+
+@BUTTONS.button("🌤️ Погода")
 async def weather_button(message: types.Message):
     await message.answer("Введите название города для получения погоды:")
 
@@ -1057,14 +5118,11 @@ async def weather_callback_handler(callback: types.CallbackQuery):
         weather_text = WeatherAPI.format_weather(weather_data)
         await callback.message.answer(weather_text)
     elif action == "forecast":
-        # Здесь можно реализовать получение прогноза
-        await callback.message.answer(f"🚧 Прогноз погоды для {city} временно недоступен. Работаем над этим!")
+        forecast = await WeatherAPI.get_forecast(city)
+        await callback.message.answer(WeatherAPI.format_forecast(forecast))
     elif action == "map":
-        map_image = await MapsAPI.get_map_image(city)
-        if map_image:
-            photo = BufferedInputFile(map_image, filename="map.png")
-            await callback.message.answer_photo(photo, caption=f"🗺 Карта {city}")
-        else:
+        request = await MapsAPI.map_request(city)
+        if not await send_static_map(callback.message, request, f"🗺 Карта {city}"):
             await callback.message.answer(f"Не удалось найти карту для {city}")
 
     await callback.answer()
@@ -1081,10 +5139,8 @@ async def cmd_map(message: types.Message):
     # Показываем статус обработки
     processing_msg = await message.answer(f"🔄 Поиск карты для {location}...")
 
-    map_image = await MapsAPI.get_map_image(location)
-    if map_image:
-        photo = BufferedInputFile(map_image, filename="map.png")
-        await message.answer_photo(photo, caption=f"🗺 Карта {location}")
+    request = await MapsAPI.map_request(location)
+    if await send_static_map(message, request, f"🗺 Карта {location}"):
         await processing_msg.delete()
     else:
         await processing_msg.edit_text(f"Не удалось найти карту для {location}")
@@ -1097,18 +5153,23 @@ async def cmd_route(message: types.Message):
         origin = args[1]
         destination = args[2]
     except IndexError:
-        await message.answer("Использование: /route [откуда] [куда]")
+        await message.answer(f"Использование: /route [откуда] [куда] [{'|'.join(ROUTE_MODES)}]")
         return
 
+    # Способ передвижения - необязательное последнее слово
+    mode = "driving"
+    parts = destination.rsplit(maxsplit=1)
+    if len(parts) == 2 and parts[1].lower() in ROUTE_MODES:
+        destination, mode = parts[0], parts[1].lower()
+
     processing_msg = await message.answer(f"🔄 Построение маршрута из {origin} в {destination}...")
 
-    route_image = await MapsAPI.get_route_map(origin, destination)
-    if route_image:
-        photo = BufferedInputFile(route_image, filename="route.png")
-        await message.answer_photo(
-            photo,
-            caption=f"🛣 Маршрут из {origin} в {destination}",
-        )
+    route = await MapsAPI.get_directions(origin, destination, mode)
+    request = MapsAPI.route_map_request(route) if route else None
+    caption = f"🛣 Маршрут из {origin} в {destination}"
+    if route and route["distance"]:
+        caption += f"\n📏 {route['distance']}, ⏱ {route['duration']}"
+    if await send_static_map(message, request, caption):
         await processing_msg.delete()
     else:
         await processing_msg.edit_text(f"Не удалось построить маршрут из {origin} в {destination}")
@@ -1124,7 +5185,7 @@ async def cmd_translate(message: types.Message):
 
     processing_msg = await message.answer("🔄 Перевод текста...")
 
-    translated = await TranslateAPI.translate_text(text)
+    translated = await TRANSLATOR.translate(text)
     if translated:
         await processing_msg.edit_text(
             f"🌍 Перевод:\n\n"
@@ -1143,11 +5204,11 @@ async def cmd_quiz(message: types.Message):
         return
 
     # Сохраняем текущий вопрос для пользователя
-    USER_STATES[message.from_user.id] = {
+    USER_STATES.set(message.from_user.id, {
         "waiting_for": "quiz_answer",
         "quiz": quiz,
         "correct_answer": quiz["answer"],
-    }
+    }, ttl=QUIZ_ANSWER_TIMEOUT)
 
     # Создаем клавиатуру с вариантами ответов
     keyboard = InlineKeyboardMarkup(
@@ -1163,7 +5224,7 @@ async def cmd_quiz(message: types.Message):
     )
 
 
-@dp.message(F.text.lower() == "🎯 викторина")
+@BUTTONS.button("🎯 Викторина")
 async def quiz_button(message: types.Message):
     await cmd_quiz(message)
 
@@ -1171,13 +5232,16 @@ async def quiz_button(message: types.Message):
 @dp.callback_query(F.data.startswith("quiz_"))
 async def quiz_callback_handler(callback: types.CallbackQuery):
     user_id = callback.from_user.id
-    if user_id not in USER_STATES or USER_STATES[user_id].get("waiting_for") != "quiz_answer":
+    state = USER_STATES.get(user_id)
+    if not state or state.get("waiting_for") != "quiz_answer":
         await callback.answer("Время ответа истекло. Начните новую викторину.")
         return
 
+    # Удаляем состояние викторины сразу: повторное нажатие не даст второй награды
+    USER_STATES.pop(user_id)
     answer_idx = int(callback.data.split("_")[1])
-    quiz = USER_STATES[user_id]["quiz"]
-    correct_idx = USER_STATES[user_id]["correct_answer"]
+    quiz = state["quiz"]
+    correct_idx = state["correct_answer"]
 
     if answer_idx == correct_idx:
         # Награждаем пользователя за правильный ответ
@@ -1196,8 +5260,6 @@ async def quiz_callback_handler(callback: types.CallbackQuery):
             f"Правильный ответ: {quiz['options'][correct_idx]}"
         )
 
-    # Удаляем состояние викторины
-    del USER_STATES[user_id]["waiting_for"]
     await callback.answer()
 
 
@@ -1243,27 +5305,47 @@ async def cmd_who(message: types.Message):
         await message.answer("Использование: /who [текст]\nПример: /who должен вынести мусор")
         return
 
-    # Получаем список участников чата
-    chat_members = await bot.get_chat_administrators(message.chat.id)
-    if not chat_members:
-        await message.answer("Не удалось получить список участников чата.")
-        return
-
-    # Выбираем случайного участника
-    chosen_member = random.choice(chat_members).user
+    # Выбираем случайного участника из недавно активных, в личке - собеседника
+    if message.chat.type == "private":
+        chosen_name = message.from_user.first_name
+    else:
+        chat_members = await CHAT_MEMBERS.members(message.chat.id)
+        if not chat_members:
+            await message.answer("Не удалось получить список участников чата.")
+            return
+        chosen_name = random.choice(list(chat_members.values()))
 
     # Формируем ответ
     responses = [
-        f"🎲 {chosen_member.first_name}, {text}",
-        f"✨ По жребию выпало: {chosen_member.first_name}, {text}",
-        f"🔮 Магический шар говорит: {chosen_member.first_name}, {text}",
-        f"🤔 Думаю, что {chosen_member.first_name} должен(а) {text}",
-        f"👑 Корона достается {chosen_member.first_name}, {text}",
+        f"🎲 {chosen_name}, {text}",
+        f"✨ По жребию выпало: {chosen_name}, {text}",
+        f"🔮 Магический шар говорит: {chosen_name}, {text}",
+        f"🤔 Думаю, что {chosen_name} должен(а) {text}",
+        f"👑 Корона достается {chosen_name}, {text}",
     ]
 
     await message.answer(random.choice(responses))
 
 
+@dp.chat_member()
+async def on_chat_member(update: types.ChatMemberUpdated):
+    """Вступления, выходы и изменения прав участников обновляют кэш без запросов к API"""
+    if update.new_chat_member.status in ("left", "kicked"):
+        CHAT_MEMBERS.remove(update.chat.id, update.new_chat_member.user.id)
+        CHAT_STATS.remove(update.chat.id, update.new_chat_member.user.id)
+    else:
+        CHAT_MEMBERS.seen(update.chat.id, update.new_chat_member.user)
+    if update.old_chat_member.status != update.new_chat_member.status:
+        CHAT_MEMBERS.invalidate_admins(update.chat.id)
+
+
+@dp.my_chat_member()
+async def on_my_chat_member(update: types.ChatMemberUpdated):
+    if update.new_chat_member.status in ("left", "kicked"):
+        CHAT_MEMBERS.forget(update.chat.id)
+        CHAT_STATS.forget(update.chat.id)
+
+
 @dp.message(Command("real_life"))
 async def cmd_real_life(message: types.Message):
     response = """
@@ -1285,66 +5367,125 @@ async def cmd_real_life(message: types.Message):
 
 @dp.message(Command("statistics"))
 async def cmd_statistics(message: types.Message):
-    # Статистика по сообщениям
-    top_users = sorted(
-        users.items(),
-        key=lambda x: x[1].get("messages_count", 0),
-        reverse=True
-    )[:5]
-
-    # Статистика по пайкоинам
-    top_rich = sorted(
-        users.items(),
-        key=lambda x: x[1].get("irisky", 0),
-        reverse=True
-    )[:5]
-
-    # Общая статистика
-    total_users = len(users)
-    total_messages = sum(user.get("messages_count", 0) for user in users.values())
-    total_irisky = sum(user.get("irisky", 0) for user in users.values())
+    # В группе - раздел этого чата, общая статистика - только модераторам
+    args = message.text.split(maxsplit=1)
+    scope = args[1].strip().lower() if len(args) > 1 else ""
+    if scope == "global" or message.chat.type == "private":
+        moderator = users.get(str(message.from_user.id))
+        if not moderator or not moderator.is_moderator:
+            await message.answer("📊 Статистика доступна в групповых чатах. Общая статистика - только модераторам.")
+            return
+        chat_id, title = ChatStats.GLOBAL, "Общая статистика"
+    else:
+        chat_id, title = message.chat.id, "Статистика чата"
+
+    partition = CHAT_STATS.partition(chat_id)
+    if chat_id == ChatStats.GLOBAL:
+        # Общий раздел: балансы всех пользователей
+        balances = [(uid, user.username, user.irisky) for uid, user in scan_users()]
+    else:
+        balances = []
+        for user_id in partition.counts:
+            user = users.get(str(user_id))
+            if user is not None:
+                balances.append((str(user_id), user.username, user.irisky))
+
+    top_rich = heapq.nlargest(CHAT_STATS_TOP, balances, key=lambda x: x[2])
+    total_users = len(balances) if chat_id == ChatStats.GLOBAL else len(partition.counts)
+    total_irisky = sum(irisky for _, _, irisky in balances)
 
     # Формируем ответ
     stats_text = (
-        f"📊 {bold('Статистика чата')}\n\n"
+        f"📊 {bold(title)}\n\n"
         f"👥 Всего пользователей: {total_users}\n"
-        f"📨 Всего сообщений: {total_messages}\n"
+        f"📨 Всего сообщений: {partition.messages}\n"
         f"💰 Всего пайкоинов в системе: {total_irisky}\n\n"
         f"🏆 {bold('Топ активных пользователей:')}\n"
     )
 
-    for idx, (uid, data) in enumerate(top_users, 1):
-        stats_text += f"{idx}. {data.get('username', uid)} - {data.get('messages_count', 0)} сообщений\n"
+    for idx, user_id in enumerate(partition.top, 1):
+        user = users.get(str(user_id))
+        name = user.username if user and user.username else user_id
+        stats_text += f"{idx}. {name} - {partition.counts[user_id]} сообщений\n"
 
     stats_text += f"\n💰 {bold('Топ богачей:')}\n"
-    for idx, (uid, data) in enumerate(top_rich, 1):
-        stats_text += f"{idx}. {data.get('username', uid)} - {data.get('irisky', 0)} пайкоинов\n"
+    for idx, (uid, username, irisky) in enumerate(top_rich, 1):
+        stats_text += f"{idx}. {username or uid} - {irisky} пайкоинов\n"
 
     await message.answer(stats_text, parse_mode=ParseMode.HTML)
 
 
+@dp.message(Command("economy"))
+async def cmd_economy(message: types.Message):
+    if not ECONOMY.ready:
+        await message.answer("⏳ Аналитика экономики ещё собирается, попробуйте чуть позже.")
+        return
+
+    report = ECONOMY.report()
+    percentiles = report["percentiles"]
+    inflow_ferma = int(report["inflow_ferma"].sum())
+    inflow_quiz = int(report["inflow_quiz"].sum())
+    days = len(report["days"])
+
+    economy_text = (
+        f"📈 {bold('Экономика пайкоинов')}\n\n"
+        f"👥 Пользователей: {report['users']}\n"
+        f"💰 Денежная масса: {report['supply']}\n"
+        f"⚖ Коэффициент Джини: {report['gini']:.3f}\n"
+        f"📊 Медиана баланса: {percentiles[50]:.0f} "
+        f"(p10 {percentiles[10]:.0f} / p90 {percentiles[90]:.0f} / p99 {percentiles[99]:.0f})\n\n"
+        f"🌾 Приток с фермы за {days} дн.: {inflow_ferma}\n"
+        f"🎯 Приток с викторин за {days} дн.: {inflow_quiz}\n"
+        f"🔁 Переводы за {days} дн.: {report['transfer_volume']} ({report['transfer_count']} шт.)\n"
+        f"⚡ Скорость обращения: {report['velocity']:.3f}"
+    )
+
+    chart = await ChartGenerator.generate_economy_chart(report)
+    if chart:
+        photo = BufferedInputFile(chart, filename="economy.png")
+        await message.answer_photo(photo, caption=economy_text, parse_mode=ParseMode.HTML)
+    else:
+        await message.answer(economy_text, parse_mode=ParseMode.HTML)
+
+
 @dp.message(Command("game_chess"))
 async def game_chess(message: types.Message):
     gid = str(message.chat.id)
     if gid not in GAME_STATES:
+        # /game_chess [blitz|rapid] - партия с контролем времени
+        time_control = None
+        if message.text and message.text.startswith("/game_chess"):
+            args = message.text.split()[1:]
+            if args:
+                time_control = args[0].lower()
+                if time_control not in CHESS_TIME_CONTROLS:
+                    await message.answer(f"Доступные контроли времени: {', '.join(CHESS_TIME_CONTROLS)}")
+                    return
+
         # Создаем игру с реальными именами игроков
         white_player = message.from_user.full_name
         black_player = "AI"  # Можно реализовать поиск второго игрока
-        game = ChessGame(white_player, black_player)
+        game = ChessGame(white_player, black_player, time_control)
+        if not message.from_user.is_bot:
+            game.white_id = message.from_user.id
         GAME_STATES[gid] = game
+        CHESS_CLOCKS.schedule(gid, game)
 
-        # Отправляем начальную доску
-        await draw_board_and_send(message.chat.id, game.board)
-
-        await message.answer(
+        intro_text = (
             f"♟ {bold('Новая шахматная партия!')}\n\n"
             f"⚪ Белые: {white_player}\n"
             f"⚫ Чёрные: {black_player}\n\n"
+        )
+        if time_control:
+            minutes, increment = CHESS_TIME_CONTROLS[time_control]
+            intro_text += f"⏱ Контроль времени: {minutes} мин + {increment} с за ход\n"
+        intro_text += (
             f"Сейчас ходят: {bold(game.current_turn.capitalize())}\n"
             f"Используйте /move [ход] чтобы сделать ход\n"
-            f"Например: /move e2e4",
-            parse_mode=ParseMode.HTML
+            f"Например: /move e2e4"
         )
+
+        await show_chess_game(message.chat.id, game, intro_text)
     else:
         await message.answer(
             "⚠ Игра уже идет! Завершите текущую партию командой /end_chess или сделайте ход.\n"
@@ -1352,7 +5493,7 @@ async def game_chess(message: types.Message):
         )
 
 
-@dp.message(F.text.lower() == "🎮 игры")
+@BUTTONS.button("🎮 Игры")
 async def games_button(message: types.Message):
     keyboard = InlineKeyboardMarkup(
         inline_keyboard=[
@@ -1369,21 +5510,28 @@ async def game_chess_callback(callback: types.CallbackQuery):
     await game_chess(callback.message)
 
 
-async def draw_board_and_send(chat_id: int, board: chess.Board, orientation: chess.Color = chess.WHITE) -> None:
+def render_board_png(board: chess.Board, orientation: chess.Color = chess.WHITE,
+                     in_check: Optional[bool] = None) -> bytes:
+    """Отрисовка шахматной доски в PNG"""
+    # Генерируем SVG
+    svg_data = chess.svg.board(
+        board=board,
+        orientation=orientation,
+        size=400,
+        lastmove=board.peek() if board.move_stack else None,
+        check=board.king(board.turn) if (board.is_check() if in_check is None else in_check) else None,
+    )
+
+    # Конвертируем SVG в PNG
+    drawing = svg2rlg(BytesIO(svg_data.encode("utf-8")))
+    return renderPM.drawToString(drawing, fmt="PNG")
+
+
+async def draw_board_and_send(chat_id: int, board: chess.Board, orientation: chess.Color = chess.WHITE,
+                              in_check: Optional[bool] = None) -> None:
     """Генерация и отправка шахматной доски"""
     try:
-        # Генерируем SVG
-        svg_data = chess.svg.board(
-            board=board,
-            orientation=orientation,
-            size=400,
-            lastmove=board.peek() if board.move_stack else None,
-            check=board.king(chess.WHITE if board.turn == chess.WHITE else chess.BLACK) if board.is_check() else None,
-        )
-
-        # Конвертируем SVG в PNG
-        drawing = svg2rlg(BytesIO(svg_data.encode("utf-8")))
-        png_image = renderPM.drawToString(drawing, fmt="PNG")
+        png_image = await asyncio.to_thread(render_board_png, board.copy(), orientation, in_check)
 
         # Создаем объект фото
         photo = BufferedInputFile(png_image, filename="chess_board.png")
@@ -1391,10 +5539,137 @@ async def draw_board_and_send(chat_id: int, board: chess.Board, orientation: che
         # Отправляем изображение
         await bot.send_photo(chat_id, photo=photo)
     except Exception as e:
-        logger.error(f"Ошибка при генерации доски: {e}")
+        logger.error("Ошибка при генерации доски: %s", e)
         await bot.send_message(chat_id, "Не удалось сгенерировать изображение доски.")
 
 
+# file_id уже загруженных в Telegram картинок доски: одинаковые позиции не загружаются повторно
+BOARD_FILE_IDS = SessionStore(max_size=BOARD_FILE_ID_CACHE_SIZE, default_ttl=30 * 24 * 3600)
+
+
+async def send_game_view(chat_id: int, game: ChessGame, caption: str) -> None:
+    """Показывает партию одним сообщением: доска с подписью, которое редактируется на месте"""
+    orientation = game.orientation
+    in_check = game.status().is_check
+    lastmove = game.board.peek().uci() if game.board.move_stack else ""
+    key = (game.board.board_fen(), orientation, lastmove, in_check)
+
+    file_id = BOARD_FILE_IDS.get(key)
+    if file_id:
+        photo = file_id
+    else:
+        try:
+            png_image = await asyncio.to_thread(render_board_png, game.board.copy(), orientation, in_check)
+        except Exception as e:
+            logger.error("Ошибка при генерации доски: %s", e)
+            await bot.send_message(chat_id, caption, parse_mode=ParseMode.HTML)
+            return
+        photo = BufferedInputFile(png_image, filename="chess_board.png")
+
+    result = None
+    if game.message_id:
+        try:
+            result = await bot.edit_message_media(
+                media=InputMediaPhoto(media=photo, caption=caption, parse_mode=ParseMode.HTML),
+                chat_id=chat_id,
+                message_id=game.message_id,
+            )
+        except TelegramBadRequest as e:
+            if "message is not modified" in str(e):
+                return
+            # Сообщение удалено или слишком старое - начинаем новое
+            logger.info("Game view message %s in %s is not editable: %s", game.message_id, chat_id, e)
+            game.message_id = None
+
+    if not game.message_id:
+        result = await bot.send_photo(chat_id, photo=photo, caption=caption, parse_mode=ParseMode.HTML)
+        game.message_id = result.message_id
+
+    if not file_id and isinstance(result, Message) and result.photo:
+        BOARD_FILE_IDS.set(key, result.photo[-1].file_id)
+
+
+async def show_chess_game(chat_id: int, game: ChessGame, text: str) -> None:
+    """Показывает доску и текст в режиме CHESS_VIEW_MODE"""
+    if CHESS_VIEW_MODE == "edit":
+        # Доска и статус - одно редактирование сообщения партии
+        await send_game_view(chat_id, game, text)
+    else:
+        await draw_board_and_send(chat_id, game.board, game.orientation, in_check=game.status().is_check)
+        await bot.send_message(chat_id, text, parse_mode=ParseMode.HTML)
+
+
+async def finish_chess_game(gid: str, game: ChessGame, winner: str) -> str:
+    """Завершает партию: награждает победителя и удаляет игру, возвращает текст итога"""
+    status = game.get_game_status()
+    duration = game.get_game_duration()
+
+    if winner == "Draw":
+        result_text = f"🎉 {bold('Ничья!')}\n{status}\nПродолжительность игры: {duration}"
+    else:
+        result_text = (
+            f"🎉 {bold('Игра окончена!')}\n"
+            f"Победитель: {bold(winner)}\n"
+            f"{status}\n"
+            f"Продолжительность игры: {duration}"
+        )
+
+        # Награждаем победителя, если это не AI
+        if winner != "AI":
+            uid = game.white_id if winner == game.white_player else game.black_id
+            if uid is None:
+                uid = next((uid for uid, data in scan_users() if data.username == winner), None)
+            if uid:
+                reward = random.randint(20, 50)
+                await IriskyEconomy.add_irisky(int(uid), reward, "Победа в шахматах")
+                result_text += f"\n\n🏆 {winner} получает {reward} пайкоинов за победу!"
+
+    result_text += await archive_game(game)
+    CHESS_CLOCKS.cancel(gid)
+    if gid in GAME_STATES:
+        del GAME_STATES[gid]
+    return result_text
+
+
+async def archive_game(game) -> str:
+    """Сохраняет завершённую партию в архив, возвращает текст об изменении рейтингов"""
+    record = game.archive_record()
+    try:
+        changes = await GAME_ARCHIVE.add(record)
+    except OSError as e:
+        logger.error("Error archiving game: %s", e)
+        return ""
+    lines = [
+        f"{name}: {GAME_ARCHIVE.rating(player_id, record[0])} ({changes[player_id]:+d})"
+        for player_id, name in ((record[2], record[4]), (record[3], record[5]))
+        if player_id in changes
+    ]
+    return "\n\n📈 Рейтинг: " + ", ".join(lines) if lines else ""
+
+
+async def on_flag_fall(gid: str) -> None:
+    """Срабатывание таймера: если время стороны на ходу вышло, партия завершается"""
+    game = GAME_STATES.get(gid)
+    if not isinstance(game, ChessGame):
+        return
+    flag_at = game.flag_at()
+    if flag_at is None:
+        return
+    if flag_at > time.time():
+        # Ход успели сделать, пока таймер ждал своей очереди
+        CHESS_CLOCKS.schedule(gid, game)
+        return
+
+    game.clocks[game.board.turn] = 0.0
+    game.flagged = game.board.turn
+    CHESS_CLOCKS.flag_falls += 1
+    try:
+        result_text = await finish_chess_game(gid, game, game.winner())
+        await show_chess_game(int(gid), game, f"⏱ {result_text}\n{game.clock_text()}")
+    except Exception as e:
+        logger.error("Error finishing game %s on flag fall: %s", gid, e)
+
+
 @dp.message(Command("move"))
 async def handle_move(message: types.Message):
     gid = str(message.chat.id)
@@ -1409,6 +5684,9 @@ async def handle_move(message: types.Message):
         return
 
     game = GAME_STATES[gid]
+    if isinstance(game, PuzzleGame):
+        await handle_puzzle_move(message, gid, game, move_str)
+        return
 
     # Проверяем, чей сейчас ход
     current_player = game.white_player if game.current_turn == "white" else game.black_player
@@ -1416,48 +5694,36 @@ async def handle_move(message: types.Message):
         await message.answer(f"Сейчас не ваш ход. Ожидается ход от {current_player}.")
         return
 
-    if game.move(move_str):
-        # После успешного хода обновляем доску
-        await draw_board_and_send(
-            message.chat.id,
-            game.board,
-            chess.WHITE if game.current_turn == "white" else chess.BLACK
-        )
+    flag_at = game.flag_at()
+    if flag_at is not None and flag_at <= time.time():
+        # Время вышло раньше, чем сработал таймер
+        await on_flag_fall(gid)
+        return
 
-        # Проверяем окончание игры
+    if game.move(move_str):
+        # Проверяем окончание игры; пока позиция есть в дебютной книге, AI отвечает мгновенно
         winner = game.winner()
+        book_move = None
+        if not winner:
+            book_move = game.play_book_move()
+            winner = game.winner() if book_move else None
         if winner:
-            status = game.get_game_status()
-            duration = game.get_game_duration()
-
-            if winner == "Draw":
-                result_text = f"🎉 {bold('Ничья!')}\n{status}\nПродолжительность игры: {duration}"
-            else:
-                result_text = (
-                    f"🎉 {bold('Игра окончена!')}\n"
-                    f"Победитель: {bold(winner)}\n"
-                    f"{status}\n"
-                    f"Продолжительность игры: {duration}"
-                )
-
-                # Награждаем победителя, если это не AI
-                if winner != "AI":
-                    uid = next((uid for uid, data in users.items() if data.get("username") == winner), None)
-                    if uid:
-                        reward = random.randint(20, 50)
-                        await IriskyEconomy.add_irisky(int(uid), reward, "Победа в шахматах")
-                        result_text += f"\n\n🏆 {winner} получает {reward} пайкоинов за победу!"
-
-            await message.answer(result_text, parse_mode=ParseMode.HTML)
-            del GAME_STATES[gid]
+            result_text = await finish_chess_game(gid, game, winner)
         else:
-            status = game.get_game_status()
-            await message.answer(
-                f"♟ Ход {code(move_str)} выполнен!\n\n"
-                f"Сейчас ходят: {bold(game.current_turn.capitalize())}\n"
-                f"Статус: {status}",
-                parse_mode=ParseMode.HTML
+            result_text = f"♟ Ход {code(move_str)} выполнен!\n"
+            if book_move:
+                result_text += f"📖 AI отвечает по книге: {code(book_move)}\n"
+            if game.opening:
+                result_text += f"Дебют: {italic(game.opening)}\n"
+            result_text += (
+                f"\nСейчас ходят: {bold(game.current_turn.capitalize())}\n"
+                f"Статус: {game.get_game_status()}"
             )
+            if game.time_control:
+                result_text += f"\n{game.clock_text()}"
+            CHESS_CLOCKS.schedule(gid, game)
+
+        await show_chess_game(message.chat.id, game, result_text)
     else:
         await message.answer(
             f"❌ Недопустимый ход: {code(move_str)}\n"
@@ -1466,12 +5732,82 @@ async def handle_move(message: types.Message):
         )
 
 
+async def handle_puzzle_move(message: types.Message, gid: str, game: PuzzleGame, move_str: str) -> None:
+    """Ход в шахматной задаче"""
+    result = game.solve(move_str)
+    if result == "illegal":
+        await message.answer(f"❌ Недопустимый ход: {code(move_str)}", parse_mode=ParseMode.HTML)
+        return
+    if result == "wrong":
+        await message.answer(
+            f"🤔 {code(move_str)} - не лучший ход. Попробуйте ещё раз или сдайтесь командой /end_chess",
+            parse_mode=ParseMode.HTML
+        )
+        return
+
+    if result == "solved":
+        text = (
+            f"🧩 {bold('Задача решена!')}\n"
+            f"Рейтинг задачи: {game.rating}\n"
+            f"Ошибок: {game.mistakes}\n"
+            f"Время: {game.get_game_duration()}"
+        )
+        if game.mistakes == 0:
+            reward = max(game.rating // 200, 3)
+            await IriskyEconomy.add_irisky(message.from_user.id, reward, "Решение шахматной задачи")
+            text += f"\n\n🏆 {message.from_user.full_name} получает {reward} пайкоинов!"
+        del GAME_STATES[gid]
+    else:
+        text = (
+            f"✅ {code(move_str)} - верно! Соперник отвечает {code(game.last_reply())}\n"
+            f"Ваш ход: /move [ход]"
+        )
+    await show_chess_game(message.chat.id, game, text)
+
+
+@dp.message(Command("puzzle"))
+async def cmd_puzzle(message: types.Message):
+    gid = str(message.chat.id)
+    if gid in GAME_STATES:
+        await message.answer("⚠ Игра уже идет! Завершите текущую партию или задачу, прежде чем начать новую.")
+        return
+
+    rating = None
+    theme = None
+    for arg in message.text.split()[1:]:
+        if arg.isdigit():
+            rating = int(arg)
+        else:
+            theme = arg
+
+    puzzle = await asyncio.to_thread(PUZZLES.random, rating, theme)
+    if puzzle is None:
+        if theme and PUZZLES.open():
+            themes = ", ".join(PUZZLES.themes()[:30])
+            await message.answer(f"Тема {code(theme)} не найдена. Доступные темы: {themes}",
+                                 parse_mode=ParseMode.HTML)
+        else:
+            await message.answer("База задач недоступна.")
+        return
+
+    game = PuzzleGame(message.from_user.full_name, puzzle)
+    GAME_STATES[gid] = game
+    side = "белых" if game.player_color == chess.WHITE else "чёрных"
+    text = (
+        f"🧩 {bold('Задача')} #{puzzle['id']} (рейтинг {puzzle['rating']})\n\n"
+        f"Соперник сыграл {code(game.last_reply())}. Ход {side} - найдите лучшее продолжение.\n"
+        f"Используйте /move [ход], например: /move e2e4"
+    )
+    await show_chess_game(message.chat.id, game, text)
+
+
 @dp.message(Command("end_chess"))
 async def end_chess(message: types.Message):
     gid = str(message.chat.id)
     if gid in GAME_STATES and isinstance(GAME_STATES[gid], ChessGame):
         game = GAME_STATES[gid]
         duration = game.get_game_duration()
+        CHESS_CLOCKS.cancel(gid)
         del GAME_STATES[gid]
         await message.answer(
             f"🏁 Игра прервана. Доска очищена.\n"
@@ -1485,16 +5821,28 @@ async def end_chess(message: types.Message):
 async def game_checkers(message: types.Message):
     gid = str(message.chat.id)
     if gid not in GAME_STATES:
+        # /game_checkers [глубина] - сила AI-соперника
+        ai_depth = CHECKERS_AI_DEPTH
+        if message.text and message.text.startswith("/game_checkers"):
+            args = message.text.split()[1:]
+            if args:
+                if not args[0].isdigit() or not 1 <= int(args[0]) <= CHECKERS_AI_MAX_DEPTH:
+                    await message.answer(f"Глубина AI должна быть от 1 до {CHECKERS_AI_MAX_DEPTH}")
+                    return
+                ai_depth = int(args[0])
+
         # Создаем игру с реальными именами игроков
         player1 = message.from_user.full_name
         player2 = "AI"  # Можно реализовать поиск второго игрока
-        game = CheckersGame(player1, player2)
+        game = CheckersGame(player1, player2, ai_depth)
+        if not message.from_user.is_bot:
+            game.player1_id = message.from_user.id
         GAME_STATES[gid] = game
 
         await message.answer(
             f"🔴 {bold('Новая игра в шашки!')}\n\n"
             f"🔘 Игрок 1: {player1}\n"
-            f"🔴 Игрок 2: {player2}\n\n"
+            f"🔴 Игрок 2: {player2} (глубина {ai_depth})\n\n"
             f"Сейчас ходит: {bold(game.current_player)}\n"
             f"Используйте /move_checkers [откуда] [куда] чтобы сделать ход\n"
             f"Например: /move_checkers 52 43\n\n"
@@ -1508,6 +5856,66 @@ async def game_checkers(message: types.Message):
         )
 
 
+async def finish_checkers_game(gid: str, game: CheckersGame, winner: str) -> str:
+    """Завершает партию в шашки: награждает победителя и удаляет игру, возвращает текст итога"""
+    if winner == "Draw":
+        result_text = "🎉 Ничья!"
+    else:
+        result_text = f"🎉 Победитель: {bold(winner)}!"
+
+        # Награждаем победителя, если это не AI
+        if winner != "AI":
+            uid = game.player1_id if winner == game.player1 else game.player2_id
+            if uid is None:
+                uid = next((uid for uid, data in scan_users() if data.username == winner), None)
+            if uid:
+                reward = random.randint(15, 40)
+                await IriskyEconomy.add_irisky(int(uid), reward, "Победа в шашках")
+                result_text += f"\n\n🏆 {winner} получает {reward} пайкоинов за победу!"
+
+    result_text += await archive_game(game)
+    if gid in GAME_STATES:
+        del GAME_STATES[gid]
+    return (
+        f"{result_text}\n\n"
+        f"Итоговая доска:\n\n"
+        f"{code(game.show_board())}"
+    )
+
+
+async def play_checkers_ai(chat_id: int, gid: str, game: CheckersGame) -> None:
+    """Ход AI: перебор в пуле процессов, затем ход применяется, если партия за это время не изменилась"""
+    if gid in CHECKERS_AI.thinking:
+        return
+    CHECKERS_AI.thinking.add(gid)
+    before = game.pack_board()
+    try:
+        move = await CHECKERS_AI.choose_move(game)
+    except Exception as e:
+        logger.error("Checkers AI error in game %s: %s", gid, e)
+        await bot.send_message(chat_id, "🤖 AI не смог сделать ход. Отправьте /move_checkers, чтобы попробовать снова.")
+        return
+    finally:
+        CHECKERS_AI.thinking.discard(gid)
+
+    game = GAME_STATES.get(gid)
+    if not isinstance(game, CheckersGame) or game.current_player != "AI" or game.pack_board() != before:
+        return
+    if move is not None:
+        game.apply_move(move)
+    winner = game.winner()
+    if winner:
+        await bot.send_message(chat_id, await finish_checkers_game(gid, game, winner), parse_mode=ParseMode.HTML)
+    else:
+        await bot.send_message(
+            chat_id,
+            f"🤖 AI ходит {game.moves_history[-1]}\n\n"
+            f"Сейчас ходит: {bold(game.current_player)}\n\n"
+            f"{code(game.show_board())}",
+            parse_mode=ParseMode.HTML
+        )
+
+
 @dp.message(Command("move_checkers"))
 async def handle_checkers_move(message: types.Message):
     gid = str(message.chat.id)
@@ -1515,6 +5923,16 @@ async def handle_checkers_move(message: types.Message):
         await message.answer("Сначала начните игру командой /game_checkers")
         return
 
+    game = GAME_STATES[gid]
+
+    # Ход AI: если перебор не идёт (например, после перезапуска), запускаем его
+    if game.current_player == "AI":
+        if gid in CHECKERS_AI.thinking:
+            await message.answer("🤖 AI думает над ходом...")
+        else:
+            await play_checkers_ai(message.chat.id, gid, game)
+        return
+
     try:
         args = message.text.split()
         from_pos = args[1]
@@ -1523,10 +5941,8 @@ async def handle_checkers_move(message: types.Message):
         await message.answer("Укажите ход: /move_checkers [откуда] [куда]\nПример: /move_checkers 52 43")
         return
 
-    game = GAME_STATES[gid]
-
     # Проверяем, чей сейчас ход
-    if message.from_user.full_name != game.current_player and game.current_player != "AI":
+    if message.from_user.full_name != game.current_player:
         await message.answer(f"Сейчас не ваш ход. Ожидается ход от {game.current_player}.")
         return
 
@@ -1534,26 +5950,7 @@ async def handle_checkers_move(message: types.Message):
         # Проверяем окончание игры
         winner = game.winner()
         if winner:
-            if winner == "Draw":
-                result_text = "🎉 Ничья!"
-            else:
-                result_text = f"🎉 Победитель: {bold(winner)}!"
-
-                # Награждаем победителя, если это не AI
-                if winner != "AI":
-                    uid = next((uid for uid, data in users.items() if data.get("username") == winner), None)
-                    if uid:
-                        reward = random.randint(15, 40)
-                        await IriskyEconomy.add_irisky(int(uid), reward, "Победа в шашках")
-                        result_text += f"\n\n🏆 {winner} получает {reward} пайкоинов за победу!"
-
-            await message.answer(
-                f"{result_text}\n\n"
-                f"Итоговая доска:\n\n"
-                f"{code(game.show_board())}",
-                parse_mode=ParseMode.HTML
-            )
-            del GAME_STATES[gid]
+            await message.answer(await finish_checkers_game(gid, game, winner), parse_mode=ParseMode.HTML)
         else:
             await message.answer(
                 f"🔴 Ход {from_pos}-{to_pos} выполнен!\n\n"
@@ -1561,10 +5958,12 @@ async def handle_checkers_move(message: types.Message):
                 f"{code(game.show_board())}",
                 parse_mode=ParseMode.HTML
             )
+            if game.current_player == "AI":
+                await play_checkers_ai(message.chat.id, gid, game)
     else:
         await message.answer(
             f"❌ Недопустимый ход: {from_pos}-{to_pos}\n"
-            f"Попробуйте другой ход или используйте /help для справки.",
+            f"Взятие обязательно; для серии взятий укажите начальную и конечную клетку.",
             parse_mode=ParseMode.HTML
         )
 
@@ -1591,12 +5990,82 @@ async def game_checkers_callback(callback: types.CallbackQuery):
     await game_checkers(callback.message)
 
 
+def format_games_page(player_id: int, page: int):
+    """Текст и клавиатура страницы /games"""
+    game_nos, total = GAME_ARCHIVE.player_games(player_id, page)
+    pages = max((total + GAMES_PAGE_SIZE - 1) // GAMES_PAGE_SIZE, 1)
+    lines = [f"📜 {bold('Ваши партии')} (страница {page + 1} из {pages}, всего {total})\n"]
+    for game_no in game_nos:
+        record = GAME_ARCHIVE.get(game_no)
+        if record is None:
+            continue
+        kind, finished, white_id, _, white_name, black_name, result, moves, _, extra = record
+        is_white = white_id == player_id
+        opponent = black_name if is_white else white_name
+        scores = _ARCHIVE_RESULT_SCORES.get(result)
+        outcome = "не окончена" if scores is None else ("поражение", "ничья", "победа")[scores[0 if is_white else 1]]
+        icon = "♟" if kind == "chess" else "🔴"
+        plies = len(moves) // 2
+        date = from_timestamp(finished).strftime("%d.%m.%Y")
+        line = f"#{game_no} {date} {icon} против {opponent}: {outcome}, ходов: {plies}"
+        if kind == "chess" and extra[1]:
+            line += f" ({extra[1]})"
+        lines.append(line)
+    if not game_nos:
+        lines.append("Завершённых партий пока нет.")
+
+    buttons = []
+    if page > 0:
+        buttons.append(InlineKeyboardButton(text="⬅ Новее", callback_data=f"games_{player_id}_{page - 1}"))
+    if page + 1 < pages:
+        buttons.append(InlineKeyboardButton(text="Старше ➡", callback_data=f"games_{player_id}_{page + 1}"))
+    keyboard = InlineKeyboardMarkup(inline_keyboard=[buttons]) if buttons else None
+    return "\n".join(lines), keyboard
+
+
+@dp.message(Command("games"))
+async def cmd_games(message: types.Message):
+    args = message.text.split()
+    page = int(args[1]) - 1 if len(args) > 1 and args[1].isdigit() and int(args[1]) > 0 else 0
+    text, keyboard = format_games_page(message.from_user.id, page)
+    await message.answer(text, reply_markup=keyboard, parse_mode=ParseMode.HTML)
+
+
+@dp.callback_query(F.data.startswith("games_"))
+async def games_page_callback(callback: types.CallbackQuery):
+    _, player_id, page = callback.data.split("_")
+    if int(player_id) != callback.from_user.id:
+        await callback.answer("Это список чужих партий. Используйте /games")
+        return
+    text, keyboard = format_games_page(int(player_id), int(page))
+    await callback.message.edit_text(text, reply_markup=keyboard, parse_mode=ParseMode.HTML)
+    await callback.answer()
+
+
+@dp.message(Command("rating"))
+async def cmd_rating(message: types.Message):
+    player_id = message.from_user.id
+    rating_text = f"📈 {bold('Рейтинг Эло')}\n"
+    for kind, title in (("chess", "♟ Шахматы"), ("checkers", "🔴 Шашки")):
+        wins, draws, losses = GAME_ARCHIVE.scores(player_id, kind)
+        rating_text += (
+            f"\n{title}: {bold(GAME_ARCHIVE.rating(player_id, kind))} "
+            f"(победы {wins}, ничьи {draws}, поражения {losses})\n"
+        )
+        for place, (rating, pid) in enumerate(GAME_ARCHIVE.top(kind, 5), 1):
+            user = users.get(str(pid))
+            name = user.username if user and user.username else str(pid)
+            rating_text += f"  {place}. {name} - {rating}\n"
+    await message.answer(rating_text, parse_mode=ParseMode.HTML)
+
+
 # ================== МОДЕРАЦИОННЫЕ КОМАНДЫ ==================
 
 @dp.message(Command("warn"))
 async def cmd_warn(message: types.Message):
     uid = str(message.from_user.id)
-    if not users.get(uid, {}).get("is_moderator", False):
+    moderator = users.get(uid)
+    if not moderator or not moderator.is_moderator:
         await message.answer("❌ У вас нет прав для выдачи предупреждений.")
         return
 
@@ -1612,25 +6081,23 @@ async def cmd_warn(message: types.Message):
         await message.answer("Пользователь с указанным ID не найден.")
         return
 
-    users[warn_id]["warnings"].append({
-        "timestamp": datetime.now().isoformat(),
-        "reason": reason,
-        "moderator": users[uid]["username"],
-    })
+    target = users[warn_id]
+    target.warnings.append(WarningEntry(to_timestamp(datetime.now()), reason, moderator.username))
 
-    warn_count = len(users[warn_id]["warnings"])
+    warn_count = len(target.warnings)
 
     # Если 3 или более предупреждений - бан на 24 часа
     if warn_count >= 3:
-        users[warn_id]["ban_expiry"] = (datetime.now() + timedelta(hours=24)).isoformat()
+        target.ban_expiry = to_timestamp(datetime.now() + timedelta(hours=24))
+        BANS.set(int(warn_id), target.ban_expiry)
         await message.answer(
-            f"⚠ Пользователь {users[warn_id]['username']} получил предупреждение ({warn_count}/3).\n"
+            f"⚠ Пользователь {target.username} получил предупреждение ({warn_count}/3).\n"
             f"Причина: {reason}\n\n"
             f"🚫 Пользователь заблокирован на 24 часа за 3 предупреждения."
         )
     else:
         await message.answer(
-            f"⚠ Пользователь {users[warn_id]['username']} получил предупреждение ({warn_count}/3).\n"
+            f"⚠ Пользователь {target.username} получил предупреждение ({warn_count}/3).\n"
             f"Причина: {reason}"
         )
 
@@ -1640,7 +6107,8 @@ async def cmd_warn(message: types.Message):
 @dp.message(Command("ban"))
 async def cmd_ban(message: types.Message):
     uid = str(message.from_user.id)
-    if not users.get(uid, {}).get("is_moderator", False):
+    moderator = users.get(uid)
+    if not moderator or not moderator.is_moderator:
         await message.answer("❌ У вас нет прав для блокировки пользователей.")
         return
 
@@ -1656,9 +6124,11 @@ async def cmd_ban(message: types.Message):
         await message.answer("Пользователь с указанным ID не найден.")
         return
 
-    users[ban_id]["ban_expiry"] = (datetime.now() + timedelta(hours=24)).isoformat()
+    target = users[ban_id]
+    target.ban_expiry = to_timestamp(datetime.now() + timedelta(hours=24))
+    BANS.set(int(ban_id), target.ban_expiry)
     await message.answer(
-        f"🚫 Пользователь {users[ban_id]['username']} заблокирован на 24 часа.\n"
+        f"🚫 Пользователь {target.username} заблокирован на 24 часа.\n"
         f"Причина: {reason}"
     )
     save_data()
@@ -1667,7 +6137,8 @@ async def cmd_ban(message: types.Message):
 @dp.message(Command("unban"))
 async def cmd_unban(message: types.Message):
     uid = str(message.from_user.id)
-    if not users.get(uid, {}).get("is_moderator", False):
+    moderator = users.get(uid)
+    if not moderator or not moderator.is_moderator:
         await message.answer("❌ У вас нет прав для разблокировки пользователей.")
         return
 
@@ -1681,16 +6152,83 @@ async def cmd_unban(message: types.Message):
         await message.answer("Пользователь с указанным ID не найден.")
         return
 
-    users[unban_id]["ban_expiry"] = None
-    users[unban_id]["warnings"] = []  # Снимаем все предупреждения
-    await message.answer(f"✅ Пользователь {users[unban_id]['username']} разблокирован.")
+    target = users[unban_id]
+    target.ban_expiry = None
+    BANS.set(int(unban_id), None)
+    target.warnings = []  # Снимаем все предупреждения
+    await message.answer(f"✅ Пользователь {target.username} разблокирован.")
     save_data()
 
 
+@dp.message(Command("storage"))
+async def cmd_storage(message: types.Message):
+    moderator = users.get(str(message.from_user.id))
+    if not moderator or not moderator.is_moderator:
+        await message.answer("❌ Команда доступна только модераторам.")
+        return
+
+    stats = PERSISTENCE.stats()
+    games = GAME_STATES.stats()
+    book = OPENING_BOOK.stats()
+    puzzles = PUZZLES.stats()
+    archive = GAME_ARCHIVE.stats()
+    checkers_ai = CHECKERS_AI.stats()
+    throttling = THROTTLING.stats()
+    members = CHAT_MEMBERS.stats()
+    translate = TRANSLATOR.stats()
+    maps = MAP_CACHE.stats()
+    circuits = []
+    for breaker in CIRCUIT_BREAKERS.values():
+        circuit = breaker.stats()
+        circuits.append(f"{breaker.name} {circuit['state']} "
+                        f"({circuit['error_rate']:.0%} ошибок, отклонено {circuit['rejected']})")
+    chat_stats = CHAT_STATS.stats()
+    retry_note = f", повтор после ошибки через {stats['retry_delay']:.1f} с" if stats["retry_delay"] else ""
+    await message.answer(
+        f"💾 {bold('Сохранение данных')}\n\n"
+        f"Окно группировки: {PERSISTENCE.delay:.1f} с, макс. потеря: {PERSISTENCE.max_delay:.1f} с\n"
+        f"Изменений: {stats['marks']}, записей: {stats['flushes']}, ошибок: {stats['failures']}\n"
+        f"Задержка записи: последняя {stats['last_latency'] * 1000:.0f} мс, "
+        f"средняя {stats['avg_latency'] * 1000:.0f} мс, макс. {stats['max_latency'] * 1000:.0f} мс\n"
+        f"Несохранённые изменения: {stats['dirty_for']:.1f} с{retry_note}\n\n"
+        f"Состояния пользователей: {len(USER_STATES)} "
+        f"(вытеснено {USER_STATES.evictions}, истекло {USER_STATES.expirations})\n"
+        f"Партии: в памяти {games['live']}, на диске {games['hibernated']} "
+        f"(выгружено {games['hibernations']}, восстановлено {games['revivals']}, удалено {games['purged']})\n"
+        f"Архив партий: {archive['games']} (в хвосте {archive['pending']}), игроков {archive['players']}\n"
+        f"AI шашек: ходов {checkers_ai['searches']}, в работе {checkers_ai['thinking']}, "
+        f"{checkers_ai['nodes_per_second']:.0f} узлов/с, в среднем {checkers_ai['avg_time']:.2f} с на ход\n"
+        f"Ограничение частоты: пропущено {throttling['passed']}, отклонено {throttling['throttled']}, "
+        f"активных корзин {throttling['buckets']}\n"
+        f"Кэш участников: чатов {members['chats']}, участников {members['members']}, "
+        f"попаданий {members['hits']}, запросов администраторов {members['refreshes']}\n"
+        f"Статистика чатов: разделов {chat_stats['chats']}, участий {chat_stats['memberships']}, "
+        f"записей {chat_stats['saves']}\n"
+        f"Погода: в кэше {len(WEATHER_CACHE)}, прогнозов {len(FORECAST_CACHE)}, "
+        f"популярных запросов {len(WEATHER_POPULARITY)}, обновлено заранее {WeatherAPI.refreshes}, "
+        f"отдано устаревших {WeatherAPI.stale_hits}\n"
+        f"Перевод: запросов {translate['requests']}, из кэша {translate['cache_hits']}, "
+        f"склеено {translate['coalesced']}, вызовов API {translate['batches']} ({translate['upstream_texts']} текстов), "
+        f"устаревших {translate['stale_hits']}\n"
+        f"Геокодер и маршруты: в кэше {len(GEOCODE_CACHE)} и {len(ROUTE_CACHE)}, "
+        f"отдано устаревших {GEOCODE_CACHE.stale_hits} и {ROUTE_CACHE.stale_hits}\n"
+        f"Внешние API: {', '.join(circuits)}\n"
+        f"Логи: повторов подавлено {REPEATED_ERRORS.suppressed}, в очереди {LOG_LISTENER.queue.qsize()}\n"
+        f"Карты: {maps['images']} ({maps['bytes'] // 1024} КБ), file_id {maps['file_ids']}, "
+        f"повторных отправок {maps['file_id_hits']}, с диска {maps['hits']}, загрузок {maps['misses']}\n"
+        f"Активных банов: {len(BANS)}, отклонено апдейтов: {BANS.rejected}, снято по сроку: {BANS.lifted}\n"
+        f"Шахматные часы: {len(CHESS_CLOCKS)}, упало флажков: {CHESS_CLOCKS.flag_falls}\n"
+        f"Дебютная книга: {'есть' if book['book'] else 'нет'}, названий дебютов: {book['openings']}\n"
+        f"Задачи: {puzzles['puzzles']}, тем: {puzzles['themes']}",
+        parse_mode=ParseMode.HTML
+    )
+
+
 @dp.message(Command("clearwarns"))
 async def cmd_clearwarns(message: types.Message):
     uid = str(message.from_user.id)
-    if not users.get(uid, {}).get("is_moderator", False):
+    moderator = users.get(uid)
+    if not moderator or not moderator.is_moderator:
         await message.answer("❌ У вас нет прав для снятия предупреждений.")
         return
 
@@ -1704,8 +6242,9 @@ async def cmd_clearwarns(message: types.Message):
         await message.answer("Пользователь с указанным ID не найден.")
         return
 
-    users[clear_id]["warnings"] = []
-    await message.answer(f"✅ Все предупреждения пользователя {users[clear_id]['username']} сняты.")
+    target = users[clear_id]
+    target.warnings = []
+    await message.answer(f"✅ Все предупреждения пользователя {target.username} сняты.")
     save_data()
 
 
@@ -1713,7 +6252,7 @@ async def cmd_clearwarns(message: types.Message):
 
 @dp.errors()
 async def errors_handler(update: types.Update, exception: Exception):
-    logger.error(f"Ошибка при обработке запроса: {exception}", exc_info=True)
+    logger.error("Ошибка при обработке запроса: %s", exception, exc_info=True)
 
     try:
         if isinstance(update, types.Message):
@@ -1721,7 +6260,7 @@ async def errors_handler(update: types.Update, exception: Exception):
                 "⚠ Произошла ошибка при обработке вашего запроса. Пожалуйста, попробуйте позже."
             )
     except Exception as e:
-        logger.error(f"Ошибка при отправке сообщения об ошибке: {e}")
+        logger.error("Ошибка при отправке сообщения об ошибке: %s", e)
 
 
 # ================== ЗАПУСК БОТА ==================
@@ -1730,6 +6269,28 @@ async def on_startup():
     logger.info("Бот запущен")
     # Запускаем фоновую задачу для проверки напоминаний
     asyncio.create_task(check_reminders_background())
+    # Собираем колонки для аналитики экономики
+    asyncio.create_task(ECONOMY.rebuild())
+    # Собираем индекс активных банов
+    asyncio.create_task(BANS.rebuild())
+    # Статистика чатов: загрузка и периодическая запись
+    await asyncio.to_thread(CHAT_STATS.load)
+    asyncio.create_task(save_chat_stats_background())
+    # Индекс городов для пакетных запросов погоды
+    await asyncio.to_thread(CITY_INDEX.load)
+    asyncio.create_task(refresh_weather_background())
+    # Дисковый кэш картинок карт
+    await asyncio.to_thread(MAP_CACHE.open)
+    # Выгружаем неактивные партии на диск
+    asyncio.create_task(maintain_games_background())
+    # Открываем дебютную книгу и базу задач; индекс названий дебютов при необходимости
+    # пересобирается в фоне, до готовности партии идут без подсказок книги
+    asyncio.create_task(asyncio.to_thread(OPENING_BOOK.open))
+    await asyncio.to_thread(PUZZLES.open)
+    # Индексы архива партий и рейтингов
+    await asyncio.to_thread(GAME_ARCHIVE.load)
+    # Таймеры флажка для партий с контролем времени, переживших перезапуск
+    CHESS_CLOCKS.restore()
 
 
 async def check_reminders_background():
@@ -1738,31 +6299,73 @@ async def check_reminders_background():
         try:
             await ReminderManager.check_reminders()
         except Exception as e:
-            logger.error(f"Ошибка в фоновой задаче проверки напоминаний: {e}")
+            logger.error("Ошибка в фоновой задаче проверки напоминаний: %s", e)
         await asyncio.sleep(60)  # Проверяем каждую минуту
 
 
+async def maintain_games_background():
+    """Фоновая задача для выгрузки и удаления неактивных партий"""
+    while True:
+        try:
+            GAME_STATES.maintain()
+        except Exception as e:
+            logger.error("Ошибка в фоновой задаче обслуживания игр: %s", e)
+        await asyncio.sleep(60)
+
+
+async def refresh_weather_background():
+    """Фоновая задача для заблаговременного обновления популярной погоды и прогнозов"""
+    while True:
+        await asyncio.sleep(WEATHER_REFRESH_INTERVAL)
+        try:
+            await WeatherAPI.refresh_popular()
+        except Exception as e:
+            logger.error("Ошибка в фоновой задаче обновления погоды: %s", e)
+
+
+async def save_chat_stats_background():
+    """Фоновая задача для записи статистики чатов"""
+    while True:
+        await asyncio.sleep(CHAT_STATS_SAVE_INTERVAL)
+        await CHAT_STATS.save()
+
+
 async def on_shutdown():
     logger.info("Бот остановлен")
-    save_data()
+    CHESS_CLOCKS.close()
+    CHECKERS_AI.close()
+    GAME_STATES.close()
+    await CHAT_STATS.save()
+    await PERSISTENCE.close()
+    logger.info("Persistence stats: %s", PERSISTENCE.stats())
 
 
 async def main():
+    global bot
+    bot = Bot(token=API_TOKEN, default=DefaultBotProperties(parse_mode=ParseMode.HTML))
     dp.startup.register(on_startup)
     dp.shutdown.register(on_shutdown)
 
     # Запускаем бота
     await bot.delete_webhook(drop_pending_updates=True)
-    await dp.start_polling(bot)
+    # chat_member приходит только если явно запрошен в allowed_updates
+    await dp.start_polling(bot, allowed_updates=dp.resolve_used_update_types())
 
 
 if __name__ == "__main__":
-    import asyncio
-
-    logging.basicConfig(
-        level=logging.INFO,
-        format="%(asctime)s - %(name)s - %(levelname)s - %(message)s",
-    )
+    # python main.py build_puzzle_index - индекс базы задач (PUZZLES_FILE) по рейтингу и темам
+    if len(sys.argv) > 1 and sys.argv[1] == "build_puzzle_index":
+        logger.info("Indexed %s puzzles from %s", PUZZLES.build_index(), PUZZLES_FILE)
+        sys.exit(0)
+
+    # python main.py export_json | import_json - перенос данных между снапшотом и JSON
+    if len(sys.argv) > 1 and sys.argv[1] in ("export_json", "import_json"):
+        if sys.argv[1] == "export_json":
+            export_json()
+        else:
+            import_json()
+            save_data_now()
+        sys.exit(0)
 
     try:
         asyncio.run(main())